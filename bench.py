@@ -0,0 +1,603 @@
+import os
+import sys
+import json
+import time
+import tempfile
+import random
+import argparse
+import threading
+import subprocess
+import statistics
+from collections import defaultdict
+from concurrent.futures import Future
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+os.chdir(tempfile.mkdtemp(prefix="schoolbot-bench-"))
+# spawned worker processes re-import this file; they must open the same DB
+CONFIG = {"BOT_TOKEN": "123456:BENCH", "DB_PATH": os.path.abspath("school.db")}
+
+import telebot
+from telebot import types, apihelper
+
+import education_system_bot as app
+
+# ================== HELPERS ==================
+def make_message(chat_id, text, update_id=1):
+    return types.Message.de_json({
+        "message_id": update_id,
+        "date": 0,
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "bench"},
+        "text": text,
+    })
+
+def per_call_us(fn, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - start) / n * 1e6
+
+def noop(m):
+    pass
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[int(q * (len(values) - 1))] if values else 0.0
+
+# ================== ROUTER ==================
+def bench_router(args):
+    chat_id = 1
+    app.get_state(chat_id).step = "step_last"
+    saved = dict(app.routes)
+    print(f"{'handlers':>8} {'lambda chain, us':>18} {'router, us':>12}")
+    for n in args.sizes:
+        half = n // 2
+        texts = [f"button_{i}" for i in range(half)]
+        steps = [f"step_{i}" for i in range(n - half - 1)] + ["step_last"]
+        m = make_message(chat_id, "free text answer")
+
+        chain = telebot.TeleBot(app.BOT_TOKEN, threaded=False)
+        for t in texts:
+            chain.register_message_handler(noop, func=lambda m, t=t: m.text == t)
+        for st in steps:
+            chain.register_message_handler(noop, func=lambda m, st=st: app.get_state(m.chat.id).step == st)
+
+        app.routes.clear()
+        for t in texts:
+            app.routes[(None, t)] = noop
+        for st in steps:
+            app.routes[(st, None)] = noop
+        routed = telebot.TeleBot(app.BOT_TOKEN, threaded=False)
+        routed.register_message_handler(app.dispatch, content_types=["text"])
+
+        chain_us = per_call_us(lambda: chain.process_new_messages([m]), args.iterations)
+        router_us = per_call_us(lambda: routed.process_new_messages([m]), args.iterations)
+        print(f"{n:>8} {chain_us:>18.2f} {router_us:>12.2f}")
+    app.routes.clear()
+    app.routes.update(saved)
+
+# ================== DB ==================
+SUBJECTS = ["Математика", "Физика", "Химия", "История", "Литература", "Биология", "География", "Английский"]
+
+def seed_grades(rows, students):
+    c = app.db()
+    with c:
+        c.executemany(
+            "INSERT OR IGNORE INTO students (id, login, password) VALUES (?, ?, 'x')",
+            ((i, f"student_{i}") for i in range(1, students + 1))
+        )
+        c.executemany(
+            "INSERT INTO grades (student_id, subject, semester, marks, comment) VALUES (?, ?, ?, x'05040305', '—')",
+            ((i % students + 1, SUBJECTS[i % len(SUBJECTS)], i % 2 + 1) for i in range(rows))
+        )
+
+def seed_grade_totals(students):
+    rng = random.Random(1)
+    with app.db() as c:
+        c.executemany(
+            "INSERT OR IGNORE INTO grade_totals (student_id, subject, semester, count, total) VALUES (?, ?, ?, ?, ?)",
+            ((student_id, subject, semester, count, sum(rng.randint(2, 5) for _ in range(count)))
+             for student_id in range(1, students + 1) for subject in SUBJECTS for semester in (1, 2)
+             for count in [rng.randint(3, 12)])
+        )
+
+def time_analytics(n=5):
+    results = []
+    for subject in (None, SUBJECTS[0]):
+        start = time.perf_counter()
+        for _ in range(n):
+            app.render_analytics(subject)
+        results.append((subject or "вся школа", (time.perf_counter() - start) / n * 1000))
+    return results
+
+def time_hot_queries(students, n):
+    ids = [(i * 7919) % students + 1 for i in range(n)]
+    start = time.perf_counter()
+    for student_id in ids:
+        app.fetch_grades(student_id)
+    by_student = (time.perf_counter() - start) / n * 1e6
+    start = time.perf_counter()
+    for student_id in ids:
+        app.fetch_grades(student_id, SUBJECTS[student_id % len(SUBJECTS)])
+    by_subject = (time.perf_counter() - start) / n * 1e6
+    return by_student, by_subject
+
+def bench_db(args):
+    print(f"⏳ Заполняю grades: {args.rows} строк, {args.students} учеников...")
+    start = time.perf_counter()
+    seed_grades(args.rows, args.students)
+    print(f"   готово за {time.perf_counter() - start:.1f} с")
+
+    problems = app.check_query_plans()
+    print("EXPLAIN QUERY PLAN:", "✅ все горячие запросы по индексу" if not problems else problems)
+
+    indexed = time_hot_queries(args.students, args.queries)
+    with app.db() as c:
+        c.execute("DROP INDEX idx_grades_student_subject_semester")
+    scanned = time_hot_queries(args.students, max(1, args.queries // 100))
+    with app.db() as c:
+        app.migration_grade_indexes(c)
+
+    print(f"{'query':>24} {'full scan, us':>14} {'indexed, us':>12}")
+    print(f"{'progress (student)':>24} {scanned[0]:>14.0f} {indexed[0]:>12.1f}")
+    print(f"{'teacher view (+subject)':>24} {scanned[1]:>14.0f} {indexed[1]:>12.1f}")
+
+    seed_grade_totals(args.students)
+    rows = app.fetch_one("SELECT COUNT(*) FROM grade_totals")[0]
+    for title, ms in time_analytics():
+        print(f"analytics ({title}, {rows} grade_totals rows): {ms:.1f} ms")
+
+# ================== ARCHIVE ==================
+# Several years of grades piled up in the hot table vs. the same reads after
+# a rollover moved the closed years to the archive DB.
+def time_history(students, n):
+    ids = [(i * 7919) % students + 1 for i in range(n)]
+    start = time.perf_counter()
+    for student_id in ids:
+        app.render_history(student_id)
+    return (time.perf_counter() - start) / n * 1000
+
+def bench_archive(args):
+    print(f"⏳ Заполняю grades: {args.years} года по {args.rows} строк, {args.students} учеников...")
+    seed_grades(args.rows * args.years, args.students)
+    piled = time_hot_queries(args.students, args.queries)
+    start = time.perf_counter()
+    closed, _, students, grades, size = app.rollover_year(app.current_year())
+    elapsed = time.perf_counter() - start
+    print(
+        f"rollover {closed}: {grades} строк, {students} учеников за {elapsed:.2f} с ({grades / elapsed:.0f} строк/с), "
+        f"архив {size / 2 ** 20:.1f} МБ ({size / grades:.1f} Б/строку)"
+    )
+    seed_grades(args.rows, args.students)
+    current = time_hot_queries(args.students, args.queries)
+    print(f"{'query':>24} {f'{args.years} years, us':>14} {'one year, us':>13}")
+    print(f"{'progress (student)':>24} {piled[0]:>14.1f} {current[0]:>13.1f}")
+    print(f"{'teacher view (+subject)':>24} {piled[1]:>14.1f} {current[1]:>13.1f}")
+    print(f"history (archive): {time_history(args.students, max(1, args.queries // 10)):.2f} ms")
+
+# ================== BACKUP ==================
+# Grade-write latency of a few chats while nothing else runs vs. while an
+# online backup of the same DB is copying it step by step.
+def timed_writes(chats, until, latencies):
+    def chat(index):
+        i = 0
+        while not until():
+            start = time.perf_counter()
+            app.insert_grades(index + 1, SUBJECTS[i % len(SUBJECTS)], 1, [5, 4], "—")
+            latencies.append(time.perf_counter() - start)
+            i += 1
+            time.sleep(0.005)
+        app.release_db()
+
+    threads = [threading.Thread(target=chat, args=(index,)) for index in range(chats)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+def bench_backup(args):
+    print(f"⏳ Заполняю grades: {args.rows} строк...")
+    seed_grades(args.rows, args.students)
+    idle = []
+    deadline = time.monotonic() + args.seconds
+    for thread in timed_writes(args.chats, lambda: time.monotonic() > deadline, idle):
+        thread.join()
+    during = []
+    done = threading.Event()
+    threads = timed_writes(args.chats, done.is_set, during)
+    start = time.perf_counter()
+    results = app.run_backups()
+    elapsed = time.perf_counter() - start
+    done.set()
+    for thread in threads:
+        thread.join()
+    for source, _, seconds, pages, size, error in results:
+        raw = pages * app.fetch_one("PRAGMA page_size")[0]
+        print(
+            f"{source}: {pages} стр. за {seconds:.2f} с ({pages / seconds:.0f} стр./с), "
+            f"gzip {size / 2 ** 20:.1f} из {raw / 2 ** 20:.1f} МБ" + (f", ошибка: {error}" if error else "")
+        )
+    print(f"{'writes':>16} {'count':>7} {'p50, ms':>8} {'p99, ms':>8} {'max, ms':>8}")
+    for name, values in (("без копии", idle), (f"во время ({elapsed:.1f} с)", during)):
+        print(
+            f"{name:>16} {len(values):>7} {percentile(values, 0.5) * 1000:>8.2f} "
+            f"{percentile(values, 0.99) * 1000:>8.2f} {max(values) * 1000:>8.2f}"
+        )
+
+# ================== SCALE ==================
+# Scripted student sessions pushed through the supervisor into 1..N worker
+# processes; the Bot API is stubbed out inside the workers. Passwords use
+# cheap scrypt parameters hashed inline: this measures dispatch, not the KDF.
+SCALE_SCRYPT_PARAMS = (2 ** 8, 8, 1)
+# the outbox limits are Telegram's, not the bot's; lift them when measuring
+UNLIMITED = 10 ** 6
+
+def scale_worker(index, inbox, config, ready):
+    app.create_app(config)
+    app.bot.send_message = lambda *args, **kwargs: None
+    app.outbox.limiter = app.RateLimiter(UNLIMITED, 0)
+    app.SCRYPT_PARAMS = SCALE_SCRYPT_PARAMS
+    ready.put(index)
+    app.run_worker(index, inbox, config)
+
+def seed_students(count):
+    app.SCRYPT_PARAMS = SCALE_SCRYPT_PARAMS
+    password = app.hash_password("secret")
+    with app.db() as c:
+        c.executemany(
+            "INSERT OR IGNORE INTO students (login, password) VALUES (?, ?)",
+            ((f"Ученик {i:05d}", password) for i in range(count))
+        )
+    ids = app.student_ids_by_logins(f"Ученик {i:05d}" for i in range(count))
+    for subject in SUBJECTS[:4]:
+        app.insert_grades_bulk(subject, [(student_id, 1, [5, 4, 3, 5, 4], "—") for student_id in ids.values()])
+
+def scripted_updates(chats, rounds):
+    script = ["/start", app.BTN_STUDENT, None, "secret"] + [app.BTN_PROGRESS] * 4 + [app.BTN_EXIT]
+    updates = []
+    for r in range(rounds):
+        for text in script:
+            for chat in range(chats):
+                update_id = len(updates) + 1
+                updates.append({"update_id": update_id, "message": {
+                    "message_id": update_id,
+                    "date": 0,
+                    "chat": {"id": 1000 + chat, "type": "private"},
+                    "from": {"id": 1000 + chat, "is_bot": False, "first_name": "bench"},
+                    "text": text or f"Ученик {chat:05d}",
+                }})
+    return updates
+
+def bench_scale(args):
+    seed_students(args.chats)
+    updates = scripted_updates(args.chats, args.rounds)
+    print(f"{'processes':>9} {'updates/s':>10} {'speedup':>8}")
+    base = None
+    for n in args.processes:
+        config = app.Config(CONFIG, WORKER_PROCESSES=n, AUTH_WORKERS=0)
+        ready = app.multiprocessing.get_context("spawn").Queue()
+        router = app.ProcessRouter(n, 10000, target=scale_worker, args=(config, ready))
+        router.start()
+        for _ in range(n):
+            ready.get()
+        start = time.perf_counter()
+        for update in updates:
+            router.submit(update)
+        router.stop(timeout=600)
+        rate = len(updates) / (time.perf_counter() - start)
+        base = base or rate
+        print(f"{n:>9} {rate:>10.0f} {rate / base:>7.2f}x")
+
+# ================== LOAD ==================
+# Scripted conversations for thousands of synthetic chats (student progress,
+# teacher grade entry, an admin broadcast) against a pre-seeded school.db.
+# telebot talks to a local stand-in Bot API server instead of Telegram; it
+# runs in its own process so its CPU is not charged to the bot.
+LOAD_PASSWORD = "secret"
+
+class FakeBotAPI(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes; Nagle would stall each reply
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.answer()
+
+    def do_POST(self):
+        self.answer()
+
+    def answer(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        url = urlparse(self.path)
+        method = url.path.rsplit("/", 1)[-1]
+        chat_id = int(parse_qs(url.query).get("chat_id", ["0"])[0])
+        result = True if method == "answerCallbackQuery" else {
+            "message_id": 1, "date": 0, "chat": {"id": chat_id, "type": "private"},
+        }
+        body = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_fake_api(ports):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeBotAPI)
+    server.daemon_threads = True
+    ports.put(server.server_port)
+    server.serve_forever()
+
+def start_fake_api():
+    context = app.multiprocessing.get_context("spawn")
+    ports = context.Queue()
+    context.Process(target=serve_fake_api, args=(ports,), daemon=True).start()
+    apihelper.API_URL = f"http://127.0.0.1:{ports.get()}/bot{{0}}/{{1}}"
+
+def seed_school(students, teachers, rng):
+    app.SCRYPT_PARAMS = SCALE_SCRYPT_PARAMS
+    password = app.hash_password(LOAD_PASSWORD)
+    with app.db() as c:
+        c.executemany(
+            "INSERT OR IGNORE INTO students (login, password) VALUES (?, ?)",
+            ((f"Ученик {i:05d}", password) for i in range(students))
+        )
+        c.executemany(
+            "INSERT OR IGNORE INTO teachers (login, subject, password) VALUES (?, ?, ?)",
+            ((f"Учитель {i:03d}", SUBJECTS[i % len(SUBJECTS)], password) for i in range(teachers))
+        )
+    ids = app.student_ids_by_logins(f"Ученик {i:05d}" for i in range(students))
+    for subject in SUBJECTS:
+        app.insert_grades_bulk(subject, [
+            (student_id, rng.randint(1, 2), [rng.randint(2, 5) for _ in range(5)], "—") for student_id in ids.values()
+        ])
+
+def load_conversations(args, rng):
+    chats = []
+    for i in range(args.students):
+        chats.append((10000 + i, [
+            "/start", app.BTN_STUDENT, f"Ученик {i:05d}", LOAD_PASSWORD,
+            app.BTN_PROGRESS, app.BTN_PROGRESS, app.BTN_EXIT,
+        ]))
+    for i in range(args.teachers):
+        texts = ["/start", app.BTN_TEACHER, f"Учитель {i:03d}", LOAD_PASSWORD]
+        for _ in range(args.entries):
+            name = f"Ученик {rng.randrange(args.students):05d}"
+            marks = ",".join(str(rng.randint(2, 5)) for _ in range(3))
+            texts += [app.BTN_ENTER_GRADES, name, str(rng.randint(1, 2)), marks, "ок"]
+        texts += [app.BTN_VIEW_STUDENT_GRADES, name, app.BTN_EXIT]
+        chats.append((20000 + i, texts))
+    chats.append((1, ["/start", app.BTN_ADMIN, "admin", "admin123", app.BTN_BROADCAST, "📢 Проверка", app.BTN_SEND_ALL]))
+    # interleave: step k of every chat before step k + 1 of any
+    updates = []
+    for step in range(max(len(texts) for _, texts in chats)):
+        for chat_id, texts in chats:
+            if step < len(texts):
+                update_id = len(updates) + 1
+                updates.append({"update_id": update_id, "message": {
+                    "message_id": update_id,
+                    "date": 0,
+                    "chat": {"id": chat_id, "type": "private"},
+                    "from": {"id": chat_id, "is_bot": False, "first_name": "load"},
+                    "text": texts[step],
+                }})
+    return updates
+
+def record_handlers(samples):
+    call_handler = app.call_handler
+
+    def timed(handler, arg):
+        start = time.perf_counter()
+        try:
+            return call_handler(handler, arg)
+        finally:
+            samples[handler.__name__].append(time.perf_counter() - start)
+    app.call_handler = timed
+
+def db_seconds():
+    with app.query_seconds.lock:
+        return sum(h.sum for h in app.query_seconds.series.values())
+
+def api_calls():
+    with app.api_seconds.lock:
+        return {key[0]: h.count for key, h in app.api_seconds.series.items()}
+
+def bench_load(args):
+    rng = random.Random(args.seed)
+    print(f"⏳ Заполняю school.db: {args.students} учеников, {args.teachers} учителей...")
+    seed_school(args.students, args.teachers, rng)
+    updates = load_conversations(args, rng)
+    start_fake_api()
+    app.limiter = app.RateLimiter(args.broadcast_rate, 0)
+    app.outbox.limiter = app.RateLimiter(args.send_rate or UNLIMITED, 0)
+    samples = defaultdict(list)
+    record_handlers(samples)
+    app.executor.start()
+
+    db_before = db_seconds()
+    start = time.perf_counter()
+    for update in updates:
+        app.executor.submit(update)
+    app.executor.join()
+    app.outbox.join()
+    elapsed = time.perf_counter() - start
+    db_time = db_seconds() - db_before
+    while app.fetch_one("SELECT 1 FROM broadcasts WHERE status='running'"):
+        time.sleep(0.05)
+    broadcast = time.perf_counter() - start
+
+    handled = sum(len(v) for v in samples.values())
+    print(f"updates: {len(updates)} за {elapsed:.2f} с — {len(updates) / elapsed:.0f} updates/s")
+    print(f"обработчики: p50 {percentile(sum(samples.values(), []), 0.5) * 1000:.2f} мс, "
+          f"p99 {percentile(sum(samples.values(), []), 0.99) * 1000:.2f} мс ({handled} вызовов)")
+    print(f"БД: {db_time:.2f} с суммарно по запросам" if app.METRICS else "БД: n/a (METRICS=0)")
+    print(f"рассылка завершена через {broadcast:.2f} с; Bot API: {api_calls()}")
+    st = app.outbox.stats()
+    with app.send_queue_seconds.lock:
+        delay = app.send_queue_seconds.series.get(("send_message",))
+        p99 = f"p99 ≤ {delay.quantile(0.99) * 1000:.0f} мс" if delay else "p99 n/a"
+    print(f"отправка: {st['sent']} вызовов, ожидание в очереди ср. {st['avg_wait_ms']:.1f} мс, {p99}, "
+          f"повторов после 429: {st['retried']}, ошибок {st['failed']}")
+    print(f"{'handler':>24} {'calls':>7} {'p50, ms':>8} {'p99, ms':>8}")
+    slow = []
+    for name, values in sorted(samples.items(), key=lambda item: -percentile(item[1], 0.99)):
+        p99 = percentile(values, 0.99) * 1000
+        print(f"{name:>24} {len(values):>7} {percentile(values, 0.5) * 1000:>8.2f} {p99:>8.2f}")
+        if args.max_p99_ms and p99 > args.max_p99_ms:
+            slow.append(name)
+    if slow:
+        print(f"❌ p99 выше {args.max_p99_ms} мс: {', '.join(slow)}")
+        sys.exit(1)
+
+# ================== WRITES ==================
+# N chats saving grades at once (what save_grades does), either through the
+# group-commit writer or with one transaction and commit per write on the
+# chat's own connection, as before the writer.
+class DirectWriter:
+    def submit(self, op):
+        # runs the write at once and hands back an already resolved future
+        future = Future()
+        try:
+            future.set_result(self.write(op))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def write(self, op):
+        with app.db() as c:
+            return op(c)
+
+def run_writers(chats, writes, sync):
+    barrier = threading.Barrier(chats + 1)
+
+    def chat(index):
+        app.db().execute(f"PRAGMA synchronous={sync}")
+        barrier.wait()
+        for i in range(writes // chats):
+            app.insert_grades(index + 1, SUBJECTS[i % len(SUBJECTS)], 1, [5, 4], "—")
+        app.release_db()
+
+    threads = [threading.Thread(target=chat, args=(index,)) for index in range(chats)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return writes // chats * chats / (time.perf_counter() - start)
+
+def bench_writes(args):
+    with app.db() as c:
+        c.executemany(
+            "INSERT OR IGNORE INTO students (id, login, password) VALUES (?, ?, 'x')",
+            ((i, f"student_{i}") for i in range(1, max(args.chats) + 1))
+        )
+    print(f"{'sync':>6} {'chats':>6} {'commit each, w/s':>17} {'group commit, w/s':>18} {'writes/commit':>14}")
+    sh = app.shard()
+    for sync in args.sync:
+        for chats in args.chats:
+            sh.writer = DirectWriter()
+            direct = run_writers(chats, args.writes, sync)
+            sh.writer = app.Writer(sh.path, args.batch_ms / 1000, sync)
+            grouped = run_writers(chats, args.writes, sync)
+            st = sh.writer.stats()
+            sh.writer.stop()
+            print(f"{sync:>6} {chats:>6} {direct:>17.0f} {grouped:>18.0f} {st['per_commit']:>14.1f}")
+
+# ================== STARTUP ==================
+# Cold start in a fresh interpreter each run: importing the module, then
+# create_app() on an empty DB (all migrations) and on an up-to-date one.
+STARTUP_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import education_system_bot as app
+imported = time.perf_counter()
+if sys.argv[1] != "-":
+    app.create_app(app.Config(BOT_TOKEN="123456:BENCH", DB_PATH=sys.argv[1], METRICS=False, AUTH_WORKERS=0))
+print(imported - start, time.perf_counter() - imported)
+"""
+
+def cold_start(db_path):
+    out = subprocess.run(
+        [sys.executable, "-c", STARTUP_SCRIPT, db_path], check=True, capture_output=True, text=True,
+        cwd=os.getcwd(), env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__))),
+    ).stdout.split("\n")[-2]
+    return [float(x) * 1000 for x in out.split()]
+
+def bench_startup(args):
+    fresh, current = [], []
+    for run in range(args.runs):
+        path = os.path.abspath(f"startup-{run}.db")
+        fresh.append(cold_start(path))
+        current.append(cold_start(path))
+    imports = [cold_start("-")[0] for _ in range(args.runs)]
+    print(f"{'':>22} {'import, ms':>11} {'create_app, ms':>15}")
+    print(f"{'import only':>22} {statistics.median(imports):>11.1f} {'—':>15}")
+    for title, runs in (("empty DB", fresh), ("up-to-date DB", current)):
+        print(f"{title:>22} {statistics.median(r[0] for r in runs):>11.1f} {statistics.median(r[1] for r in runs):>15.1f}")
+    print("import без create_app() не создаёт school.db:", "✅" if not os.path.exists("school.db") else "❌")
+
+# ================== RUN ==================
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SchoolBot benchmarks")
+    sub = parser.add_subparsers(dest="name", required=True)
+
+    p = sub.add_parser("router", help="per-update routing cost vs. the lambda-filter chain")
+    p.add_argument("--iterations", type=int, default=5000)
+    p.add_argument("--sizes", type=int, nargs="+", default=[35, 100, 500, 1000])
+    p.set_defaults(func=bench_router)
+
+    p = sub.add_parser("db", help="grade hot-path queries on a large grades table, with and without indexes")
+    p.add_argument("--rows", type=int, default=2_000_000)
+    p.add_argument("--students", type=int, default=20_000)
+    p.add_argument("--queries", type=int, default=2000)
+    p.set_defaults(func=bench_db)
+
+    p = sub.add_parser("archive", help="hot grade queries with years of grades piled up vs. after a rollover")
+    p.add_argument("--rows", type=int, default=300_000, help="grade rows per year")
+    p.add_argument("--years", type=int, default=4)
+    p.add_argument("--students", type=int, default=5_000)
+    p.add_argument("--queries", type=int, default=2000)
+    p.set_defaults(func=bench_archive)
+
+    p = sub.add_parser("backup", help="grade-write latency with and without an online backup running")
+    p.add_argument("--rows", type=int, default=1_000_000)
+    p.add_argument("--students", type=int, default=5_000)
+    p.add_argument("--chats", type=int, default=8)
+    p.add_argument("--seconds", type=float, default=3.0, help="length of the baseline run")
+    p.set_defaults(func=bench_backup)
+
+    p = sub.add_parser("scale", help="update throughput through the supervisor with 1..N worker processes")
+    p.add_argument("--chats", type=int, default=400)
+    p.add_argument("--rounds", type=int, default=5)
+    p.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    p.set_defaults(func=bench_scale)
+
+    p = sub.add_parser("load", help="scripted conversations against a fake Bot API server")
+    p.add_argument("--students", type=int, default=2000)
+    p.add_argument("--teachers", type=int, default=40)
+    p.add_argument("--entries", type=int, default=10, help="grade entries per teacher")
+    p.add_argument("--broadcast-rate", type=float, default=1000, help="messages/sec for the fake API")
+    p.add_argument("--send-rate", type=float, default=0, help="outbox messages/sec (0: unlimited)")
+    p.add_argument("--max-p99-ms", type=float, default=0, help="exit 1 if any handler's p99 is above this")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_load)
+
+    p = sub.add_parser("writes", help="grade writes/s for concurrent chats: commit per write vs. group commit")
+    p.add_argument("--chats", type=int, nargs="+", default=[1, 10, 100])
+    p.add_argument("--writes", type=int, default=2000, help="writes per run, split between the chats")
+    p.add_argument("--sync", nargs="+", default=["NORMAL", "FULL"], help="PRAGMA synchronous values to compare")
+    p.add_argument("--batch-ms", type=float, default=2.0)
+    p.set_defaults(func=bench_writes)
+
+    p = sub.add_parser("startup", help="cold start: import time, create_app() on an empty and an up-to-date DB")
+    p.add_argument("--runs", type=int, default=10)
+    p.set_defaults(func=bench_startup)
+
+    args = parser.parse_args()
+    if args.name != "startup":
+        app.create_app(app.Config(CONFIG))
+    args.func(args)
+    sys.exit(0)
@@ -1,706 +1,4056 @@
-import os
-import sqlite3
-import random
-import string
-import telebot
-from telebot import types
-from dotenv import load_dotenv
-
-# ================== CONFIG ==================
-load_dotenv()
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-if not BOT_TOKEN:
-    raise RuntimeError("❌ BOT_TOKEN не найден в .env файле")
-
-bot = telebot.TeleBot(BOT_TOKEN)
-
-# ================== BUTTONS ==================
-BTN_ADMIN = "🛠 Администратор"
-BTN_TEACHER = "👨‍🏫 Преподаватель"
-BTN_STUDENT = "👨‍🎓 Ученик"
-
-BTN_ADD_STUDENT = "👤 Добавить ученика"
-BTN_ENTER_GRADES = "✏️ Ввести оценки"
-BTN_LIST_STUDENTS = "📋 Список учеников"
-BTN_VIEW_STUDENT_GRADES = "🔍 Посмотреть оценки ученика"
-
-BTN_ADD_TEACHER = "➕ Добавить преподавателя"
-BTN_LIST_TEACHERS = "📋 Список преподавателей"
-BTN_DELETE_PROFILE = "🗑 Удалить профиль"
-BTN_BROADCAST = "📨 Рассылка"
-
-BTN_PROGRESS = "📊 Моя успеваемость"
-BTN_CHANGE_PASSWORD = "🔐 Сменить пароль"
-BTN_EXIT = "🚪 Выйти"
-BTN_CANCEL = "❌ Отмена"
-BTN_CONFIRM_DELETE = "✅ Подтвердить удаление"
-
-# ================== DATABASE ==================
-conn = sqlite3.connect("school.db", check_same_thread=False)
-cursor = conn.cursor()
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS admins(
-    id INTEGER PRIMARY KEY,
-    login TEXT UNIQUE,
-    password TEXT
-)
-""")
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS teachers(
-    id INTEGER PRIMARY KEY,
-    login TEXT UNIQUE,
-    subject TEXT,
-    password TEXT
-)
-""")
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS students(
-    id INTEGER PRIMARY KEY,
-    login TEXT UNIQUE,
-    password TEXT
-)
-""")
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS grades(
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    student_id INTEGER,
-    subject TEXT,
-    semester INTEGER,
-    grades TEXT,
-    comment TEXT,
-    FOREIGN KEY(student_id) REFERENCES students(id) ON DELETE CASCADE
-)
-""")
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS users(
-    chat_id INTEGER PRIMARY KEY
-)
-""")
-conn.commit()
-
-# ================== SEED DEFAULT ADMIN ==================
-cursor.execute("SELECT COUNT(*) FROM admins")
-if cursor.fetchone()[0] == 0:
-    cursor.execute("INSERT INTO admins (login, password) VALUES ('admin', 'admin123')")
-    conn.commit()
-
-# ================== STATE MANAGEMENT ==================
-states = {}
-
-def get_state(chat_id):
-    if chat_id not in states:
-        states[chat_id] = {"role": None, "step": None}
-    return states[chat_id]
-
-def reset_step(chat_id):
-    if chat_id in states:
-        states[chat_id]["step"] = None
-
-# ================== UTILS ==================
-def gen_password():
-    return ''.join(random.choices(string.ascii_letters + string.digits, k=8))
-
-def percent(grades):
-    if not grades:
-        return 0.0
-    return round(sum(grades) / len(grades) / 5 * 100, 1)
-
-def final_mark(p):
-    if p <= 54: return 2
-    if p <= 69: return 3
-    if p <= 84: return 4
-    return 5
-
-def validate_grades(text):
-    try:
-        grades = list(map(int, text.split(",")))
-        if all(2 <= g <= 5 for g in grades):
-            return grades
-    except:
-        pass
-    return None
-
-# ================== KEYBOARDS ==================
-def role_menu():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add(BTN_ADMIN, BTN_TEACHER, BTN_STUDENT)
-    return kb
-
-def admin_menu():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add(BTN_ADD_TEACHER, BTN_LIST_TEACHERS)
-    kb.add(BTN_BROADCAST)
-    kb.add(BTN_DELETE_PROFILE)
-    kb.add(BTN_EXIT)
-    return kb
-
-def teacher_menu():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add(BTN_ADD_STUDENT)
-    kb.add(BTN_ENTER_GRADES, BTN_VIEW_STUDENT_GRADES)
-    kb.add(BTN_LIST_STUDENTS)
-    kb.add(BTN_EXIT)
-    return kb
-
-def student_menu():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add(BTN_PROGRESS)
-    kb.add(BTN_CHANGE_PASSWORD)
-    kb.add(BTN_EXIT)
-    return kb
-
-def cancel_button():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add(BTN_CANCEL)
-    return kb
-
-def confirm_delete_button():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add(BTN_CONFIRM_DELETE, BTN_CANCEL)
-    return kb
-
-# ================== START & EXIT ==================
-@bot.message_handler(commands=["start"])
-def start(m):
-    try:
-        cursor.execute("INSERT OR IGNORE INTO users (chat_id) VALUES (?)", (m.chat.id,))
-        conn.commit()
-        s = get_state(m.chat.id)
-        s["role"] = None
-        s["step"] = None
-        bot.send_message(
-            m.chat.id,
-            "🎓 <b>Добро пожаловать в SchoolBot!</b>\n\n"
-            "Выберите свою роль:\n"
-            "👨‍🎓 <b>Ученик</b> — просмотр оценок\n"
-            "👨‍🏫 <b>Преподаватель</b> — ввод и управление\n"
-            "🛠 <b>Администратор</b> — настройка системы",
-            parse_mode="HTML",
-            reply_markup=role_menu()
-        )
-    except Exception as e:
-        print(f"⚠️ Ошибка в /start: {e}")
-        bot.send_message(m.chat.id, "❌ Произошла ошибка. Попробуйте позже.")
-
-@bot.message_handler(commands=["cancel"])
-def cmd_cancel(m):
-    cancel(m)
-
-@bot.message_handler(func=lambda m: m.text == BTN_CANCEL)
-def cancel(m):
-    reset_step(m.chat.id)
-    s = get_state(m.chat.id)
-    if s["role"] == "admin":
-        bot.send_message(m.chat.id, "↩️ Отменено. Вы в панели администратора.", reply_markup=admin_menu())
-    elif s["role"] == "teacher":
-        bot.send_message(m.chat.id, "↩️ Отменено. Вы в меню преподавателя.", reply_markup=teacher_menu())
-    elif s["role"] == "student":
-        bot.send_message(m.chat.id, "↩️ Отменено. Вы в личном кабинете.", reply_markup=student_menu())
-    else:
-        start(m)
-
-@bot.message_handler(func=lambda m: m.text == BTN_EXIT)
-def exit_menu(m):
-    start(m)
-
-# ================== ADMIN AUTH ==================
-@bot.message_handler(func=lambda m: m.text == BTN_ADMIN)
-def admin_login(m):
-    s = get_state(m.chat.id)
-    s["role"] = None
-    s["step"] = "admin_login"
-    bot.send_message(m.chat.id, "🔐 Введите логин администратора:", reply_markup=cancel_button())
-
-@bot.message_handler(func=lambda m: get_state(m.chat.id)["step"] == "admin_login")
-def admin_password(m):
-    s = get_state(m.chat.id)
-    s["login"] = m.text
-    s["step"] = "admin_password"
-    bot.send_message(m.chat.id, "🔑 Введите пароль:", reply_markup=cancel_button())
-
-@bot.message_handler(func=lambda m: get_state(m.chat.id)["step"] == "admin_password")
-def admin_auth(m):
-    try:
-        s = get_state(m.chat.id)
-        cursor.execute("SELECT id FROM admins WHERE login=? AND password=?", (s["login"], m.text))
-        if not cursor.fetchone():
-            bot.send_message(m.chat.id, "❌ Неверные данные. Попробуйте снова.", reply_markup=role_menu())
-            reset_step(m.chat.id)
-            return
-        s["role"] = "admin"
-        reset_step(m.chat.id)
-        bot.send_message(
-            m.chat.id,
-            "✅ <b>Вы вошли как администратор!</b>\n\nВыберите действие:",
-            parse_mode="HTML",
-            reply_markup=admin_menu()
-        )
-    except Exception as e:
-        print(f"⚠️ Ошибка в admin_auth: {e}")
-        bot.send_message(m.chat.id, "❌ Внутренняя ошибка. Обратитесь к разработчику.")
-
-# ================== ADD TEACHER (ADMIN) ==================
-@bot.message_handler(func=lambda m: m.text == BTN_ADD_TEACHER)
-def add_teacher(m):
-    s = get_state(m.chat.id)
-    if s["role"] != "admin":
-        bot.send_message(m.chat.id, "❌ Только для администраторов.", reply_markup=role_menu())
-        return
-    reset_step(m.chat.id)
-    s["step"] = "teacher_name"
-    bot.send_message(m.chat.id, "👤 Введите ФИО преподавателя (уникальное):", reply_markup=cancel_button())
-
-@bot.message_handler(func=lambda m: get_state(m.chat.id)["step"] == "teacher_name")
-def teacher_enter_subject(m):
-    name = m.text.strip()
-    if not name:
-        bot.send_message(m.chat.id, "❌ ФИО не может быть пустым.", reply_markup=cancel_button())
-        return
-    cursor.execute("SELECT id FROM teachers WHERE login=?", (name,))
-    if cursor.fetchone():
-        bot.send_message(m.chat.id, "❌ Преподаватель с таким ФИО уже существует!", reply_markup=admin_menu())
-        reset_step(m.chat.id)
-        return
-    s = get_state(m.chat.id)
-    s["teacher_name"] = name
-    s["step"] = "teacher_subject"
-    bot.send_message(m.chat.id, "📚 Введите предмет:", reply_markup=cancel_button())
-
-@bot.message_handler(func=lambda m: get_state(m.chat.id)["step"] == "teacher_subject")
-def save_teacher(m):
-    subject = m.text.strip()
-    if not subject:
-        bot.send_message(m.chat.id, "❌ Предмет не может быть пустым.", reply_markup=cancel_button())
-        return
-    s = get_state(m.chat.id)
-    name = s["teacher_name"]
-    password = gen_password()
-    cursor.execute("INSERT INTO teachers (login, subject, password) VALUES (?, ?, ?)", (name, subject, password))
-    conn.commit()
-    reset_step(m.chat.id)
-    bot.send_message(
-        m.chat.id,
-        f"✅ <b>Преподаватель добавлен!</b>\n"
-        f"👤 ФИО: <b>{name}</b>\n"
-        f"📚 Предмет: <b>{subject}</b>\n"
-        f"🔑 Пароль: <code>{password}</code>\n\n"
-        f"❗ Перешлите пароль — он не сохраняется!",
-        parse_mode="HTML",
-        reply_markup=admin_menu()
-    )
-
-# ================== LIST TEACHERS (ADMIN) ==================
-@bot.message_handler(func=lambda m: m.text == BTN_LIST_TEACHERS)
-def list_teachers(m):
-    s = get_state(m.chat.id)
-    if s["role"] != "admin":
-        bot.send_message(m.chat.id, "❌ Только для администраторов.", reply_markup=role_menu())
-        return
-    reset_step(m.chat.id)
-    cursor.execute("SELECT login, subject FROM teachers")
-    teachers = cursor.fetchall()
-    if not teachers:
-        bot.send_message(m.chat.id, "📭 Нет преподавателей.", reply_markup=admin_menu())
-        return
-    text = "📋 <b>Список преподавателей:</b>\n\n"
-    for name, subject in teachers:
-        text += f"• <b>{name}</b> — {subject}\n"
-    bot.send_message(m.chat.id, text, parse_mode="HTML", reply_markup=admin_menu())
-
-# ================== BROADCAST (ADMIN) ==================
-@bot.message_handler(func=lambda m: m.text == BTN_BROADCAST)
-def broadcast_start(m):
-    s = get_state(m.chat.id)
-    if s["role"] != "admin":
-        bot.send_message(m.chat.id, "❌ Только админ может делать рассылку.", reply_markup=role_menu())
-        return
-    reset_step(m.chat.id)
-    s["step"] = "broadcast_text"
-    bot.send_message(m.chat.id, "📬 Введите текст рассылки (можно с HTML):", reply_markup=cancel_button())
-
-@bot.message_handler(func=lambda m: get_state(m.chat.id)["step"] == "broadcast_text")
-def broadcast_preview(m):
-    s = get_state(m.chat.id)
-    message_text = m.text.strip()
-    if not message_text:
-        bot.send_message(m.chat.id, "❌ Текст не может быть пустым.", reply_markup=cancel_button())
-        return
-    s["broadcast_content"] = message_text
-    bot.send_message(m.chat.id, "📤 <b>Предпросмотр:</b>", parse_mode="HTML")
-    try:
-        bot.send_message(m.chat.id, message_text, parse_mode="HTML")
-    except:
-        bot.send_message(m.chat.id, "⚠️ Ошибка HTML. Отправляю как обычный текст.")
-        bot.send_message(m.chat.id, message_text)
-    s["step"] = "confirm_broadcast"
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add("✅ Отправить всем", "❌ Отменить")
-    bot.send_message(m.chat.id, "❓ Отправить всем пользователям?", reply_markup=kb)
-
-@bot.message_handler(func=lambda m: get_state(m.chat.id)["step"] == "confirm_broadcast" and m.text == "✅ Отправить всем")
-def broadcast_confirmed(m):
-    s = get_state(m.chat.id)
-    message_text = s["broadcast_content"]
-    cursor.execute("SELECT chat_id FROM users")
-    all_chats = cursor.fetchall()
-    success = failed = 0
-    for (chat_id,) in all_chats:
-        try:
-            bot.send_message(chat_id, message_text, parse_mode="HTML")
-            success += 1
-        except:
-            failed += 1
-    reset_step(m.chat.id)
-    bot.send_message(
-        m.chat.id,
-        f"✅ <b>Рассылка отправлена!</b>\n"
-        f"👥 Получателей: {len(all_chats)}\n"
-        f"✅ Успешно: {success}\n"
-        f"❌ Ошибок: {failed}",
-        parse_mode="HTML",
-        reply_markup=admin_menu()
-    )
-
-@bot.message_handler(func=lambda m: get_state(m.chat.id)["step"] == "confirm_broadcast" and m.text == "❌ Отменить")
-def broadcast_cancelled(m):
-    reset_step(m.chat.id)
-    bot.send_message(m.chat.id, "📨 Рассылка отменена.", reply_markup=admin_menu())
-
-# ================== DELETE PROFILE (ADMIN) ==================
-@bot.message_handler(func=lambda m: m.text == BTN_DELETE_PROFILE)
-def admin_delete(m):
-    s = get_state(m.chat.id)
-    if s["role"] != "admin":
-        bot.send_message(m.chat.id, "❌ Только для администраторов.", reply_markup=role_menu())
-        return
-    reset_step(m.chat.id)
-    s["step"] = "delete_login"
-    bot.send_message(m.chat.id, "🗑 Введите ФИО для удаления:", reply_markup=cancel_button())
-
-@bot.message_handler(func=lambda m: get_state(m.chat.id)["step"] == "delete_login")
-def admin_delete_confirm(m):
-    login = m.text.strip()
-    if not login:
-        bot.send_message(m.chat.id, "❌ ФИО не может быть пустым.", reply_markup=cancel_button())
-        return
-    exists = False
-    cursor.execute("SELECT 1 FROM students WHERE login=?", (login,))
-    if cursor.fetchone():
-        exists = True
-    else:
-        cursor.execute("SELECT 1 FROM teachers WHERE login=?", (login,))
-        if cursor.fetchone():
-            exists = True
-    if not exists:
-        bot.send_message(m.chat.id, "⚠️ Пользователь не найден.", reply_markup=admin_menu())
-        reset_step(m.chat.id)
-        return
-    s = get_state(m.chat.id)
-    s["delete_target"] = login
-    s["step"] = "confirm_delete"
-    bot.send_message(
-        m.chat.id,
-        f"❓ Удалить <b>{login}</b>?\n❗ Все данные будут потеряны!",
-        parse_mode="HTML",
-        reply_markup=confirm_delete_button()
-    )
-
-@bot.message_handler(func=lambda m: get_state(m.chat.id)["step"] == "confirm_delete" and m.text == BTN_CONFIRM_DELETE)
-def delete_confirmed(m):
-    login = get_state(m.chat.id)["delete_target"]
-    cursor.execute("DELETE FROM grades WHERE student_id IN (SELECT id FROM students WHERE login=?)", (login,))
-    cursor.execute("DELETE FROM students WHERE login=?", (login,))
-    cursor.execute("DELETE FROM teachers WHERE login=?", (login,))
-    conn.commit()
-    reset_step(m.chat.id)
-    bot.send_message(m.chat.id, f"✅ Пользователь <b>{login}</b> удалён.", parse_mode="HTML", reply_markup=admin_menu())
-
-# ================== TEACHER AUTH ==================
-@bot.message_handler(func=lambda m: m.text == BTN_TEACHER)
-def teacher_login(m):
-    s = get_state(m.chat.id)
-    s["role"] = None
-    s["step"] = "teacher_login"
-    bot.send_message(m.chat.id, "👤 Введите ваше ФИО:", reply_markup=cancel_button())
-
-@bot.message_handler(func=lambda m: get_state(m.chat.id)["step"] == "teacher_login")
-def teacher_password(m):
-    s = get_state(m.chat.id)
-    s["login"] = m.text
-    s["step"] = "teacher_password"
-    bot.send_message(m.chat.id, "🔑 Введите пароль:", reply_markup=cancel_button())
-
-@bot.message_handler(func=lambda m: get_state(m.chat.id)["step"] == "teacher_password")
-def teacher_auth(m):
-    s = get_state(m.chat.id)
-    cursor.execute("SELECT id, subject FROM teachers WHERE login=? AND password=?", (s["login"], m.text))
-    row = cursor.fetchone()
-    if not row:
-        bot.send_message(m.chat.id, "❌ Неверные данные.", reply_markup=role_menu())
-        reset_step(m.chat.id)
-        return
-    s.update({"role": "teacher", "subject": row[1], "step": None})
-    bot.send_message(
-        m.chat.id,
-        f"✅ <b>Добро пожаловать, {s['login']}!</b>\n"
-        f"📚 Предмет: <b>{row[1]}</b>",
-        parse_mode="HTML",
-        reply_markup=teacher_menu()
-    )
-
-# ================== ADD STUDENT (TEACHER) ==================
-@bot.message_handler(func=lambda m: m.text == BTN_ADD_STUDENT)
-def add_student(m):
-    s = get_state(m.chat.id)
-    if s["role"] != "teacher":
-        bot.send_message(m.chat.id, "❌ Только для преподавателей.", reply_markup=role_menu())
-        return
-    reset_step(m.chat.id)
-    s["step"] = "student_name"
-    bot.send_message(m.chat.id, "👤 Введите ФИО ученика (уникальное):", reply_markup=cancel_button())
-
-@bot.message_handler(func=lambda m: get_state(m.chat.id)["step"] == "student_name")
-def save_student(m):
-    name = m.text.strip()
-    if not name:
-        bot.send_message(m.chat.id, "❌ ФИО не может быть пустым.", reply_markup=cancel_button())
-        return
-    cursor.execute("SELECT id FROM students WHERE login=?", (name,))
-    if cursor.fetchone():
-        bot.send_message(m.chat.id, "❌ Ученик уже существует!", reply_markup=teacher_menu())
-        reset_step(m.chat.id)
-        return
-    password = gen_password()
-    cursor.execute("INSERT INTO students (login, password) VALUES (?, ?)", (name, password))
-    conn.commit()
-    reset_step(m.chat.id)
-    bot.send_message(
-        m.chat.id,
-        f"✅ <b>Ученик добавлен!</b>\n"
-        f"👤 ФИО: <b>{name}</b>\n"
-        f"🔑 Пароль: <code>{password}</code>",
-        parse_mode="HTML",
-        reply_markup=teacher_menu()
-    )
-
-# ================== LIST STUDENTS (TEACHER) ==================
-@bot.message_handler(func=lambda m: m.text == BTN_LIST_STUDENTS)
-def list_students(m):
-    s = get_state(m.chat.id)
-    if s["role"] != "teacher":
-        bot.send_message(m.chat.id, "❌ Только для преподавателей.", reply_markup=role_menu())
-        return
-    reset_step(m.chat.id)
-    cursor.execute("SELECT login FROM students")
-    students = cursor.fetchall()
-    if not students:
-        bot.send_message(m.chat.id, "📭 Нет учеников.", reply_markup=teacher_menu())
-        return
-    text = "📋 <b>Список учеников:</b>\n\n"
-    for (name,) in students:
-        text += f"• {name}\n"
-    text += "\n💡 Используйте «✏️ Ввести оценки» или «🔍 Посмотреть оценки»."
-    bot.send_message(m.chat.id, text, parse_mode="HTML", reply_markup=teacher_menu())
-
-# ================== VIEW STUDENT GRADES (TEACHER) ==================
-@bot.message_handler(func=lambda m: m.text == BTN_VIEW_STUDENT_GRADES)
-def view_student_grades_start(m):
-    s = get_state(m.chat.id)
-    if s["role"] != "teacher":
-        bot.send_message(m.chat.id, "❌ Только для преподавателей.", reply_markup=role_menu())
-        return
-    reset_step(m.chat.id)
-    cursor.execute("SELECT login FROM students")
-    students = cursor.fetchall()
-    if not students:
-        bot.send_message(m.chat.id, "📭 Нет учеников.", reply_markup=teacher_menu())
-        return
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    for (name,) in students:
-        kb.add(name)
-    kb.add(BTN_CANCEL)
-    s["step"] = "view_choose_student"
-    bot.send_message(m.chat.id, "🔍 Выберите ученика:", reply_markup=kb)
-
-@bot.message_handler(func=lambda m: get_state(m.chat.id)["step"] == "view_choose_student")
-def show_student_grades(m):
-    student_name = m.text.strip()
-    cursor.execute("SELECT id FROM students WHERE login=?", (student_name,))
-    row = cursor.fetchone()
-    if not row:
-        bot.send_message(m.chat.id, "❌ Ученик не найден.", reply_markup=cancel_button())
-        return
-    student_id = row[0]
-    s = get_state(m.chat.id)
-    cursor.execute("SELECT subject, semester, grades, comment FROM grades WHERE student_id=? AND subject=?", (student_id, s["subject"]))
-    rows = cursor.fetchall()
-    if not rows:
-        bot.send_message(m.chat.id, f"📭 У <b>{student_name}</b> нет оценок по «{s['subject']}».", parse_mode="HTML", reply_markup=teacher_menu())
-        reset_step(m.chat.id)
-        return
-    text = f"📊 <b>Оценки: {student_name}</b>\n\n"
-    for subj, sem, g_str, comm in rows:
-        grades = list(map(int, g_str.split(",")))
-        p = percent(grades)
-        text += (
-            f"• <b>{subj}</b> — {sem} сем.\n"
-            f"  Оценки: <code>{g_str}</code>\n"
-            f"  Комментарий: {comm}\n"
-            f"  Итог: <b>{final_mark(p)}</b>\n\n"
-        )
-    bot.send_message(m.chat.id, text, parse_mode="HTML", reply_markup=teacher_menu())
-    reset_step(m.chat.id)
-
-# ================== ENTER GRADES (TEACHER) ==================
-@bot.message_handler(func=lambda m: m.text == BTN_ENTER_GRADES)
-def start_grades(m):
-    s = get_state(m.chat.id)
-    if s["role"] != "teacher":
-        bot.send_message(m.chat.id, "❌ Только для преподавателей.", reply_markup=role_menu())
-        return
-    reset_step(m.chat.id)
-    cursor.execute("SELECT login FROM students")
-    students = cursor.fetchall()
-    if not students:
-        bot.send_message(m.chat.id, "📭 Нет учеников.")
-        return
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    for (name,) in students:
-        kb.add(name)
-    kb.add(BTN_CANCEL)
-    s["step"] = "choose_student"
-    bot.send_message(m.chat.id, "✏️ Выберите ученика:", reply_markup=kb)
-
-@bot.message_handler(func=lambda m: get_state(m.chat.id)["step"] == "choose_student")
-def choose_student(m):
-    cursor.execute("SELECT id FROM students WHERE login=?", (m.text.strip(),))
-    row = cursor.fetchone()
-    if not row:
-        bot.send_message(m.chat.id, "❌ Ученик не найден.", reply_markup=cancel_button())
-        return
-    s = get_state(m.chat.id)
-    s["student_id"] = row[0]
-    s["step"] = "semester"
-    bot.send_message(m.chat.id, "🔢 Семестр (1 или 2):", reply_markup=cancel_button())
-
-@bot.message_handler(func=lambda m: get_state(m.chat.id)["step"] == "semester")
-def enter_semester(m):
-    if m.text not in ("1", "2"):
-        bot.send_message(m.chat.id, "🔢 Введите 1 или 2.", reply_markup=cancel_button())
-        return
-    s = get_state(m.chat.id)
-    s["semester"] = int(m.text)
-    s["step"] = "grades"
-    bot.send_message(m.chat.id, "🎯 Оценки через запятую (2–5):\nПример: <code>5,4,5</code>", reply_markup=cancel_button())
-
-@bot.message_handler(func=lambda m: get_state(m.chat.id)["step"] == "grades")
-def enter_grades(m):
-    grades = validate_grades(m.text)
-    if not grades:
-        bot.send_message(m.chat.id, "❌ Оценки от 2 до 5 через запятую.", reply_markup=cancel_button())
-        return
-    s = get_state(m.chat.id)
-    s["grades"] = ",".join(map(str, grades))
-    s["step"] = "comment"
-    bot.send_message(m.chat.id, "💬 Комментарий (можно пропустить):", reply_markup=cancel_button())
-
-@bot.message_handler(func=lambda m: get_state(m.chat.id)["step"] == "comment")
-def save_grades(m):
-    s = get_state(m.chat.id)
-    comment = m.text.strip() or "—"
-    cursor.execute(
-        "INSERT INTO grades (student_id, subject, semester, grades, comment) VALUES (?,?,?,?,?)",
-        (s["student_id"], s["subject"], s["semester"], s["grades"], comment)
-    )
-    conn.commit()
-    reset_step(m.chat.id)
-    bot.send_message(m.chat.id, "✅ Оценки сохранены!", reply_markup=teacher_menu())
-
-# ================== STUDENT AUTH ==================
-@bot.message_handler(func=lambda m: m.text == BTN_STUDENT)
-def student_login(m):
-    s = get_state(m.chat.id)
-    s["role"] = None
-    s["step"] = "student_login"
-    bot.send_message(m.chat.id, "👤 Введите ваше ФИО:", reply_markup=cancel_button())
-
-@bot.message_handler(func=lambda m: get_state(m.chat.id)["step"] == "student_login")
-def student_password(m):
-    s = get_state(m.chat.id)
-    s["login"] = m.text
-    s["step"] = "student_password"
-    bot.send_message(m.chat.id, "🔑 Введите пароль:", reply_markup=cancel_button())
-
-@bot.message_handler(func=lambda m: get_state(m.chat.id)["step"] == "student_password")
-def student_auth(m):
-    s = get_state(m.chat.id)
-    cursor.execute("SELECT id FROM students WHERE login=? AND password=?", (s["login"], m.text))
-    row = cursor.fetchone()
-    if not row:
-        bot.send_message(m.chat.id, "❌ Неверные данные.", reply_markup=role_menu())
-        reset_step(m.chat.id)
-        return
-    s.update({"role": "student", "student_id": row[0], "step": None})
-    bot.send_message(m.chat.id, f"✅ Добро пожаловать, <b>{s['login']}</b>!", parse_mode="HTML", reply_markup=student_menu())
-
-@bot.message_handler(func=lambda m: m.text == BTN_CHANGE_PASSWORD)
-def change_password(m):
-    s = get_state(m.chat.id)
-    if s["role"] != "student":
-        bot.send_message(m.chat.id, "❌ Только для учеников.", reply_markup=role_menu())
-        return
-    reset_step(m.chat.id)
-    s["step"] = "new_password"
-    bot.send_message(m.chat.id, "🔑 Новый пароль (минимум 6 символов):", reply_markup=cancel_button())
-
-@bot.message_handler(func=lambda m: get_state(m.chat.id)["step"] == "new_password")
-def save_new_password(m):
-    new_pass = m.text.strip()
-    if len(new_pass) < 6:
-        bot.send_message(m.chat.id, "❌ Минимум 6 символов.", reply_markup=cancel_button())
-        return
-    s = get_state(m.chat.id)
-    cursor.execute("UPDATE students SET password=? WHERE id=?", (new_pass, s["student_id"]))
-    conn.commit()
-    reset_step(m.chat.id)
-    bot.send_message(m.chat.id, "✅ Пароль изменён!", reply_markup=student_menu())
-
-@bot.message_handler(func=lambda m: m.text == BTN_PROGRESS)
-def progress(m):
-    s = get_state(m.chat.id)
-    if s["role"] != "student":
-        return
-    reset_step(m.chat.id)
-    cursor.execute("SELECT subject, semester, grades, comment FROM grades WHERE student_id=?", (s["student_id"],))
-    rows = cursor.fetchall()
-    if not rows:
-        bot.send_message(m.chat.id, "📭 У вас пока нет оценок.", reply_markup=student_menu())
-        return
-    data = {}
-    comments = {}
-    for subj, sem, g, c in rows:
-        key = (subj, sem)
-        data.setdefault(key, []).extend(map(int, g.split(",")))
-        comments.setdefault(key, []).append(c)
-    text = "📊 <b>Ваша успеваемость:</b>\n\n"
-    for (subj, sem), grades in data.items():
-        p = percent(grades)
-        comment_text = "; ".join(filter(lambda x: x != "—", comments[(subj, sem)])) or "—"
-        text += (
-            f"<b>{subj}</b> — {sem} сем.\n"
-            f"Оценки: <code>{','.join(map(str, grades))}</code>\n"
-            f"Комментарий: {comment_text}\n"
-            f"Итог: <b>{final_mark(p)}</b>\n\n"
-        )
-    text += "🔽 Скопируйте, чтобы показать родителям."
-    bot.send_message(m.chat.id, text, parse_mode="HTML", reply_markup=student_menu())
-
-# ================== RUN ==================
-if __name__ == "__main__":
-    print("🚀 SchoolBot запущен!")
-    bot.polling(none_stop=True, timeout=60, long_polling_timeout=60)
+import os
+import re
+import sys
+import json
+import time
+import atexit
+import io
+import csv
+import gzip
+import zlib
+import tempfile
+import itertools
+import functools
+import bisect
+import html
+import sqlite3
+import random
+import string
+import threading
+import queue
+import hmac
+import hashlib
+import signal
+import multiprocessing
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+import telebot
+from telebot.apihelper import ApiTelegramException
+from telebot import types, apihelper
+from dotenv import load_dotenv
+
+# ================== CONFIG ==================
+# Importing this module has no side effects: no .env, no token check, no DB.
+# The values below are defaults; create_app() applies a Config on top of them
+# (Config.from_env() reads .env and the environment, tests pass their own).
+BOT_TOKEN = None
+DB_PATH = "school.db"
+
+# BOT_MODE=webhook runs the built-in HTTP server instead of long polling.
+# TLS is expected to be terminated by a reverse proxy in front of it.
+BOT_MODE = "polling"
+WEBHOOK_URL = None
+WEBHOOK_SECRET = None
+WEBHOOK_HOST = "127.0.0.1"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "/webhook"
+
+# Updates are processed on WORKER_LANES serial lanes, one per chat shard.
+WORKER_LANES = 8
+LANE_QUEUE_SIZE = 200
+
+# WORKER_PROCESSES > 1 starts a supervisor that forwards updates to that many
+# worker processes, partitioned by chat id.
+WORKER_PROCESSES = 1
+
+# METRICS=0 turns instrumentation off entirely; METRICS_PORT serves it as
+# Prometheus text (worker processes use METRICS_PORT + 1 + index).
+METRICS = True
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 0
+
+# processes hashing passwords; 0 hashes on the calling thread
+AUTH_WORKERS = 2
+
+# outgoing messages are sent from SEND_LANES threads; 0 sends inline
+SEND_LANES = 4
+SEND_QUEUE_SIZE = 1000
+
+# group commit: writes arriving within WRITE_BATCH_MS share one transaction;
+# WRITE_SYNC=FULL makes each of them durable before the handler continues
+WRITE_BATCH_MS = 2.0
+WRITE_SYNC = "NORMAL"
+
+# every school is its own SQLite file; this many stay open per process
+MAX_OPEN_SHARDS = 32
+
+# online backups of every school into BACKUP_DIR (next to DB_PATH), every
+# BACKUP_INTERVAL_HOURS (0: only on /backup now); BACKUP_PAGES pages are
+# copied per step with BACKUP_STEP_MS between steps
+BACKUP_DIR = "backups"
+BACKUP_INTERVAL_HOURS = 24.0
+BACKUP_KEEP = 7
+BACKUP_PAGES = 256
+BACKUP_STEP_MS = 10.0
+
+SETTINGS = {
+    "BOT_TOKEN": str,
+    "DB_PATH": str,
+    "BOT_MODE": str,
+    "WEBHOOK_URL": str,
+    "WEBHOOK_SECRET": str,
+    "WEBHOOK_HOST": str,
+    "WEBHOOK_PORT": int,
+    "WEBHOOK_PATH": str,
+    "WORKER_LANES": int,
+    "LANE_QUEUE_SIZE": int,
+    "WORKER_PROCESSES": int,
+    "METRICS": lambda value: value == "1",
+    "METRICS_HOST": str,
+    "METRICS_PORT": int,
+    "AUTH_WORKERS": int,
+    "SEND_LANES": int,
+    "SEND_QUEUE_SIZE": int,
+    "WRITE_BATCH_MS": float,
+    "WRITE_SYNC": str,
+    "MAX_OPEN_SHARDS": int,
+    "BACKUP_DIR": str,
+    "BACKUP_INTERVAL_HOURS": float,
+    "BACKUP_KEEP": int,
+    "BACKUP_PAGES": int,
+    "BACKUP_STEP_MS": float,
+}
+
+class Config(dict):
+    # overrides of the settings above, by name
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        unknown = set(self) - set(SETTINGS)
+        if unknown:
+            raise ValueError(f"Неизвестные настройки: {', '.join(sorted(unknown))}")
+
+    @classmethod
+    def from_env(cls):
+        load_dotenv()
+        return cls((name, parse(os.environ[name])) for name, parse in SETTINGS.items() if name in os.environ)
+
+# built by create_app(); handlers run on the executor's lanes, not on
+# TeleBot's own thread pool, and reply through the outbox
+bot = None
+executor = None
+outbox = None
+
+# ================== BUTTONS ==================
+BTN_ADMIN = "🛠 Администратор"
+BTN_TEACHER = "👨‍🏫 Преподаватель"
+BTN_STUDENT = "👨‍🎓 Ученик"
+
+BTN_ADD_STUDENT = "👤 Добавить ученика"
+BTN_ENTER_GRADES = "✏️ Ввести оценки"
+BTN_LIST_STUDENTS = "📋 Список учеников"
+BTN_VIEW_STUDENT_GRADES = "🔍 Посмотреть оценки ученика"
+BTN_IMPORT_GRADES = "📥 Импорт оценок"
+BTN_IMPORT_STUDENTS = "📥 Импорт учеников"
+BTN_ANALYTICS = "📊 Аналитика"
+BTN_EXPORT_GRADES = "📤 Экспорт оценок"
+BTN_EXPORT_CSV = "CSV"
+BTN_EXPORT_XLSX = "XLSX"
+BTN_EXPORT_GZIP = "CSV (gzip)"
+
+BTN_ADD_TEACHER = "➕ Добавить преподавателя"
+BTN_LIST_TEACHERS = "📋 Список преподавателей"
+BTN_IMPORT_TEACHERS = "📥 Импорт преподавателей"
+BTN_DELETE_PROFILE = "🗑 Удалить профиль"
+BTN_ROLLOVER = "📅 Закрыть учебный год"
+BTN_BROADCAST = "📨 Рассылка"
+BTN_BROADCAST_STATUS = "📈 Статус рассылки"
+
+BTN_PROGRESS = "📊 Моя успеваемость"
+BTN_CHANGE_PASSWORD = "🔐 Сменить пароль"
+BTN_HISTORY = "🗂 Прошлые годы"
+BTN_EXIT = "🚪 Выйти"
+BTN_CANCEL = "❌ Отмена"
+BTN_CONFIRM_DELETE = "✅ Подтвердить удаление"
+BTN_CONFIRM_ROLLOVER = "✅ Закрыть год"
+BTN_SEND_ALL = "✅ Отправить всем"
+BTN_CANCEL_BROADCAST = "❌ Отменить"
+
+# ================== METRICS ==================
+# Fixed-bucket histograms keyed by a label tuple. Hooks are only installed
+# when METRICS is on, so a disabled build pays nothing on the hot path.
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(METRIC_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q-th observation
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(METRIC_BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+class HistogramFamily:
+    def __init__(self, name, labels, help):
+        self.name = name
+        self.labels = labels
+        self.help = help
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, key, value):
+        with self.lock:
+            h = self.series.get(key)
+            if h is None:
+                h = self.series[key] = Histogram()
+            h.counts[bisect.bisect_left(METRIC_BUCKETS, value)] += 1
+            h.sum += value
+            h.count += 1
+
+class CounterFamily:
+    def __init__(self, name, labels, help):
+        self.name = name
+        self.labels = labels
+        self.help = help
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def inc(self, key, value=1):
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + value
+
+handler_seconds = HistogramFamily("schoolbot_handler_seconds", ("handler",), "Handler latency")
+query_seconds = HistogramFamily("schoolbot_query_seconds", ("sql",), "SQLite statement time to first row")
+api_seconds = HistogramFamily("schoolbot_telegram_api_seconds", ("method",), "Bot API call latency")
+api_errors = CounterFamily("schoolbot_telegram_api_errors_total", ("method", "code"), "Failed Bot API calls")
+handler_errors = CounterFamily("schoolbot_handler_errors_total", ("handler",), "Handlers that raised")
+send_queue_seconds = HistogramFamily("schoolbot_send_queue_seconds", ("method",), "Time a Bot API call waited in the outbox")
+send_retries = CounterFamily("schoolbot_send_retries_total", ("method",), "Bot API calls retried after a 429")
+backup_failures = CounterFamily("schoolbot_backup_failures_total", ("source",), "Files whose backup failed")
+HISTOGRAMS = (handler_seconds, query_seconds, api_seconds, send_queue_seconds)
+COUNTERS = (api_errors, handler_errors, send_retries, backup_failures)
+
+def call_handler(handler, arg):
+    if not METRICS:
+        return handler(arg)
+    start = time.perf_counter()
+    try:
+        return handler(arg)
+    except Exception:
+        handler_errors.inc((handler.__name__,))
+        raise
+    finally:
+        handler_seconds.observe((handler.__name__,), time.perf_counter() - start)
+
+# Statements are keyed by their text with whitespace collapsed and "?, ?, ..."
+# runs folded, so batched IN (...) lists of any size share one series.
+_sql_keys = {}
+
+def sql_key(sql):
+    key = _sql_keys.get(sql)
+    if key is None:
+        key = re.sub(r"\?(\s*,\s*\?)+", "?, ...", " ".join(sql.split()))
+        if len(_sql_keys) < 10000:
+            _sql_keys[sql] = key
+    return key
+
+class TimedConnection(sqlite3.Connection):
+    def execute(self, sql, params=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            query_seconds.observe((sql_key(sql),), time.perf_counter() - start)
+
+    def executemany(self, sql, params):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, params)
+        finally:
+            query_seconds.observe((sql_key(sql),), time.perf_counter() - start)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            query_seconds.observe(("COMMIT",), time.perf_counter() - start)
+
+_make_request = apihelper._make_request
+
+def timed_request(token, method_name, method="get", params=None, files=None):
+    start = time.perf_counter()
+    try:
+        return _make_request(token, method_name, method, params, files)
+    except ApiTelegramException as e:
+        api_errors.inc((method_name, str(e.error_code)))
+        raise
+    except Exception:
+        api_errors.inc((method_name, "network"))
+        raise
+    finally:
+        api_seconds.observe((method_name,), time.perf_counter() - start)
+
+# ================== DATABASE ==================
+# Every worker thread gets its own connection (TeleBot runs handlers on a
+# thread pool), so execute/fetch pairs can no longer interleave between chats.
+# Connections of finished threads go back to a pool instead of being closed.
+#
+# Each school is its own SQLite file (shard) with its own write lock. DB_PATH
+# is the first school's shard and also holds the catalog: the schools, which
+# school every login and chat belongs to, and the sessions. db() returns the
+# connection for the school the current thread works for (use_school()).
+# Shards are opened on first use; past MAX_OPEN_SHARDS the least recently
+# used one is closed together with its pool and writer.
+CATALOG = 1
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA foreign_keys=ON",
+)
+DB_STATEMENT_CACHE = 256
+
+_db_local = threading.local()
+_shards = OrderedDict()
+_shards_lock = threading.Lock()
+
+def open_connection(path):
+    c = sqlite3.connect(
+        path, timeout=30, check_same_thread=False, cached_statements=DB_STATEMENT_CACHE,
+        factory=TimedConnection if METRICS else sqlite3.Connection
+    )
+    for pragma in DB_PRAGMAS:
+        c.execute(pragma)
+    return c
+
+class Shard:
+    def __init__(self, school_id, path):
+        self.school_id = school_id
+        self.path = path
+        self.pool = queue.LifoQueue()
+        self.writer = Writer(path, WRITE_BATCH_MS / 1000, WRITE_SYNC.upper())
+        self.closed = False
+
+    def connect(self):
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            return open_connection(self.path)
+
+    def release(self, c):
+        if self.closed:
+            c.close()
+        else:
+            self.pool.put(c)
+
+    def close(self):
+        # connections held by threads are dropped by them on next use
+        self.closed = True
+        self.writer.stop()
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+def shard_path(school_id):
+    if school_id == CATALOG:
+        return DB_PATH
+    row = db(CATALOG).execute("SELECT path FROM schools WHERE id=?", (school_id,)).fetchone()
+    if row is None:
+        raise KeyError(f"Школа #{school_id} не найдена")
+    # relative to the catalog, so a district moves as one directory
+    return os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), row[0])
+
+def shard(school_id=None):
+    school_id = school_id or current_school()
+    with _shards_lock:
+        sh = _shards.get(school_id)
+        if sh is not None:
+            _shards.move_to_end(school_id)
+            return sh
+    sh = Shard(school_id, shard_path(school_id))
+    c = sh.connect()
+    migrate(c)
+    sh.release(c)
+    evicted = []
+    with _shards_lock:
+        if school_id in _shards:
+            # opened by another thread meanwhile
+            evicted.append(sh)
+            sh = _shards[school_id]
+        else:
+            _shards[school_id] = sh
+            candidates = [key for key in _shards if key not in (CATALOG, school_id)]
+            while len(_shards) > MAX_OPEN_SHARDS and candidates:
+                evicted.append(_shards.pop(candidates.pop(0)))
+    for old in evicted:
+        old.close()
+    return sh
+
+def open_shards():
+    with _shards_lock:
+        return list(_shards.values())
+
+def close_shards():
+    with _shards_lock:
+        shards = list(_shards.values())
+        _shards.clear()
+    for sh in shards:
+        sh.close()
+
+def current_school():
+    return getattr(_db_local, "school", CATALOG)
+
+def use_school(school_id):
+    _db_local.school = school_id
+
+def db(school_id=None):
+    school_id = school_id or current_school()
+    conns = getattr(_db_local, "conns", None)
+    if conns is None:
+        conns = _db_local.conns = {}
+    held = conns.get(school_id)
+    if held is not None and not held[0].closed:
+        return held[1]
+    # forget connections of closed shards; a cursor still reading one keeps
+    # it alive until it is done
+    for key in [key for key, (sh, _) in conns.items() if sh.closed]:
+        del conns[key]
+    sh = shard(school_id)
+    c = sh.connect()
+    conns[school_id] = (sh, c)
+    return c
+
+def release_db():
+    conns = getattr(_db_local, "conns", None)
+    if conns:
+        _db_local.conns = {}
+        for sh, c in conns.values():
+            sh.release(c)
+
+def writer(school_id=None):
+    return shard(school_id).writer
+
+def fetch_one(sql, params=()):
+    return db().execute(sql, params).fetchone()
+
+def fetch_all(sql, params=()):
+    return db().execute(sql, params).fetchall()
+
+# ================== WRITER ==================
+# Single-row writes from handlers are handed to the shard's writer thread,
+# which has its own connection. Everything queued within WRITE_BATCH_MS of the
+# first write shares one transaction and one commit (group commit); each write runs in a
+# SAVEPOINT, so one that fails is rolled back alone and raises from its own
+# future. WRITE_SYNC is the writer's PRAGMA synchronous: NORMAL may lose the
+# last commits on power loss (never corrupts), FULL makes a write durable by
+# the time its future resolves.
+WRITE_BATCH_MAX = 500
+
+class Writer:
+    def __init__(self, path, window, sync):
+        self.path = path
+        self.queue = queue.Queue()
+        self.window = window
+        self.sync = sync
+        self.started = self.stopping = False
+        self.lock = threading.Lock()
+        self.writes = self.commits = 0
+
+    def submit(self, op):
+        # op(c) runs on the writer's connection inside the shared transaction
+        future = Future()
+        with self.lock:
+            if not self.started:
+                self.started = True
+                threading.Thread(target=self.work, name="writer", daemon=True).start()
+            self.queue.put((future, op))
+        return future
+
+    def write(self, op):
+        return self.submit(op).result()
+
+    def work(self):
+        c = open_connection(self.path)
+        c.execute(f"PRAGMA synchronous={self.sync}")
+        last = 1
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < WRITE_BATCH_MAX:
+                # take what is already queued; wait out the window only while
+                # the batch is smaller than the previous one, so a lone writer
+                # commits at once and a steady load doesn't idle on the timer
+                timeout = deadline - time.monotonic() if len(batch) < last else 0
+                try:
+                    batch.append(self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            ops = [item for item in batch if item is not None]
+            if ops:
+                self.commit(c, ops)
+                last = len(ops)
+            for _ in batch:
+                self.queue.task_done()
+            with self.lock:
+                # stop() was called and nothing came in after it
+                if self.stopping and self.queue.empty():
+                    self.started = self.stopping = False
+                    c.close()
+                    return
+
+    def commit(self, c, batch):
+        results = []
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            for future, op in batch:
+                c.execute("SAVEPOINT write")
+                try:
+                    results.append((future, op(c), None))
+                    c.execute("RELEASE write")
+                except Exception as e:
+                    c.execute("ROLLBACK TO write")
+                    c.execute("RELEASE write")
+                    results.append((future, None, e))
+            c.commit()
+        except Exception as e:
+            c.rollback()
+            print(f"⚠️ Групповая запись не удалась ({len(batch)} операций): {e}")
+            for future, _ in batch:
+                future.set_exception(e)
+            return
+        self.writes += len(batch)
+        self.commits += 1
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def stop(self):
+        # finishes what is queued, then closes the connection; a later
+        # submit() starts it again
+        with self.lock:
+            if self.started:
+                self.stopping = True
+                self.queue.put(None)
+
+    def join(self):
+        self.queue.join()
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "writes": self.writes,
+            "commits": self.commits,
+            "per_commit": self.writes / self.commits if self.commits else 0.0,
+        }
+
+# ================== PASSWORDS ==================
+# Passwords are stored as "scrypt$n$r$p$salt$key". The KDF is deliberately
+# slow, so it runs on a small process pool: the lane waiting for it blocks,
+# other chats keep being served. Plaintext rows and rows with outdated
+# parameters are rehashed on the next successful login.
+SCRYPT_PARAMS = (2 ** 14, 8, 1)
+
+_auth_pool = None
+_auth_pool_lock = threading.Lock()
+
+def derive_key(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=64 * 1024 * 1024, dklen=32)
+
+def auth_pool():
+    global _auth_pool
+    with _auth_pool_lock:
+        if _auth_pool is None:
+            _auth_pool = ProcessPoolExecutor(AUTH_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _auth_pool
+
+def run_kdf(jobs):
+    # jobs: (password, salt, n, r, p)
+    if not jobs:
+        return []
+    if AUTH_WORKERS == 0:
+        return [derive_key(*job) for job in jobs]
+    return list(auth_pool().map(derive_key, *zip(*jobs)))
+
+def hash_passwords(passwords):
+    n, r, p = SCRYPT_PARAMS
+    salts = [os.urandom(16) for _ in passwords]
+    keys = run_kdf([(password, salt, n, r, p) for password, salt in zip(passwords, salts)])
+    return [f"scrypt${n}${r}${p}${salt.hex()}${key.hex()}" for salt, key in zip(salts, keys)]
+
+def hash_password(password):
+    return hash_passwords([password])[0]
+
+def verify_password(password, stored):
+    # returns (ok, needs_rehash)
+    if not stored.startswith("scrypt$"):
+        return hmac.compare_digest(stored.encode(), password.encode()), True
+    _, n, r, p, salt, key = stored.split("$")
+    params = (int(n), int(r), int(p))
+    derived = run_kdf([(password, bytes.fromhex(salt)) + params])[0]
+    return hmac.compare_digest(derived.hex(), key), params != SCRYPT_PARAMS
+
+# ================== MIGRATIONS ==================
+# PRAGMA user_version holds the number of applied migrations. Each migration
+# runs in its own transaction together with the version bump, so an existing
+# school.db is evolved in place and a crash never leaves it half-migrated.
+def migration_initial_schema(c):
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS admins(
+        id INTEGER PRIMARY KEY,
+        login TEXT UNIQUE,
+        password TEXT
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS teachers(
+        id INTEGER PRIMARY KEY,
+        login TEXT UNIQUE,
+        subject TEXT,
+        password TEXT
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS students(
+        id INTEGER PRIMARY KEY,
+        login TEXT UNIQUE,
+        password TEXT
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS grades(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        student_id INTEGER,
+        subject TEXT,
+        semester INTEGER,
+        grades TEXT,
+        comment TEXT,
+        FOREIGN KEY(student_id) REFERENCES students(id) ON DELETE CASCADE
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS users(
+        chat_id INTEGER PRIMARY KEY
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS broadcasts(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        admin_chat_id INTEGER,
+        text TEXT,
+        status TEXT DEFAULT 'running',
+        created_at REAL,
+        finished_at REAL
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS broadcast_recipients(
+        broadcast_id INTEGER,
+        chat_id INTEGER,
+        status TEXT DEFAULT 'pending',
+        attempts INTEGER DEFAULT 0,
+        PRIMARY KEY (broadcast_id, chat_id),
+        FOREIGN KEY(broadcast_id) REFERENCES broadcasts(id) ON DELETE CASCADE
+    ) WITHOUT ROWID
+    """)
+
+def migration_grade_indexes(c):
+    # the cascade was never enforced, so clean up grades of deleted students
+    c.execute("DELETE FROM grades WHERE student_id NOT IN (SELECT id FROM students)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_grades_student_subject_semester ON grades(student_id, subject, semester)")
+
+def migration_packed_grades(c):
+    # grades TEXT "5,4,5" -> marks BLOB b"\x05\x04\x05", plus per-(student, subject, semester) totals
+    c.create_function("pack_marks", 1, lambda text: bytes(map(int, text.split(","))) if text else b"", deterministic=True)
+    c.create_function("marks_sum", 1, lambda marks: sum(marks or b""), deterministic=True)
+    c.execute("ALTER TABLE grades ADD COLUMN marks BLOB")
+    c.execute("UPDATE grades SET marks = pack_marks(grades)")
+    c.execute("ALTER TABLE grades DROP COLUMN grades")
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS grade_totals(
+        student_id INTEGER,
+        subject TEXT,
+        semester INTEGER,
+        count INTEGER NOT NULL,
+        total INTEGER NOT NULL,
+        PRIMARY KEY (student_id, subject, semester),
+        FOREIGN KEY(student_id) REFERENCES students(id) ON DELETE CASCADE
+    ) WITHOUT ROWID
+    """)
+    c.execute("""
+    INSERT INTO grade_totals (student_id, subject, semester, count, total)
+    SELECT student_id, subject, semester, SUM(length(marks)), SUM(marks_sum(marks))
+    FROM grades GROUP BY student_id, subject, semester
+    """)
+
+def migration_sessions(c):
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS sessions(
+        chat_id INTEGER PRIMARY KEY,
+        data TEXT NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sessions_updated_at ON sessions(updated_at)")
+
+def migration_students_search(c):
+    # FTS5 index over ФИО for the student picker; skipped if SQLite lacks FTS5
+    try:
+        c.execute("CREATE VIRTUAL TABLE students_fts USING fts5(login, content='students', content_rowid='id')")
+    except sqlite3.OperationalError as e:
+        print(f"⚠️ FTS5 недоступен, поиск учеников по префиксу: {e}")
+        return
+    c.execute("""
+    CREATE TRIGGER students_fts_insert AFTER INSERT ON students BEGIN
+        INSERT INTO students_fts(rowid, login) VALUES (new.id, new.login);
+    END
+    """)
+    c.execute("""
+    CREATE TRIGGER students_fts_delete AFTER DELETE ON students BEGIN
+        INSERT INTO students_fts(students_fts, rowid, login) VALUES ('delete', old.id, old.login);
+    END
+    """)
+    c.execute("""
+    CREATE TRIGGER students_fts_update AFTER UPDATE OF login ON students BEGIN
+        INSERT INTO students_fts(students_fts, rowid, login) VALUES ('delete', old.id, old.login);
+        INSERT INTO students_fts(rowid, login) VALUES (new.id, new.login);
+    END
+    """)
+    c.execute("INSERT INTO students_fts(students_fts) VALUES ('rebuild')")
+
+def migration_cache_invalidations(c):
+    # AUTOINCREMENT: ids must never be reused after old rows are purged
+    c.execute("""
+    CREATE TABLE cache_invalidations(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        student_id INTEGER,
+        login TEXT,
+        created_at REAL NOT NULL
+    )
+    """)
+
+def migration_grade_totals_by_subject(c):
+    # covering index for per-subject analytics
+    c.execute("CREATE INDEX idx_grade_totals_subject ON grade_totals(subject, semester, student_id, count, total)")
+
+def migration_school_catalog(c):
+    # every shard gets these tables, only DB_PATH's copy is used; no foreign
+    # keys, the rows they would point at live in other files
+    c.execute("""
+    CREATE TABLE schools(
+        id INTEGER PRIMARY KEY,
+        name TEXT UNIQUE NOT NULL,
+        path TEXT UNIQUE,
+        created_at REAL NOT NULL
+    )
+    """)
+    c.execute("""
+    CREATE TABLE school_logins(
+        login TEXT PRIMARY KEY,
+        school_id INTEGER NOT NULL
+    ) WITHOUT ROWID
+    """)
+    c.execute("CREATE INDEX idx_school_logins_school ON school_logins(school_id)")
+    c.execute("""
+    CREATE TABLE school_chats(
+        chat_id INTEGER PRIMARY KEY,
+        school_id INTEGER NOT NULL
+    )
+    """)
+    # everyone registered so far belongs to the first school
+    for table in ("admins", "teachers", "students"):
+        c.execute(f"INSERT OR IGNORE INTO school_logins (login, school_id) SELECT login, 1 FROM {table}")
+
+def migration_academic_years(c):
+    # grades of the open year stay in grades; rollover moves them to the archive
+    c.execute("""
+    CREATE TABLE academic_years(
+        id INTEGER PRIMARY KEY,
+        name TEXT UNIQUE NOT NULL,
+        started_at REAL NOT NULL,
+        closed_at REAL,
+        archived_grades INTEGER
+    )
+    """)
+    c.execute("INSERT INTO academic_years (name, started_at) VALUES (?, ?)", (academic_year_name(), time.time()))
+
+def migration_backups(c):
+    # backup runs; like the catalog, only DB_PATH's copy is used
+    c.execute("""
+    CREATE TABLE backups(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        source TEXT NOT NULL,
+        file TEXT,
+        started_at REAL NOT NULL,
+        seconds REAL NOT NULL,
+        pages INTEGER NOT NULL,
+        bytes INTEGER NOT NULL,
+        error TEXT
+    )
+    """)
+    c.execute("CREATE INDEX idx_backups_source ON backups(source, started_at)")
+
+MIGRATIONS = [
+    migration_initial_schema,
+    migration_grade_indexes,
+    migration_packed_grades,
+    migration_sessions,
+    migration_students_search,
+    migration_cache_invalidations,
+    migration_grade_totals_by_subject,
+    migration_school_catalog,
+    migration_academic_years,
+    migration_backups,
+]
+
+def migrate(c):
+    version = c.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        # IMMEDIATE takes the write lock up front; another process may have
+        # applied this migration while we were waiting for it
+        c.execute("BEGIN IMMEDIATE")
+        if c.execute("PRAGMA user_version").fetchone()[0] >= number:
+            c.rollback()
+            continue
+        try:
+            migration(c)
+            c.execute(f"PRAGMA user_version={number}")
+            c.commit()
+        except Exception:
+            c.rollback()
+            raise
+        print(f"🗄 Миграция БД #{number}: {migration.__name__}")
+
+# Hot-path queries that must be served by an index, checked at startup.
+HOT_QUERIES = [
+    ("SELECT subject, semester, marks, comment FROM grades WHERE student_id=?", (0,)),
+    ("SELECT subject, semester, marks, comment FROM grades WHERE student_id=? AND subject=?", (0, "")),
+    ("SELECT subject, semester, count, total FROM grade_totals WHERE student_id=?", (0,)),
+    ("SELECT id FROM students WHERE login=?", ("",)),
+    ("SELECT id, login FROM students WHERE login>(SELECT login FROM students WHERE id=?) ORDER BY login LIMIT ?", (0, 9)),
+    ("SELECT id, password, subject FROM teachers WHERE login=?", ("",)),
+    ("SELECT subject, semester, count, total FROM grade_totals WHERE subject=?", ("",)),
+    ("SELECT school_id FROM school_logins WHERE login=?", ("",)),
+    ("SELECT school_id FROM school_chats WHERE chat_id=?", (0,)),
+]
+
+def check_query_plans():
+    problems = []
+    for sql, params in HOT_QUERIES:
+        for row in db().execute("EXPLAIN QUERY PLAN " + sql, params):
+            detail = row[-1]
+            if detail.startswith("SCAN"):
+                problems.append(f"{sql} -> {detail}")
+    return problems
+
+def init_db():
+    # opening the catalog shard migrates it; on an up-to-date DB this is
+    # three reads and no write
+    use_school(CATALOG)
+    c = db(CATALOG)
+    if c.execute("SELECT 1 FROM schools WHERE id=?", (CATALOG,)).fetchone() is None:
+        with c:
+            c.execute(
+                "INSERT OR IGNORE INTO schools (id, name, path, created_at) VALUES (?, ?, NULL, ?)",
+                (CATALOG, "Школа №1", time.time())
+            )
+    if c.execute("SELECT 1 FROM admins LIMIT 1").fetchone() is None:
+        with c:
+            c.execute(
+                "INSERT INTO admins (login, password) SELECT 'admin', 'admin123' "
+                "WHERE NOT EXISTS (SELECT 1 FROM admins)"
+            )
+            c.execute("INSERT OR IGNORE INTO school_logins (login, school_id) VALUES ('admin', ?)", (CATALOG,))
+
+# ================== CACHE ==================
+# Size-bounded LRU caches in front of the hottest reads. Every write path in
+# QUERIES invalidates the entries it makes stale; a load that raced with an
+# invalidation is not stored. Keys are scoped to the current school, since ids
+# and logins of different shards overlap.
+REPORT_CACHE_SIZE = 5000
+TEACHER_VIEW_CACHE_SIZE = 5000
+STUDENT_CACHE_SIZE = 20000
+ANALYTICS_CACHE_SIZE = 64
+AUTH_CACHE_SIZE = 20000
+# a verified login is remembered this long, so re-logins skip the KDF
+AUTH_CACHE_TTL = 10 * 60
+
+_MISSING = object()
+
+class LRUCache:
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def get_or_load(self, key, loader):
+        key = (current_school(), key)
+        with self.lock:
+            value = self.data.get(key, _MISSING)
+            if value is not _MISSING:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+            generation = self.generation
+        value = loader()
+        with self.lock:
+            if generation == self.generation:
+                self.data[key] = value
+                if len(self.data) > self.maxsize:
+                    self.data.popitem(last=False)
+                    self.evictions += 1
+        return value
+
+    def get(self, key):
+        key = (current_school(), key)
+        with self.lock:
+            value = self.data.get(key)
+            if value is not None:
+                self.data.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return value
+
+    def put(self, key, value):
+        key = (current_school(), key)
+        with self.lock:
+            self.data[key] = value
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self.lock:
+            self.generation += 1
+            self.data.pop((current_school(), key), None)
+
+    def clear(self):
+        self.invalidate_where(lambda key, value: True)
+
+    def invalidate_where(self, predicate):
+        school_id = current_school()
+        with self.lock:
+            self.generation += 1
+            for key in [k for k, v in self.data.items() if k[0] == school_id and predicate(k[1], v)]:
+                del self.data[key]
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self.data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+report_cache = LRUCache("student_reports", REPORT_CACHE_SIZE)
+teacher_view_cache = LRUCache("teacher_views", TEACHER_VIEW_CACHE_SIZE)
+student_cache = LRUCache("student_logins", STUDENT_CACHE_SIZE)
+auth_cache = LRUCache("verified_logins", AUTH_CACHE_SIZE)
+analytics_cache = LRUCache("analytics", ANALYTICS_CACHE_SIZE)
+CACHES = (report_cache, teacher_view_cache, student_cache, auth_cache, analytics_cache)
+
+def invalidate_student(student_id):
+    report_cache.invalidate(student_id)
+    teacher_view_cache.invalidate_where(lambda key, _: key[0] == student_id)
+    student_cache.invalidate_where(lambda _, row: row is not None and row[0] == student_id)
+    analytics_cache.clear()
+
+# With several worker processes every process has its own caches. Writes then
+# also log what they made stale to cache_invalidations, in the same
+# transaction, and each process replays new rows before reading its caches.
+INVALIDATION_MAX_AGE = 24 * 3600
+
+_invalidations_lock = threading.Lock()
+# per school: last replayed id and when
+_invalidations_seen = {}
+_invalidations_synced = {}
+
+def publish_invalidations(c, student_ids=(), logins=()):
+    if WORKER_PROCESSES < 2:
+        return
+    now = time.time()
+    c.executemany(
+        "INSERT INTO cache_invalidations (student_id, login, created_at) VALUES (?, ?, ?)",
+        [(student_id, None, now) for student_id in student_ids] + [(None, login, now) for login in logins]
+    )
+
+def sync_caches():
+    if WORKER_PROCESSES < 2:
+        return
+    school_id = current_school()
+    with _invalidations_lock:
+        now = time.monotonic()
+        seen = _invalidations_seen.get(school_id)
+        if seen is None or now - _invalidations_synced[school_id] > INVALIDATION_MAX_AGE / 2:
+            # first call, or idle long enough for rows to have been purged
+            for cache in CACHES:
+                cache.clear()
+            seen = fetch_one("SELECT COALESCE(MAX(id), 0) FROM cache_invalidations")[0]
+        else:
+            for row_id, student_id, login in fetch_all(
+                "SELECT id, student_id, login FROM cache_invalidations WHERE id>? ORDER BY id", (seen,)
+            ):
+                if student_id is not None:
+                    invalidate_student(student_id)
+                if login is not None:
+                    student_cache.invalidate(login)
+                seen = row_id
+        _invalidations_seen[school_id] = seen
+        _invalidations_synced[school_id] = now
+
+# ================== CATALOG ==================
+# Which school a login or a chat belongs to. Logins are unique across all
+# schools, so the auth handlers know which shard to open from the login alone.
+# Catalog writes go through the catalog's writer; they are a separate commit
+# from the shard write they go with, so an account is claimed before it is
+# created (and the claim is released again if the create fails) and released
+# after it is deleted.
+def login_school(login):
+    row = db(CATALOG).execute("SELECT school_id FROM school_logins WHERE login=?", (login,)).fetchone()
+    return row[0] if row else None
+
+def school_of_chat(chat_id):
+    row = db(CATALOG).execute("SELECT school_id FROM school_chats WHERE chat_id=?", (chat_id,)).fetchone()
+    return row[0] if row else CATALOG
+
+def claim_logins(logins, school_id=None, batch=500):
+    # returns (logins claimed by this call, logins that belong to another school)
+    school_id = school_id or current_school()
+    logins = list(logins)
+
+    def write(c):
+        return {
+            login for login in logins
+            if c.execute("INSERT OR IGNORE INTO school_logins (login, school_id) VALUES (?, ?)", (login, school_id)).rowcount
+        }
+    claimed = writer(CATALOG).write(write)
+    taken = set()
+    c = db(CATALOG)
+    for i in range(0, len(logins), batch):
+        part = logins[i:i + batch]
+        taken.update(login for (login,) in c.execute(
+            f"SELECT login FROM school_logins WHERE school_id<>? AND login IN ({','.join('?' * len(part))})",
+            [school_id] + part
+        ))
+    return claimed, taken
+
+def login_elsewhere(login):
+    school_id = login_school(login)
+    return school_id is not None and school_id != current_school()
+
+def release_logins(logins, school_id=None):
+    school_id = school_id or current_school()
+    writer(CATALOG).write(lambda c: c.executemany(
+        "DELETE FROM school_logins WHERE login=? AND school_id=?", [(login, school_id) for login in logins]
+    ))
+
+def undo_claims(claimed, school_id=None):
+    # after a failed create; the create's own error is the one to report
+    try:
+        release_logins(claimed, school_id)
+    except Exception as e:
+        print(f"⚠️ Не удалось освободить логины {sorted(claimed)}: {e}")
+
+def assign_chat(chat_id, school_id):
+    # the users row (broadcast recipients) follows the chat to its school
+    row = db(CATALOG).execute("SELECT school_id FROM school_chats WHERE chat_id=?", (chat_id,)).fetchone()
+    if row is not None and row[0] == school_id:
+        return
+    previous = row[0] if row else CATALOG
+    writer(CATALOG).write(lambda c: c.execute(
+        "INSERT INTO school_chats (chat_id, school_id) VALUES (?, ?) "
+        "ON CONFLICT(chat_id) DO UPDATE SET school_id=excluded.school_id",
+        (chat_id, school_id)
+    ))
+    if previous != school_id:
+        writer(previous).submit(lambda c: c.execute("DELETE FROM users WHERE chat_id=?", (chat_id,)))
+    writer(school_id).submit(lambda c: c.execute("INSERT OR IGNORE INTO users (chat_id) VALUES (?)", (chat_id,)))
+
+def school_ids():
+    return [school_id for (school_id,) in db(CATALOG).execute("SELECT id FROM schools ORDER BY id")]
+
+def fetch_schools():
+    # (id, name, path, logins)
+    return db(CATALOG).execute(
+        "SELECT s.id, s.name, s.path, (SELECT COUNT(*) FROM school_logins l WHERE l.school_id = s.id) "
+        "FROM schools s ORDER BY s.id"
+    ).fetchall()
+
+def create_school(name):
+    # returns (school id, admin login, admin password)
+    def write(c):
+        school_id = c.execute(
+            "INSERT INTO schools (name, created_at) VALUES (?, ?)", (name, time.time())
+        ).lastrowid
+        c.execute("UPDATE schools SET path=? WHERE id=?", (f"schools/school_{school_id}.db", school_id))
+        return school_id
+    school_id = writer(CATALOG).write(write)
+    os.makedirs(os.path.dirname(shard_path(school_id)), exist_ok=True)
+    login, password = f"admin_{school_id}", gen_password()
+    claimed, taken = claim_logins([login], school_id)
+    if taken:
+        raise sqlite3.IntegrityError(f"Логин {login} уже занят")
+    try:
+        hashed = hash_password(password)
+        writer(school_id).write(lambda c: c.execute(
+            "INSERT INTO admins (login, password) VALUES (?, ?)", (login, hashed)
+        ))
+    except Exception:
+        undo_claims(claimed, school_id)
+        raise
+    return school_id, login, password
+
+# ================== QUERIES ==================
+def register_chat(chat_id):
+    # nothing reads users on the way back, so /start doesn't wait for the commit
+    writer().submit(lambda c: c.execute("INSERT OR IGNORE INTO users (chat_id) VALUES (?)", (chat_id,)))
+
+# The verified-login cache keeps an HMAC of the password under a per-process
+# key together with the stored hash it was checked against, so a password
+# change anywhere makes the entry useless.
+_auth_key = os.urandom(32)
+
+def authenticate(table, row, login, password):
+    # row starts with (id, stored password)
+    if row is None:
+        return False
+    row_id, stored = row[0], row[1]
+    token = hmac.new(_auth_key, password.encode(), "sha256").digest()
+    cached = auth_cache.get((table, login))
+    if cached and cached[0] == stored and cached[2] > time.monotonic() and hmac.compare_digest(cached[1], token):
+        return True
+    ok, needs_rehash = verify_password(password, stored)
+    if not ok:
+        return False
+    if needs_rehash:
+        stored = rehash_password(table, row_id, stored, password)
+    auth_cache.put((table, login), (stored, token, time.monotonic() + AUTH_CACHE_TTL))
+    return True
+
+def rehash_password(table, row_id, old, password):
+    new = hash_password(password)
+
+    def write(c):
+        # no-op if the password was changed meanwhile
+        c.execute(f"UPDATE {table} SET password=? WHERE id=? AND password=?", (new, row_id, old))
+        if table == "students":
+            publish_invalidations(c, student_ids=[row_id])
+    writer().write(write)
+    if table == "students":
+        invalidate_student(row_id)
+    return new
+
+def check_admin(login, password):
+    return authenticate("admins", fetch_one("SELECT id, password FROM admins WHERE login=?", (login,)), login, password)
+
+def check_teacher(login, password):
+    row = fetch_one("SELECT id, password, subject FROM teachers WHERE login=?", (login,))
+    return (row[0], row[2]) if authenticate("teachers", row, login, password) else None
+
+def student_by_login(login):
+    sync_caches()
+    return student_cache.get_or_load(login, lambda: fetch_one("SELECT id, password FROM students WHERE login=?", (login,)))
+
+def check_student(login, password):
+    row = student_by_login(login)
+    return row[0] if authenticate("students", row, login, password) else None
+
+def teacher_exists(login):
+    return fetch_one("SELECT 1 FROM teachers WHERE login=?", (login,)) is not None
+
+def student_id_by_login(login):
+    row = student_by_login(login)
+    return row[0] if row else None
+
+def profile_exists(login):
+    return student_id_by_login(login) is not None or teacher_exists(login)
+
+def insert_teacher(login, subject, password):
+    claimed, taken = claim_logins([login])
+    if taken:
+        raise sqlite3.IntegrityError(f"Логин {login} занят в другой школе")
+    try:
+        password = hash_password(password)
+        writer().write(lambda c: c.execute(
+            "INSERT INTO teachers (login, subject, password) VALUES (?, ?, ?)", (login, subject, password)
+        ))
+    except Exception:
+        undo_claims(claimed)
+        raise
+
+def insert_student(login, password):
+    claimed, taken = claim_logins([login])
+    if taken:
+        raise sqlite3.IntegrityError(f"Логин {login} занят в другой школе")
+    try:
+        hashed = hash_password(password)
+
+        def write(c):
+            c.execute("INSERT INTO students (login, password) VALUES (?, ?)", (login, hashed))
+            publish_invalidations(c, logins=[login])
+        writer().write(write)
+    except Exception:
+        undo_claims(claimed)
+        raise
+    student_cache.invalidate(login)
+
+ROSTER_INSERTS = {
+    "students": "INSERT INTO students (login, password) VALUES (?, ?)",
+    "teachers": "INSERT INTO teachers (login, subject, password) VALUES (?, ?, ?)",
+}
+
+def insert_roster(table, rows):
+    # rows start with the login and end with the plaintext password, which is
+    # hashed before the write lock is taken; existing logins are found with one
+    # set-based query through a temp table, inside the same write transaction;
+    # logins of other schools count as existing
+    claimed, elsewhere = claim_logins([row[0] for row in rows])
+    rows = [row for row in rows if row[0] not in elsewhere]
+    c = db()
+    try:
+        hashed = hash_passwords([row[-1] for row in rows])
+        accounts = {row[0]: row[:-1] + (password,) for row, password in zip(rows, hashed)}
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("CREATE TEMP TABLE IF NOT EXISTS import_logins(login TEXT PRIMARY KEY)")
+        c.execute("DELETE FROM import_logins")
+        c.executemany("INSERT OR IGNORE INTO import_logins (login) VALUES (?)", [(row[0],) for row in rows])
+        existing = {login for (login,) in c.execute(
+            f"SELECT login FROM import_logins WHERE login IN (SELECT login FROM {table})"
+        )}
+        created = [row for row in rows if row[0] not in existing]
+        c.executemany(ROSTER_INSERTS[table], [accounts[row[0]] for row in created])
+        c.execute("DELETE FROM import_logins")
+        if table == "students":
+            publish_invalidations(c, logins=[row[0] for row in created])
+        c.commit()
+    except Exception:
+        c.rollback()
+        undo_claims(claimed)
+        raise
+    if table == "students":
+        for row in created:
+            student_cache.invalidate(row[0])
+    return created, existing | elsewhere
+
+def update_student_password(student_id, password):
+    password = hash_password(password)
+
+    def write(c):
+        c.execute("UPDATE students SET password=? WHERE id=?", (password, student_id))
+        publish_invalidations(c, student_ids=[student_id])
+    writer().write(write)
+    invalidate_student(student_id)
+
+def delete_profile(login):
+    # grades go with the student via ON DELETE CASCADE
+    student_id = student_id_by_login(login)
+
+    def write(c):
+        c.execute("DELETE FROM students WHERE login=?", (login,))
+        c.execute("DELETE FROM teachers WHERE login=?", (login,))
+        publish_invalidations(c, student_ids=[student_id] if student_id is not None else [], logins=[login])
+    writer().write(write)
+    if fetch_one("SELECT 1 FROM admins WHERE login=?", (login,)) is None:
+        release_logins([login])
+    if student_id is not None:
+        delete_archived(student_id)
+        invalidate_student(student_id)
+    student_cache.invalidate(login)
+
+def iter_rows(sql, params=(), batch=500):
+    cur = db().execute(sql, params)
+    while True:
+        rows = cur.fetchmany(batch)
+        if not rows:
+            return
+        yield from rows
+
+def iter_teachers():
+    return iter_rows("SELECT login, subject FROM teachers ORDER BY login")
+
+def iter_student_logins():
+    return (login for (login,) in iter_rows("SELECT login FROM students ORDER BY login"))
+
+def student_login_by_id(student_id):
+    row = fetch_one("SELECT login FROM students WHERE id=?", (student_id,))
+    return row[0] if row else None
+
+# Keyset pagination over the UNIQUE(login) index: a page costs the same
+# whether it is the first one or the hundredth.
+def fetch_students_page(direction, cursor_id, limit):
+    if direction == "next":
+        return fetch_all(
+            "SELECT id, login FROM students WHERE login>(SELECT login FROM students WHERE id=?) ORDER BY login LIMIT ?",
+            (cursor_id, limit)
+        )
+    if direction == "prev":
+        return fetch_all(
+            "SELECT id, login FROM students WHERE login<(SELECT login FROM students WHERE id=?) ORDER BY login DESC LIMIT ?",
+            (cursor_id, limit)
+        )
+    return fetch_all("SELECT id, login FROM students ORDER BY login LIMIT ?", (limit,))
+
+def has_students_fts():
+    return fetch_one("SELECT 1 FROM sqlite_master WHERE name='students_fts'") is not None
+
+def search_students(query, limit):
+    if has_students_fts():
+        match = " ".join('"' + word.replace('"', '""') + '"*' for word in query.split())
+        return fetch_all(
+            "SELECT s.id, s.login FROM students_fts JOIN students s ON s.id = students_fts.rowid "
+            "WHERE students_fts MATCH ? ORDER BY rank LIMIT ?",
+            (match, limit)
+        )
+    return fetch_all(
+        "SELECT id, login FROM students WHERE login>=? AND login<? ORDER BY login LIMIT ?",
+        (query, query + "\U0010ffff", limit)
+    )
+
+# Marks are stored packed, one byte per mark: iterating the BLOB yields ints.
+def insert_grades(student_id, subject, semester, grades, comment):
+    def write(c):
+        c.execute(
+            "INSERT INTO grades (student_id, subject, semester, marks, comment) VALUES (?,?,?,?,?)",
+            (student_id, subject, semester, bytes(grades), comment)
+        )
+        c.execute(
+            "INSERT INTO grade_totals (student_id, subject, semester, count, total) VALUES (?,?,?,?,?) "
+            "ON CONFLICT(student_id, subject, semester) DO UPDATE "
+            "SET count = count + excluded.count, total = total + excluded.total",
+            (student_id, subject, semester, len(grades), sum(grades))
+        )
+        publish_invalidations(c, student_ids=[student_id])
+    writer().write(write)
+    report_cache.invalidate(student_id)
+    teacher_view_cache.invalidate((student_id, subject))
+    analytics_cache.clear()
+
+def fetch_grades(student_id, subject=None):
+    if subject is None:
+        return fetch_all("SELECT subject, semester, marks, comment FROM grades WHERE student_id=?", (student_id,))
+    return fetch_all(
+        "SELECT subject, semester, marks, comment FROM grades WHERE student_id=? AND subject=?", (student_id, subject)
+    )
+
+def student_ids_by_logins(logins, batch=500):
+    logins = list(logins)
+    ids = {}
+    for i in range(0, len(logins), batch):
+        part = logins[i:i + batch]
+        ids.update((login, student_id) for student_id, login in fetch_all(
+            f"SELECT id, login FROM students WHERE login IN ({','.join('?' * len(part))})", part
+        ))
+    return ids
+
+def insert_grades_bulk(subject, rows):
+    # rows: (student_id, semester, grades, comment); one transaction for the whole import
+    totals = {}
+    for student_id, semester, grades, _ in rows:
+        count, total = totals.get((student_id, semester), (0, 0))
+        totals[(student_id, semester)] = (count + len(grades), total + sum(grades))
+    with db() as c:
+        c.executemany(
+            "INSERT INTO grades (student_id, subject, semester, marks, comment) VALUES (?,?,?,?,?)",
+            [(student_id, subject, semester, bytes(grades), comment) for student_id, semester, grades, comment in rows]
+        )
+        c.executemany(
+            "INSERT INTO grade_totals (student_id, subject, semester, count, total) VALUES (?,?,?,?,?) "
+            "ON CONFLICT(student_id, subject, semester) DO UPDATE "
+            "SET count = count + excluded.count, total = total + excluded.total",
+            [(student_id, subject, semester, count, total) for (student_id, semester), (count, total) in totals.items()]
+        )
+        publish_invalidations(c, student_ids={student_id for student_id, _ in totals})
+    for student_id in {student_id for student_id, _ in totals}:
+        report_cache.invalidate(student_id)
+        teacher_view_cache.invalidate((student_id, subject))
+    analytics_cache.clear()
+
+def fetch_grade_totals(student_id):
+    return fetch_all("SELECT subject, semester, count, total FROM grade_totals WHERE student_id=?", (student_id,))
+
+# Class analytics are set-based aggregates over grade_totals (one row per
+# student, subject and semester), never a loop over students. The final mark
+# is computed in integer arithmetic: final_mark(average_percent(total, count))
+# is 2 while total / count < 2.7025, i.e. total * 400 < count * 1081, and so
+# on. It only differs at an exact tie, which takes 400+ marks in one semester.
+MARK_SQL = (
+    "CASE WHEN total * 400 < count * 1081 THEN 2 WHEN total * 400 < count * 1381 THEN 3 "
+    "WHEN total * 400 < count * 1681 THEN 4 ELSE 5 END"
+)
+
+def subject_filter(subject, alias=""):
+    return (f"AND {alias}subject=?", (subject,)) if subject is not None else ("", ())
+
+def fetch_class_summary(subject=None):
+    # (subject, semester, students, avg percent, marks 2, 3, 4, 5)
+    where, params = subject_filter(subject)
+    return fetch_all(
+        f"SELECT subject, semester, COUNT(*), ROUND(AVG(total * 20.0 / count), 1), "
+        f"SUM(mark = 2), SUM(mark = 3), SUM(mark = 4), SUM(mark = 5) "
+        f"FROM (SELECT subject, semester, count, total, {MARK_SQL} AS mark FROM grade_totals WHERE 1 {where}) "
+        f"GROUP BY subject, semester ORDER BY subject, semester",
+        params
+    )
+
+def fetch_semester_trends(subject=None):
+    # students graded in both semesters: (subject, students, avg 1, avg 2, improved, declined)
+    where, params = subject_filter(subject, "a.")
+    return fetch_all(
+        f"SELECT a.subject, COUNT(*), ROUND(AVG(a.total * 20.0 / a.count), 1), ROUND(AVG(b.total * 20.0 / b.count), 1), "
+        f"SUM(b.total * a.count > a.total * b.count), SUM(b.total * a.count < a.total * b.count) "
+        f"FROM grade_totals a JOIN grade_totals b "
+        f"ON b.student_id = a.student_id AND b.subject = a.subject AND b.semester = 2 "
+        f"WHERE a.semester = 1 {where} GROUP BY a.subject ORDER BY a.subject",
+        params
+    )
+
+def fetch_at_risk(subject=None, limit=30):
+    where, params = subject_filter(subject, "g.")
+    return fetch_all(
+        f"SELECT s.login, g.subject, g.semester, ROUND(g.total * 20.0 / g.count, 1) "
+        f"FROM grade_totals g JOIN students s ON s.id = g.student_id "
+        f"WHERE g.total * 400 < g.count * 1081 {where} ORDER BY g.total * 1.0 / g.count, s.login LIMIT ?",
+        params + (limit,)
+    )
+
+# Walks idx_grades_student_subject_semester, so the ORDER BY needs no sort
+# and rows can be streamed in batches.
+def iter_grade_export(subject=None):
+    where, params = ("WHERE g.subject=?", (subject,)) if subject is not None else ("", ())
+    return iter_rows(
+        "SELECT s.login, g.subject, g.semester, g.marks, g.comment, t.count, t.total FROM grades g "
+        "JOIN students s ON s.id = g.student_id "
+        "JOIN grade_totals t ON t.student_id = g.student_id AND t.subject = g.subject AND t.semester = g.semester "
+        f"{where} ORDER BY g.student_id, g.subject, g.semester",
+        params
+    )
+
+# sessions are per chat, not per school, and live in the catalog
+def load_session(chat_id):
+    row = db(CATALOG).execute("SELECT data FROM sessions WHERE chat_id=?", (chat_id,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+def save_sessions(items):
+    now = time.time()
+    with db(CATALOG) as c:
+        c.executemany(
+            "INSERT INTO sessions (chat_id, data, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(chat_id) DO UPDATE SET data=excluded.data, updated_at=excluded.updated_at",
+            [(chat_id, json.dumps(data, ensure_ascii=False), now) for chat_id, data in items if data]
+        )
+        c.executemany("DELETE FROM sessions WHERE chat_id=?", [(chat_id,) for chat_id, data in items if not data])
+
+def purge_sessions(older_than):
+    with db(CATALOG) as c:
+        c.execute("DELETE FROM sessions WHERE updated_at<?", (older_than,))
+
+def purge_invalidations(older_than):
+    for sh in open_shards():
+        with db(sh.school_id) as c:
+            c.execute("DELETE FROM cache_invalidations WHERE created_at<?", (older_than,))
+
+# ================== ACADEMIC YEARS ==================
+# grades and grade_totals only hold the open academic year. Rollover moves
+# the closed year into the school's archive DB (school_archive.db next to the
+# shard): one zlib-compressed JSON row per student and year, read back only
+# when somebody asks for history.
+#
+# The archive is built from a read snapshot while the bot keeps writing; the
+# shard's write lock is only taken at the end, to archive the few grades
+# added meanwhile and to delete the year. Archive rows are upserted by
+# (student, year) and only show up once the shard has marked that year
+# closed, so a rollover that died halfway shows nothing and is simply repeated.
+ARCHIVE_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS grade_archive(
+        student_id INTEGER,
+        year TEXT,
+        login TEXT NOT NULL,
+        data BLOB NOT NULL,
+        PRIMARY KEY (student_id, year)
+    )
+    """,
+)
+
+def academic_year_name(now=None):
+    # the year starts on September 1st
+    t = time.localtime(now)
+    start = t.tm_year if t.tm_mon >= 9 else t.tm_year - 1
+    return f"{start}/{start + 1}"
+
+def next_year_name(name):
+    try:
+        start, end = map(int, name.split("/"))
+        return f"{start + 1}/{end + 1}"
+    except ValueError:
+        return academic_year_name()
+
+def current_year():
+    row = fetch_one("SELECT name FROM academic_years WHERE closed_at IS NULL ORDER BY id DESC LIMIT 1")
+    return row[0] if row else academic_year_name()
+
+def archive_path(school_id=None):
+    return os.path.splitext(shard_path(school_id or current_school()))[0] + "_archive.db"
+
+def open_archive(create=False):
+    # cold storage: a short-lived connection per use, not pooled
+    path = archive_path()
+    if not create and not os.path.exists(path):
+        return None
+    a = open_connection(path)
+    for sql in ARCHIVE_SCHEMA:
+        a.execute(sql)
+    return a
+
+def pack_archive(rows):
+    return zlib.compress(json.dumps(
+        [[subj, sem, list(marks), comment] for subj, sem, marks, comment in rows], ensure_ascii=False
+    ).encode(), 9)
+
+def archive_students(c, where="", params=()):
+    # (student id, login, packed year, grade rows) per student, streamed
+    rows = c.execute(
+        "SELECT g.student_id, s.login, g.subject, g.semester, g.marks, g.comment FROM grades g "
+        f"JOIN students s ON s.id = g.student_id {where} ORDER BY g.student_id, g.subject, g.semester",
+        params
+    )
+    for (student_id, login), items in itertools.groupby(rows, key=lambda r: r[:2]):
+        items = [item[2:] for item in items]
+        yield student_id, login, pack_archive(items), len(items)
+
+def upsert_archive(a, year, students, counts):
+    # counts: student id -> (grade rows, packed bytes), filled as rows stream by
+    def rows():
+        for student_id, login, data, count in students:
+            counts[student_id] = (count, len(data))
+            yield student_id, year, login, data
+    with a:
+        a.executemany("INSERT OR REPLACE INTO grade_archive (student_id, year, login, data) VALUES (?, ?, ?, ?)", rows())
+
+def rollover_year(expected):
+    # returns (closed year, new year, students, grades, archived bytes), or
+    # None if `expected` is no longer the open year
+    c = open_connection(shard().path)
+    a = open_archive(create=True)
+    counts = {}
+    try:
+        # 1. the bulk of the archive, from a read snapshot: writers carry on
+        c.execute("BEGIN")
+        row = c.execute("SELECT name FROM academic_years WHERE closed_at IS NULL").fetchone()
+        if row is None or row[0] != expected:
+            c.rollback()
+            return None
+        # grades are insert-only with AUTOINCREMENT ids, so anything newer
+        # than this is what the final step has to pick up
+        snapshot_id = c.execute("SELECT COALESCE(MAX(id), 0) FROM grades").fetchone()[0]
+        upsert_archive(a, expected, archive_students(c), counts)
+        c.rollback()
+
+        # 2. under the write lock: late grades, then the switch to the new year
+        c.execute("BEGIN IMMEDIATE")
+        row = c.execute("SELECT id FROM academic_years WHERE closed_at IS NULL AND name=?", (expected,)).fetchone()
+        if row is None:
+            c.rollback()
+            return None
+        late = [student_id for (student_id,) in c.execute(
+            "SELECT DISTINCT student_id FROM grades WHERE id>?", (snapshot_id,)
+        )]
+        if late:
+            upsert_archive(a, expected, archive_students(
+                c, f"WHERE g.student_id IN ({','.join('?' * len(late))})", late
+            ), counts)
+        # students deleted while the archive was built
+        gone = set(counts) - {student_id for (student_id,) in c.execute("SELECT id FROM students")}
+        if gone:
+            with a:
+                a.executemany("DELETE FROM grade_archive WHERE student_id=? AND year=?", [(i, expected) for i in gone])
+            for student_id in gone:
+                del counts[student_id]
+        grades = sum(count for count, _ in counts.values())
+        now = time.time()
+        c.execute("DELETE FROM grades")
+        c.execute("DELETE FROM grade_totals")
+        c.execute("UPDATE academic_years SET closed_at=?, archived_grades=? WHERE id=?", (now, grades, row[0]))
+        new_name = next_year_name(expected)
+        c.execute("INSERT INTO academic_years (name, started_at) VALUES (?, ?)", (new_name, now))
+        publish_invalidations(c, student_ids=list(counts))
+        c.commit()
+    except Exception:
+        c.rollback()
+        raise
+    finally:
+        a.close()
+        c.close()
+    report_cache.clear()
+    teacher_view_cache.clear()
+    analytics_cache.clear()
+    return expected, new_name, len(counts), grades, sum(size for _, size in counts.values())
+
+def closed_years():
+    return {name for (name,) in fetch_all("SELECT name FROM academic_years WHERE closed_at IS NOT NULL")}
+
+def archived_years(student_id):
+    # only years the shard has closed; rows of an unfinished rollover stay hidden
+    a = open_archive()
+    if a is None:
+        return []
+    try:
+        years = [year for (year,) in a.execute("SELECT year FROM grade_archive WHERE student_id=? ORDER BY year", (student_id,))]
+    finally:
+        a.close()
+    closed = closed_years() if years else set()
+    return [year for year in years if year in closed]
+
+def archived_grades(student_id, year):
+    # rows shaped like fetch_grades(): (subject, semester, marks, comment)
+    a = open_archive()
+    if a is None:
+        return []
+    try:
+        row = a.execute("SELECT data FROM grade_archive WHERE student_id=? AND year=?", (student_id, year)).fetchone()
+    finally:
+        a.close()
+    if row is None:
+        return []
+    return [(subj, sem, bytes(marks), comment) for subj, sem, marks, comment in json.loads(zlib.decompress(row[0]))]
+
+def delete_archived(student_id):
+    a = open_archive()
+    if a is not None:
+        with a:
+            a.execute("DELETE FROM grade_archive WHERE student_id=?", (student_id,))
+        a.close()
+
+def fetch_year_summary():
+    # (open year, grades in it, closed years newest first as (name, students, grades))
+    closed = fetch_all(
+        "SELECT name, archived_grades FROM academic_years WHERE closed_at IS NOT NULL ORDER BY name DESC"
+    )
+    students = {}
+    a = open_archive() if closed else None
+    if a is not None:
+        try:
+            students = dict(a.execute("SELECT year, COUNT(*) FROM grade_archive GROUP BY year").fetchall())
+        finally:
+            a.close()
+    closed = [(name, students.get(name, 0), grades) for name, grades in closed]
+    return current_year(), fetch_one("SELECT COUNT(*) FROM grades")[0], closed
+
+# ================== BACKUP ==================
+# Online backups through SQLite's backup API, one file at a time: every
+# school's shard and archive. The copy has its own connection holding one
+# read transaction, so it is a consistent snapshot and never restarts while
+# the bot keeps writing (WAL); BACKUP_PAGES pages are copied per step with a
+# BACKUP_STEP_MS pause, so it never holds the disk for long. The copy must
+# pass PRAGMA integrity_check before it is gzipped into BACKUP_DIR; only the
+# newest BACKUP_KEEP snapshots of each file are kept. Runs are logged to the
+# catalog's backups table, so every process can report them.
+#
+# Only one run at a time across all processes: the scheduler lives in the
+# supervisor, but /backup now is handled by whichever worker got the update,
+# so a run holds an OS lock on BACKUP_DIR/.lock. The schedule follows the
+# file whose last good snapshot is oldest, so one shard that keeps failing
+# is retried (with exponential backoff) even while the others succeed.
+BACKUP_RETRY_SECONDS = 300
+
+def backup_dir():
+    return os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), BACKUP_DIR)
+
+def lock_backups():
+    # the lock goes away with the file, also when the process dies; None if
+    # another run holds it
+    os.makedirs(backup_dir(), exist_ok=True)
+    lock = open(os.path.join(backup_dir(), ".lock"), "a")
+    try:
+        if os.name == "nt":
+            import msvcrt
+            lock.seek(0)
+            msvcrt.locking(lock.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return None
+    return lock
+
+def backup_source(path):
+    # how a file is named in the backups table
+    return os.path.relpath(path, os.path.dirname(os.path.abspath(DB_PATH)))
+
+def backup_sources():
+    sources = []
+    for school_id in school_ids():
+        for path in (shard_path(school_id), archive_path(school_id)):
+            if os.path.exists(path):
+                sources.append(path)
+    return sources
+
+def backup_database(path):
+    # returns (snapshot file, pages, gzipped bytes)
+    name = os.path.splitext(os.path.basename(path))[0]
+    now = time.time()
+    stamp = time.strftime("%Y%m%d_%H%M%S", time.localtime(now)) + f"_{int(now * 1e6) % 1000000:06d}"
+    os.makedirs(backup_dir(), exist_ok=True)
+    copy = os.path.join(backup_dir(), f".{name}_{stamp}.db")
+    target = os.path.join(backup_dir(), f"{name}_{stamp}.db.gz")
+    pages = [0]
+
+    def progress(status, remaining, total):
+        pages[0] = total
+        time.sleep(BACKUP_STEP_MS / 1000)
+    src = sqlite3.connect(path, timeout=30)
+    dst = sqlite3.connect(copy)
+    try:
+        src.execute("BEGIN")
+        src.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone()
+        src.backup(dst, pages=BACKUP_PAGES, progress=progress)
+        src.rollback()
+        problems = [row[0] for row in dst.execute("PRAGMA integrity_check")]
+        if problems != ["ok"]:
+            raise sqlite3.DatabaseError("integrity_check: " + "; ".join(problems[:5]))
+        # a self-contained file, without -wal/-shm
+        dst.execute("PRAGMA journal_mode=DELETE")
+        dst.close()
+        with open(copy, "rb") as f, gzip.open(target + ".part", "wb", compresslevel=6) as out:
+            while chunk := f.read(1 << 20):
+                out.write(chunk)
+        os.replace(target + ".part", target)
+    finally:
+        src.close()
+        dst.close()
+        for leftover in (copy, copy + "-wal", copy + "-shm", copy + "-journal", target + ".part"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    rotate_backups(name)
+    return os.path.basename(target), pages[0], os.path.getsize(target)
+
+def rotate_backups(name):
+    # older snapshots have no microseconds and still sort first within their second
+    pattern = re.compile(re.escape(name) + r"_\d{8}_\d{6}(?:_\d{6})?\.db\.gz")
+    snapshots = sorted(f for f in os.listdir(backup_dir()) if pattern.fullmatch(f))
+    for old in snapshots[:-BACKUP_KEEP] if BACKUP_KEEP > 0 else []:
+        os.remove(os.path.join(backup_dir(), old))
+
+def run_backups():
+    # returns one (source, file, seconds, pages, bytes, error) per file, or
+    # None if a backup is already running in any process
+    lock = lock_backups()
+    if lock is None:
+        return None
+    results = []
+    try:
+        for path in backup_sources():
+            source = backup_source(path)
+            started_at = time.time()
+            start = time.monotonic()
+            try:
+                result = (source,) + backup_database(path) + (None,)
+            except Exception as e:
+                print(f"⚠️ Резервная копия {source} не создана: {e}")
+                backup_failures.inc((source,))
+                result = (source, None, 0, 0, str(e))
+            seconds = time.monotonic() - start
+            writer(CATALOG).write(lambda c: c.execute(
+                "INSERT INTO backups (source, file, started_at, seconds, pages, bytes, error) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (result[0], result[1], started_at, seconds, result[2], result[3], result[4])
+            ))
+            results.append((result[0], result[1], seconds) + result[2:])
+    finally:
+        # closing the file drops the lock
+        lock.close()
+    return results
+
+def last_backups():
+    # latest run per file: (source, file, started_at, seconds, pages, bytes, error)
+    return db(CATALOG).execute(
+        "SELECT source, file, MAX(started_at), seconds, pages, bytes, error FROM backups GROUP BY source ORDER BY source"
+    ).fetchall()
+
+def last_backup_success():
+    # the oldest of each file's latest good snapshot; 0 if a file never had one
+    done = dict(db(CATALOG).execute(
+        "SELECT source, MAX(started_at) FROM backups WHERE error IS NULL GROUP BY source"
+    ).fetchall())
+    return min((done.get(backup_source(path), 0) for path in backup_sources()), default=0)
+
+def next_backup_at():
+    return last_backup_success() + BACKUP_INTERVAL_HOURS * 3600
+
+def backup_loop():
+    # the schedule is kept in the catalog, so a restart doesn't back up again
+    failures = 0
+    retry_at = 0
+    while True:
+        try:
+            failed = False
+            if time.time() >= retry_at and time.time() >= next_backup_at():
+                results = run_backups()
+                failed = results is not None and any(result[5] for result in results)
+                if results is not None and not failed:
+                    failures = 0
+        except Exception as e:
+            print(f"⚠️ Ошибка планировщика резервных копий: {e}")
+            backup_failures.inc(("scheduler",))
+            failed = True
+        finally:
+            release_db()
+        if failed:
+            failures += 1
+            delay = min(BACKUP_RETRY_SECONDS * 2 ** (failures - 1), BACKUP_INTERVAL_HOURS * 3600)
+            retry_at = time.time() + delay
+            print(f"⚠️ Резервная копия не удалась ({failures} раз подряд), повтор через {delay / 60:.0f} мин")
+        time.sleep(60)
+
+def start_backups():
+    if BACKUP_INTERVAL_HOURS > 0:
+        threading.Thread(target=backup_loop, name="backups", daemon=True).start()
+
+# ================== STATE MANAGEMENT ==================
+# Sessions live in memory while a chat is active and are written behind to
+# the sessions table, so a restart does not log anyone out. Idle sessions are
+# dropped from memory after SESSION_TTL and from the table after
+# SESSION_MAX_AGE; anonymous sessions are never stored.
+SESSION_TTL = 30 * 60
+SESSION_MAX_AGE = 30 * 24 * 3600
+SESSION_FLUSH_INTERVAL = 2.0
+
+ROLE_FIELDS = ("role", "login", "subject", "student_id", "school")
+FLOW_FIELDS = (
+    "step", "teacher_name", "delete_target", "broadcast_content", "selected_student_id", "semester", "grades",
+    "rollover_year",
+)
+
+class Session:
+    __slots__ = ("chat_id", "touched") + ROLE_FIELDS + FLOW_FIELDS
+
+    def __init__(self, chat_id, data=None):
+        self.chat_id = chat_id
+        self.touched = time.monotonic()
+        for field in ROLE_FIELDS + FLOW_FIELDS:
+            setattr(self, field, None)
+        if data:
+            for field, value in data.items():
+                if field in ROLE_FIELDS or field in FLOW_FIELDS:
+                    setattr(self, field, value)
+
+    def reset_flow(self):
+        for field in FLOW_FIELDS:
+            setattr(self, field, None)
+
+    def logout(self):
+        for field in ROLE_FIELDS + FLOW_FIELDS:
+            setattr(self, field, None)
+
+    def to_dict(self):
+        data = {}
+        for field in ROLE_FIELDS + FLOW_FIELDS:
+            value = getattr(self, field)
+            if value is not None:
+                data[field] = value
+        return data
+
+class SessionStore:
+    def __init__(self):
+        self.sessions = {}
+        self.dirty = {}
+        self.lock = threading.Lock()
+        self.loaded = self.created = self.evicted = self.flushed = 0
+
+    def get(self, chat_id):
+        s = self.sessions.get(chat_id)
+        if s is None:
+            data = load_session(chat_id)
+            with self.lock:
+                s = self.sessions.get(chat_id)
+                if s is None:
+                    s = self.sessions[chat_id] = Session(chat_id, data)
+                    if data:
+                        self.loaded += 1
+                    else:
+                        self.created += 1
+        s.touched = time.monotonic()
+        return s
+
+    def mark_dirty(self, s):
+        with self.lock:
+            self.dirty[s.chat_id] = s
+
+    def flush(self):
+        with self.lock:
+            dirty, self.dirty = self.dirty, {}
+        if not dirty:
+            return
+        try:
+            save_sessions([(chat_id, s.to_dict()) for chat_id, s in dirty.items()])
+            self.flushed += len(dirty)
+        except Exception as e:
+            print(f"⚠️ Не удалось сохранить сессии: {e}")
+            with self.lock:
+                for chat_id, s in dirty.items():
+                    self.dirty.setdefault(chat_id, s)
+
+    def evict_idle(self):
+        deadline = time.monotonic() - SESSION_TTL
+        with self.lock:
+            idle = [chat_id for chat_id, s in self.sessions.items() if s.touched < deadline and chat_id not in self.dirty]
+            for chat_id in idle:
+                del self.sessions[chat_id]
+            self.evicted += len(idle)
+
+    def run(self):
+        last_purge = 0
+        while True:
+            time.sleep(SESSION_FLUSH_INTERVAL)
+            self.flush()
+            self.evict_idle()
+            if time.time() - last_purge > 3600:
+                purge_sessions(time.time() - SESSION_MAX_AGE)
+                purge_invalidations(time.time() - INVALIDATION_MAX_AGE)
+                last_purge = time.time()
+            release_db()
+
+    def start(self):
+        threading.Thread(target=self.run, name="sessions", daemon=True).start()
+        atexit.register(self.flush)
+
+    def stats(self):
+        with self.lock:
+            size = len(self.sessions)
+            return {
+                "active": size,
+                "dirty": len(self.dirty),
+                "bytes": sys.getsizeof(self.sessions) + size * sys.getsizeof(Session(0)),
+                "loaded": self.loaded,
+                "created": self.created,
+                "evicted": self.evicted,
+                "flushed": self.flushed,
+            }
+
+session_store = SessionStore()
+
+def get_state(chat_id):
+    return session_store.get(chat_id)
+
+def reset_step(chat_id):
+    get_state(chat_id).reset_flow()
+
+# ================== ROUTER ==================
+# Handlers are indexed by (step, text): a button press is one dict lookup,
+# a free-text answer inside a flow is another, regardless of handler count.
+commands = {}
+routes = {}
+callbacks = {}
+DOCUMENT = object()
+
+def route(text=None, step=None, command=None, document=False):
+    def decorator(fn):
+        if command:
+            commands[command] = fn
+        elif document:
+            routes[(step, DOCUMENT)] = fn
+        else:
+            routes[(step, text)] = fn
+        return fn
+    return decorator
+
+def callback_route(prefix):
+    def decorator(fn):
+        callbacks[prefix] = fn
+        return fn
+    return decorator
+
+def find_handler(m):
+    if m.content_type == "document":
+        return routes.get((get_state(m.chat.id).step, DOCUMENT))
+    text = m.text
+    words = text[1:].split(maxsplit=1) if text and text.startswith("/") else []
+    if words:
+        handler = commands.get(words[0].split("@")[0])
+        if handler:
+            return handler
+    step = get_state(m.chat.id).step
+    return routes.get((step, text)) or routes.get((None, text)) or routes.get((step, None))
+
+def enter_school(chat_id):
+    # handlers run against the shard of the school the chat is logged in to
+    s = get_state(chat_id)
+    use_school(s.school or school_of_chat(chat_id))
+
+def dispatch(m):
+    enter_school(m.chat.id)
+    handler = find_handler(m)
+    if handler:
+        try:
+            call_handler(handler, m)
+        finally:
+            session_store.mark_dirty(get_state(m.chat.id))
+
+def dispatch_callback(c):
+    enter_school(c.message.chat.id)
+    handler = callbacks.get(c.data.split(":", 1)[0])
+    try:
+        if handler:
+            call_handler(handler, c)
+    finally:
+        outbox.submit(c.message.chat.id, "answer_callback_query", c.id)
+        session_store.mark_dirty(get_state(c.message.chat.id))
+
+def run_in_background(name, target, *args):
+    # for jobs that take minutes: lanes are shared by chat id hash, so running
+    # them on the lane would stall every other chat that hashes to it
+    school_id = current_school()
+
+    def run():
+        use_school(school_id)
+        try:
+            target(*args)
+        except Exception as e:
+            print(f"⚠️ Ошибка фоновой задачи {name}: {e}")
+        finally:
+            release_db()
+    threading.Thread(target=run, name=name, daemon=True).start()
+
+# ================== UTILS ==================
+def gen_password():
+    return ''.join(random.choices(string.ascii_letters + string.digits, k=8))
+
+def percent(grades):
+    return average_percent(sum(grades), len(grades))
+
+def average_percent(total, count):
+    if not count:
+        return 0.0
+    return round(total / count / 5 * 100, 1)
+
+def format_marks(marks):
+    return ",".join(map(str, marks))
+
+def final_mark(p):
+    if p <= 54: return 2
+    if p <= 69: return 3
+    if p <= 84: return 4
+    return 5
+
+def validate_grades(text):
+    try:
+        grades = list(map(int, text.split(",")))
+        if all(2 <= g <= 5 for g in grades):
+            return grades
+    except:
+        pass
+    return None
+
+# ================== REPORTS ==================
+def render_progress(student_id):
+    totals = fetch_grade_totals(student_id)
+    if not totals:
+        return None
+    text = format_progress(f"📊 <b>Ваша успеваемость, {current_year()}:</b>\n\n", totals, fetch_grades(student_id))
+    return text + "🔽 Скопируйте, чтобы показать родителям."
+
+def format_progress(text, totals, grades):
+    marks = {}
+    comments = {}
+    for subj, sem, packed, c in grades:
+        key = (subj, sem)
+        marks.setdefault(key, []).append(packed)
+        comments.setdefault(key, []).append(c)
+    for subj, sem, count, total in totals:
+        p = average_percent(total, count)
+        comment_text = "; ".join(filter(lambda x: x != "—", comments[(subj, sem)])) or "—"
+        text += (
+            f"<b>{html.escape(subj)}</b> — {sem} сем.\n"
+            f"Оценки: <code>{format_marks(b''.join(marks[(subj, sem)]))}</code>\n"
+            f"Комментарий: {html.escape(comment_text)}\n"
+            f"Итог: <b>{final_mark(p)}</b>\n\n"
+        )
+    return text
+
+def render_history(student_id):
+    years = archived_years(student_id)
+    if not years:
+        return None
+    text = ""
+    for year in years:
+        grades = archived_grades(student_id, year)
+        totals = {}
+        for subj, sem, marks, _ in grades:
+            count, total = totals.get((subj, sem), (0, 0))
+            totals[(subj, sem)] = (count + len(marks), total + sum(marks))
+        text = format_progress(
+            text + f"🗂 <b>{year}</b>\n\n", [key + value for key, value in sorted(totals.items())], grades
+        )
+    return text
+
+def render_student_grades(student_id, student_name, subject):
+    rows = fetch_grades(student_id, subject)
+    if not rows:
+        return None
+    text = f"📊 <b>Оценки: {html.escape(student_name)}</b>\n\n"
+    for subj, sem, marks, comm in rows:
+        p = percent(marks)
+        text += (
+            f"• <b>{html.escape(subj)}</b> — {sem} сем.\n"
+            f"  Оценки: <code>{format_marks(marks)}</code>\n"
+            f"  Комментарий: {html.escape(comm)}\n"
+            f"  Итог: <b>{final_mark(p)}</b>\n\n"
+        )
+    return text
+
+def student_report(student_id):
+    sync_caches()
+    return report_cache.get_or_load(student_id, lambda: render_progress(student_id))
+
+def teacher_report(student_id, student_name, subject):
+    sync_caches()
+    return teacher_view_cache.get_or_load(
+        (student_id, subject), lambda: render_student_grades(student_id, student_name, subject)
+    )
+
+ANALYTICS_AT_RISK_LIMIT = 30
+
+def render_analytics(subject=None):
+    summary = fetch_class_summary(subject)
+    if not summary:
+        return None
+    title = html.escape(subject or "вся школа")
+    lines = [f"📊 <b>Аналитика: {title}</b>\n\n"]
+    for subj, sem, students, avg, m2, m3, m4, m5 in summary:
+        lines.append(
+            f"<b>{html.escape(subj)}</b> — {sem} сем.: {students} уч., ср. {avg}%\n"
+            f"итог: 5 — {m5} · 4 — {m4} · 3 — {m3} · 2 — {m2}\n"
+        )
+    trends = fetch_semester_trends(subject)
+    if trends:
+        lines.append("\n📈 <b>Динамика 1 → 2 сем.:</b>\n")
+        for subj, students, avg1, avg2, improved, declined in trends:
+            lines.append(
+                f"<b>{html.escape(subj)}</b>: {avg1}% → {avg2}% ({avg2 - avg1:+.1f}), "
+                f"улучшили {improved}, ухудшили {declined} из {students}\n"
+            )
+    at_risk = sum(row[4] for row in summary)
+    lines.append(f"\n⚠️ <b>В зоне риска (итог 2): {at_risk}</b>\n")
+    for login, subj, sem, pct in fetch_at_risk(subject, ANALYTICS_AT_RISK_LIMIT):
+        lines.append(f"• {html.escape(login)} — {html.escape(subj)}, {sem} сем., {pct}%\n")
+    if at_risk > ANALYTICS_AT_RISK_LIMIT:
+        lines.append(f"… и ещё {at_risk - ANALYTICS_AT_RISK_LIMIT}\n")
+    return "".join(lines)
+
+def class_analytics(subject=None):
+    sync_caches()
+    return analytics_cache.get_or_load(subject, lambda: render_analytics(subject))
+
+# ================== OUTBOX ==================
+# Every Bot API call made on behalf of a chat goes through one queue: lanes
+# keyed by chat id keep each chat's messages in order, a shared RateLimiter
+# keeps the bot under Telegram's global and per-chat limits, and a 429 waits
+# out its retry_after instead of reaching the handler. Handlers get a Future
+# back and normally don't wait for it. SEND_LANES=0 sends on the calling thread.
+SEND_RATE = 30                 # messages/sec for the whole bot
+SEND_CHAT_INTERVAL = 0.1       # seconds between two messages to the same chat
+SEND_MAX_ATTEMPTS = 5
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        # Telegram answered 429: drain the bucket so nobody sends for `seconds`
+        with self.lock:
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+class RateLimiter:
+    def __init__(self, rate, chat_interval):
+        self.bucket = TokenBucket(rate)
+        self.chat_interval = chat_interval
+        self.next_at = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, chat_id):
+        with self.lock:
+            now = time.monotonic()
+            at = max(now, self.next_at.get(chat_id, 0))
+            self.next_at[chat_id] = at + self.chat_interval
+            if len(self.next_at) > 10000:
+                self.next_at = {c: t for c, t in self.next_at.items() if t > now}
+        if at > now:
+            time.sleep(at - now)
+        self.bucket.acquire()
+
+class Outbox:
+    def __init__(self, lanes, depth):
+        self.queues = [queue.Queue(maxsize=depth) for _ in range(lanes)]
+        self.limiter = RateLimiter(SEND_RATE, SEND_CHAT_INTERVAL)
+        self.started = False
+        self.lock = threading.Lock()
+        self.sent = self.retried = self.failed = 0
+        self.waited = 0.0
+
+    def submit(self, chat_id, method, *args, **kwargs):
+        future = Future()
+        if not self.queues:
+            self.run(future, method, chat_id, args, kwargs)
+            return future
+        if not self.started:
+            self.start()
+        self.queues[hash(chat_id) % len(self.queues)].put((time.monotonic(), future, method, chat_id, args, kwargs))
+        return future
+
+    def work(self, lane):
+        q = self.queues[lane]
+        while True:
+            queued_at, future, method, chat_id, args, kwargs = q.get()
+            waited = time.monotonic() - queued_at
+            self.waited += waited
+            if METRICS:
+                send_queue_seconds.observe((method,), waited)
+            try:
+                self.run(future, method, chat_id, args, kwargs)
+            finally:
+                q.task_done()
+
+    def run(self, future, method, chat_id, args, kwargs):
+        attempts = 0
+        while True:
+            self.limiter.acquire(chat_id)
+            attempts += 1
+            try:
+                future.set_result(getattr(bot, method)(*args, **kwargs))
+                self.sent += 1
+                return
+            except ApiTelegramException as e:
+                if e.error_code == 429 and attempts < SEND_MAX_ATTEMPTS:
+                    # flood control is per bot: everyone waits, not just this chat
+                    self.limiter.bucket.pause(e.result_json.get("parameters", {}).get("retry_after", 1))
+                    self.retried += 1
+                    if METRICS:
+                        send_retries.inc((method,))
+                    continue
+                self.failed += 1
+                future.set_exception(e)
+                return
+            except Exception as e:
+                self.failed += 1
+                future.set_exception(e)
+                return
+
+    def start(self):
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+            for lane in range(len(self.queues)):
+                threading.Thread(target=self.work, args=(lane,), name=f"send-{lane}", daemon=True).start()
+
+    def join(self):
+        for q in self.queues:
+            q.join()
+
+    def stats(self):
+        done = self.sent + self.failed
+        return {
+            "lanes": len(self.queues),
+            "depth": sum(q.qsize() for q in self.queues),
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+            "avg_wait_ms": self.waited / done * 1000 if done and self.queues else 0.0,
+        }
+
+def log_send_error(chat_id, method, future):
+    e = future.exception()
+    if e is not None:
+        print(f"⚠️ {method} для {chat_id} не выполнен: {e}")
+
+def send(chat_id, text, **kwargs):
+    future = outbox.submit(chat_id, "send_message", chat_id, text, **kwargs)
+    future.add_done_callback(functools.partial(log_send_error, chat_id, "send_message"))
+    return future
+
+def send_document(chat_id, document, **kwargs):
+    future = outbox.submit(chat_id, "send_document", chat_id, document, **kwargs)
+    future.add_done_callback(functools.partial(log_send_error, chat_id, "send_document"))
+    return future
+
+# ================== LISTINGS ==================
+# Lists are rendered line by line from a lazy row iterator and cut into
+# message-sized chunks, so neither the rows nor the full text are ever held
+# in memory and nothing breaks past Telegram's 4096-character limit.
+MESSAGE_LIMIT = 4096
+
+def text_length(text):
+    # Telegram counts message length in UTF-16 code units
+    return len(text.encode("utf-16-le")) // 2
+
+def truncate_html(line, size):
+    # cut a line of markup to about `size` characters without breaking a tag
+    # or an entity, and close the tags the cut leaves open
+    cut = re.sub(r"<[^>]*$|&[#\w]*$", "", line[:size])
+    open_tags = []
+    for closing, tag in re.findall(r"<(/?)(\w+)[^>]*>", cut):
+        if not closing:
+            open_tags.append(tag)
+        elif tag in open_tags:
+            del open_tags[len(open_tags) - 1 - open_tags[::-1].index(tag):]
+    closing = "".join(f"</{tag}>" for tag in reversed(open_tags))
+    return cut + "…" + closing + ("\n" if line.endswith("\n") else "")
+
+def chunk_lines(lines, header="", footer="", limit=MESSAGE_LIMIT):
+    parts = [header]
+    size = text_length(header)
+    # the header goes out with the first line, never on its own
+    first = bool(header)
+    for line in itertools.chain(lines, [footer] if footer else []):
+        room = max(limit - size, 0) if first else limit
+        if text_length(line) > room:
+            line = truncate_html(line, room // 2)
+        length = text_length(line)
+        if size + length > limit and not first:
+            yield "".join(parts)
+            parts = []
+            size = 0
+        first = False
+        parts.append(line)
+        size += length
+    if size:
+        yield "".join(parts)
+
+def send_chunks(chat_id, chunks, reply_markup=None):
+    # the reply keyboard goes on the last chunk, so look one chunk ahead
+    sent = 0
+    previous = None
+    for chunk in chunks:
+        if previous is not None:
+            send(chat_id, previous, parse_mode="HTML")
+            sent += 1
+        previous = chunk
+    if previous is not None:
+        send(chat_id, previous, parse_mode="HTML", reply_markup=reply_markup)
+        sent += 1
+    return sent
+
+def send_listing(chat_id, lines, header="", footer="", empty_text="📭 Пусто.", reply_markup=None):
+    lines = iter(lines)
+    first = next(lines, None)
+    if first is None:
+        send(chat_id, empty_text, parse_mode="HTML", reply_markup=reply_markup)
+        return 0
+    return send_chunks(chat_id, chunk_lines(itertools.chain([first], lines), header, footer), reply_markup)
+
+def send_long(chat_id, text, reply_markup=None):
+    return send_chunks(chat_id, chunk_lines(text.splitlines(keepends=True)), reply_markup)
+
+# ================== BROADCAST ENGINE ==================
+BROADCAST_RATE = 25             # messages/sec, under Telegram's ~30/sec global limit
+BROADCAST_CHAT_INTERVAL = 1.0   # seconds between two messages to the same chat
+BROADCAST_WORKERS = 8
+BROADCAST_BATCH = 100
+BROADCAST_MAX_ATTEMPTS = 5
+
+limiter = RateLimiter(BROADCAST_RATE, BROADCAST_CHAT_INTERVAL)
+
+def deliver(chat_id, text):
+    # paced below SEND_RATE so replies still get through during a broadcast;
+    # 429s are already retried by the outbox
+    attempts = 0
+    while attempts < BROADCAST_MAX_ATTEMPTS:
+        limiter.acquire(chat_id)
+        attempts += 1
+        try:
+            outbox.submit(chat_id, "send_message", chat_id, text, parse_mode="HTML").result()
+            return "sent", attempts
+        except ApiTelegramException as e:
+            if e.error_code == 403 or "chat not found" in e.description:
+                return "dead", attempts
+            if e.error_code < 500 and e.error_code != 429:
+                return "failed", attempts
+        except Exception as e:
+            print(f"⚠️ Сетевая ошибка рассылки для {chat_id}: {e}")
+        time.sleep(min(2 ** attempts, 30))
+    return "failed", attempts
+
+def broadcast_counts(job_id):
+    rows = db().execute(
+        "SELECT status, COUNT(*) FROM broadcast_recipients WHERE broadcast_id=? GROUP BY status", (job_id,)
+    ).fetchall()
+    return dict(rows)
+
+def run_broadcast(school_id, job_id):
+    use_school(school_id)
+    c = db()
+    try:
+        admin_chat_id, text = c.execute("SELECT admin_chat_id, text FROM broadcasts WHERE id=?", (job_id,)).fetchone()
+        last = -2 ** 63
+        with ThreadPoolExecutor(BROADCAST_WORKERS) as pool:
+            while True:
+                rows = c.execute(
+                    "SELECT chat_id FROM broadcast_recipients "
+                    "WHERE broadcast_id=? AND chat_id>? AND status='pending' ORDER BY chat_id LIMIT ?",
+                    (job_id, last, BROADCAST_BATCH)
+                ).fetchall()
+                if not rows:
+                    break
+                chat_ids = [chat_id for (chat_id,) in rows]
+                results = list(pool.map(lambda chat_id: deliver(chat_id, text), chat_ids))
+                c.executemany(
+                    "UPDATE broadcast_recipients SET status=?, attempts=? WHERE broadcast_id=? AND chat_id=?",
+                    [(status, attempts, job_id, chat_id) for chat_id, (status, attempts) in zip(chat_ids, results)]
+                )
+                c.executemany(
+                    "DELETE FROM users WHERE chat_id=?",
+                    [(chat_id,) for chat_id, (status, _) in zip(chat_ids, results) if status == "dead"]
+                )
+                c.commit()
+                last = chat_ids[-1]
+        c.execute("UPDATE broadcasts SET status='done', finished_at=? WHERE id=?", (time.time(), job_id))
+        c.commit()
+        counts = broadcast_counts(job_id)
+        send(
+            admin_chat_id,
+            f"✅ <b>Рассылка #{job_id} завершена!</b>\n"
+            f"👥 Получателей: {sum(counts.values())}\n"
+            f"✅ Успешно: {counts.get('sent', 0)}\n"
+            f"🚫 Удалены (бот заблокирован): {counts.get('dead', 0)}\n"
+            f"❌ Ошибок: {counts.get('failed', 0)}",
+            parse_mode="HTML"
+        )
+    except Exception as e:
+        print(f"⚠️ Ошибка в рассылке #{job_id}: {e}")
+    finally:
+        release_db()
+
+def start_broadcast_job(job_id, school_id=None):
+    school_id = school_id or current_school()
+    threading.Thread(
+        target=run_broadcast, args=(school_id, job_id), name=f"broadcast-{school_id}-{job_id}", daemon=True
+    ).start()
+
+def create_broadcast(admin_chat_id, text):
+    with db() as c:
+        job_id = c.execute(
+            "INSERT INTO broadcasts (admin_chat_id, text, created_at) VALUES (?, ?, ?)",
+            (admin_chat_id, text, time.time())
+        ).lastrowid
+        total = c.execute(
+            "INSERT INTO broadcast_recipients (broadcast_id, chat_id) SELECT ?, chat_id FROM users", (job_id,)
+        ).rowcount
+    start_broadcast_job(job_id)
+    return job_id, total
+
+def resume_broadcasts():
+    for school_id in school_ids():
+        jobs = db(school_id).execute("SELECT id FROM broadcasts WHERE status='running'").fetchall()
+        for (job_id,) in jobs:
+            print(f"🔁 Продолжаю рассылку #{job_id} (школа #{school_id})")
+            start_broadcast_job(job_id, school_id)
+
+# ================== KEYBOARDS ==================
+# The menus never change, so each is built and serialized to JSON once;
+# telebot passes a str reply_markup to the API untouched.
+def static_markup(build):
+    payload = build().to_json()
+
+    @functools.wraps(build)
+    def markup():
+        return payload
+    return markup
+
+@static_markup
+def role_menu():
+    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    kb.add(BTN_ADMIN, BTN_TEACHER, BTN_STUDENT)
+    return kb
+
+@static_markup
+def admin_menu():
+    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    kb.add(BTN_ADD_TEACHER, BTN_LIST_TEACHERS)
+    kb.add(BTN_IMPORT_TEACHERS)
+    kb.add(BTN_BROADCAST, BTN_BROADCAST_STATUS)
+    kb.add(BTN_ANALYTICS, BTN_EXPORT_GRADES)
+    kb.add(BTN_ROLLOVER, BTN_DELETE_PROFILE)
+    kb.add(BTN_EXIT)
+    return kb
+
+@static_markup
+def teacher_menu():
+    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    kb.add(BTN_ADD_STUDENT, BTN_IMPORT_STUDENTS)
+    kb.add(BTN_ENTER_GRADES, BTN_VIEW_STUDENT_GRADES)
+    kb.add(BTN_LIST_STUDENTS, BTN_IMPORT_GRADES)
+    kb.add(BTN_ANALYTICS, BTN_EXPORT_GRADES)
+    kb.add(BTN_EXIT)
+    return kb
+
+@static_markup
+def student_menu():
+    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    kb.add(BTN_PROGRESS, BTN_HISTORY)
+    kb.add(BTN_CHANGE_PASSWORD)
+    kb.add(BTN_EXIT)
+    return kb
+
+@static_markup
+def cancel_button():
+    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    kb.add(BTN_CANCEL)
+    return kb
+
+@static_markup
+def export_format_menu():
+    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    kb.add(BTN_EXPORT_CSV, BTN_EXPORT_XLSX, BTN_EXPORT_GZIP)
+    kb.add(BTN_CANCEL)
+    return kb
+
+@static_markup
+def confirm_delete_button():
+    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    kb.add(BTN_CONFIRM_DELETE, BTN_CANCEL)
+    return kb
+
+@static_markup
+def confirm_rollover_menu():
+    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    kb.add(BTN_CONFIRM_ROLLOVER, BTN_CANCEL)
+    return kb
+
+@static_markup
+def confirm_broadcast_menu():
+    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    kb.add(BTN_SEND_ALL, BTN_CANCEL_BROADCAST)
+    return kb
+
+# ================== START & EXIT ==================
+@route(command="start")
+def start(m):
+    try:
+        register_chat(m.chat.id)
+        s = get_state(m.chat.id)
+        s.logout()
+        send(
+            m.chat.id,
+            "🎓 <b>Добро пожаловать в SchoolBot!</b>\n\n"
+            "Выберите свою роль:\n"
+            "👨‍🎓 <b>Ученик</b> — просмотр оценок\n"
+            "👨‍🏫 <b>Преподаватель</b> — ввод и управление\n"
+            "🛠 <b>Администратор</b> — настройка системы",
+            parse_mode="HTML",
+            reply_markup=role_menu()
+        )
+    except Exception as e:
+        print(f"⚠️ Ошибка в /start: {e}")
+        send(m.chat.id, "❌ Произошла ошибка. Попробуйте позже.")
+
+@route(command="cancel")
+def cmd_cancel(m):
+    cancel(m)
+
+@route(text=BTN_CANCEL)
+def cancel(m):
+    reset_step(m.chat.id)
+    s = get_state(m.chat.id)
+    if s.role == "admin":
+        send(m.chat.id, "↩️ Отменено. Вы в панели администратора.", reply_markup=admin_menu())
+    elif s.role == "teacher":
+        send(m.chat.id, "↩️ Отменено. Вы в меню преподавателя.", reply_markup=teacher_menu())
+    elif s.role == "student":
+        send(m.chat.id, "↩️ Отменено. Вы в личном кабинете.", reply_markup=student_menu())
+    else:
+        start(m)
+
+@route(text=BTN_EXIT)
+def exit_menu(m):
+    start(m)
+
+# ================== ADMIN AUTH ==================
+@route(text=BTN_ADMIN)
+def admin_login(m):
+    s = get_state(m.chat.id)
+    s.role = None
+    s.step = "admin_login"
+    send(m.chat.id, "🔐 Введите логин администратора:", reply_markup=cancel_button())
+
+@route(step="admin_login")
+def admin_password(m):
+    s = get_state(m.chat.id)
+    s.login = m.text
+    s.step = "admin_password"
+    send(m.chat.id, "🔑 Введите пароль:", reply_markup=cancel_button())
+
+@route(step="admin_password")
+def admin_auth(m):
+    try:
+        s = get_state(m.chat.id)
+        school_id = login_school(s.login) or CATALOG
+        use_school(school_id)
+        if not check_admin(s.login, m.text):
+            send(m.chat.id, "❌ Неверные данные. Попробуйте снова.", reply_markup=role_menu())
+            reset_step(m.chat.id)
+            return
+        s.role = "admin"
+        s.school = school_id
+        assign_chat(m.chat.id, school_id)
+        reset_step(m.chat.id)
+        send(
+            m.chat.id,
+            "✅ <b>Вы вошли как администратор!</b>\n\nВыберите действие:",
+            parse_mode="HTML",
+            reply_markup=admin_menu()
+        )
+    except Exception as e:
+        print(f"⚠️ Ошибка в admin_auth: {e}")
+        send(m.chat.id, "❌ Внутренняя ошибка. Обратитесь к разработчику.")
+
+# ================== ADD TEACHER (ADMIN) ==================
+@route(text=BTN_ADD_TEACHER)
+def add_teacher(m):
+    s = get_state(m.chat.id)
+    if s.role != "admin":
+        send(m.chat.id, "❌ Только для администраторов.", reply_markup=role_menu())
+        return
+    reset_step(m.chat.id)
+    s.step = "teacher_name"
+    send(m.chat.id, "👤 Введите ФИО преподавателя (уникальное):", reply_markup=cancel_button())
+
+@route(step="teacher_name")
+def teacher_enter_subject(m):
+    name = m.text.strip()
+    if not name:
+        send(m.chat.id, "❌ ФИО не может быть пустым.", reply_markup=cancel_button())
+        return
+    if teacher_exists(name):
+        send(m.chat.id, "❌ Преподаватель с таким ФИО уже существует!", reply_markup=admin_menu())
+        reset_step(m.chat.id)
+        return
+    if login_elsewhere(name):
+        send(m.chat.id, "❌ Это ФИО уже занято в другой школе, добавьте уточнение.", reply_markup=cancel_button())
+        return
+    s = get_state(m.chat.id)
+    s.teacher_name = name
+    s.step = "teacher_subject"
+    send(m.chat.id, "📚 Введите предмет:", reply_markup=cancel_button())
+
+@route(step="teacher_subject")
+def save_teacher(m):
+    subject = m.text.strip()
+    if not subject:
+        send(m.chat.id, "❌ Предмет не может быть пустым.", reply_markup=cancel_button())
+        return
+    s = get_state(m.chat.id)
+    name = s.teacher_name
+    password = gen_password()
+    try:
+        insert_teacher(name, subject, password)
+    except sqlite3.IntegrityError:
+        # taken meanwhile, here or in another school
+        send(m.chat.id, "❌ Это ФИО уже занято, добавьте уточнение.", reply_markup=admin_menu())
+        reset_step(m.chat.id)
+        return
+    reset_step(m.chat.id)
+    send(
+        m.chat.id,
+        f"✅ <b>Преподаватель добавлен!</b>\n"
+        f"👤 ФИО: <b>{name}</b>\n"
+        f"📚 Предмет: <b>{subject}</b>\n"
+        f"🔑 Пароль: <code>{password}</code>\n\n"
+        f"❗ Перешлите пароль — он не сохраняется!",
+        parse_mode="HTML",
+        reply_markup=admin_menu()
+    )
+
+# ================== LIST TEACHERS (ADMIN) ==================
+@route(text=BTN_LIST_TEACHERS)
+def list_teachers(m):
+    s = get_state(m.chat.id)
+    if s.role != "admin":
+        send(m.chat.id, "❌ Только для администраторов.", reply_markup=role_menu())
+        return
+    reset_step(m.chat.id)
+    send_listing(
+        m.chat.id,
+        (f"• <b>{html.escape(name)}</b> — {html.escape(subject)}\n" for name, subject in iter_teachers()),
+        header="📋 <b>Список преподавателей:</b>\n\n",
+        empty_text="📭 Нет преподавателей.",
+        reply_markup=admin_menu()
+    )
+
+# ================== BROADCAST (ADMIN) ==================
+@route(text=BTN_BROADCAST)
+def broadcast_start(m):
+    s = get_state(m.chat.id)
+    if s.role != "admin":
+        send(m.chat.id, "❌ Только админ может делать рассылку.", reply_markup=role_menu())
+        return
+    reset_step(m.chat.id)
+    s.step = "broadcast_text"
+    send(m.chat.id, "📬 Введите текст рассылки (можно с HTML):", reply_markup=cancel_button())
+
+@route(step="broadcast_text")
+def broadcast_preview(m):
+    s = get_state(m.chat.id)
+    message_text = m.text.strip()
+    if not message_text:
+        send(m.chat.id, "❌ Текст не может быть пустым.", reply_markup=cancel_button())
+        return
+    s.broadcast_content = message_text
+    send(m.chat.id, "📤 <b>Предпросмотр:</b>", parse_mode="HTML")
+    try:
+        # waits for the API: a malformed HTML message is rejected there
+        send(m.chat.id, message_text, parse_mode="HTML").result()
+    except:
+        send(m.chat.id, "⚠️ Ошибка HTML. Отправляю как обычный текст.")
+        send(m.chat.id, message_text)
+    s.step = "confirm_broadcast"
+    send(m.chat.id, "❓ Отправить всем пользователям?", reply_markup=confirm_broadcast_menu())
+
+@route(step="confirm_broadcast", text=BTN_SEND_ALL)
+def broadcast_confirmed(m):
+    s = get_state(m.chat.id)
+    job_id, total = create_broadcast(m.chat.id, s.broadcast_content)
+    reset_step(m.chat.id)
+    send(
+        m.chat.id,
+        f"🚀 <b>Рассылка #{job_id} запущена!</b>\n"
+        f"👥 Получателей: {total}\n"
+        f"Прогресс — кнопка «{BTN_BROADCAST_STATUS}».",
+        parse_mode="HTML",
+        reply_markup=admin_menu()
+    )
+
+@route(step="confirm_broadcast", text=BTN_CANCEL_BROADCAST)
+def broadcast_cancelled(m):
+    reset_step(m.chat.id)
+    send(m.chat.id, "📨 Рассылка отменена.", reply_markup=admin_menu())
+
+@route(text=BTN_BROADCAST_STATUS)
+def broadcast_status(m):
+    s = get_state(m.chat.id)
+    if s.role != "admin":
+        send(m.chat.id, "❌ Только для администраторов.", reply_markup=role_menu())
+        return
+    jobs = fetch_all("SELECT id, status, created_at, finished_at FROM broadcasts ORDER BY id DESC LIMIT 3")
+    if not jobs:
+        send(m.chat.id, "📭 Рассылок ещё не было.", reply_markup=admin_menu())
+        return
+    text = "📈 <b>Последние рассылки:</b>\n\n"
+    for job_id, status, created_at, finished_at in jobs:
+        counts = broadcast_counts(job_id)
+        total = sum(counts.values())
+        done = total - counts.get("pending", 0)
+        elapsed = (finished_at or time.time()) - created_at
+        text += (
+            f"<b>#{job_id}</b> — {'✅ завершена' if status == 'done' else '⏳ идёт'}\n"
+            f"Обработано: {done}/{total} ({done / elapsed if elapsed else 0:.1f}/сек)\n"
+            f"✅ {counts.get('sent', 0)} · 🚫 {counts.get('dead', 0)} · ❌ {counts.get('failed', 0)}\n\n"
+        )
+    send(m.chat.id, text, parse_mode="HTML", reply_markup=admin_menu())
+
+# ================== STATS (ADMIN) ==================
+@route(command="stats")
+def admin_stats(m):
+    s = get_state(m.chat.id)
+    if s.role != "admin":
+        send(m.chat.id, "❌ Только для администраторов.", reply_markup=role_menu())
+        return
+    st = session_store.stats()
+    text = (
+        f"👥 <b>Сессии:</b> {st['active']} в памяти (~{st['bytes'] // 1024} КБ), {st['dirty']} ждут записи\n"
+        f"загружено {st['loaded']}, создано {st['created']}, вытеснено {st['evicted']}, записано {st['flushed']}\n\n"
+    )
+    st = executor.stats()
+    text += (
+        f"🧵 <b>Очередь:</b> {st['depth']} в {st['lanes']} дорожках (макс. {st['max_depth']}, перекос {st['depth_skew']:.1f})\n"
+        f"обработано {st['processed']} (перекос {st['processed_skew']:.2f}), ожидание {st['avg_wait_ms']:.1f} мс, отклонено {st['rejected']}\n\n"
+    )
+    shards = open_shards()
+    writes = sum(sh.writer.writes for sh in shards)
+    commits = sum(sh.writer.commits for sh in shards)
+    text += (
+        f"✍️ <b>Запись:</b> {writes} операций в {commits} коммитах "
+        f"(в среднем {writes / commits if commits else 0:.1f}), в очереди {sum(sh.writer.queue.qsize() for sh in shards)}\n"
+        f"открыто школ: {len(shards)} из {MAX_OPEN_SHARDS}\n\n"
+    )
+    st = outbox.stats()
+    text += (
+        f"📤 <b>Отправка:</b> {st['depth']} в очереди ({st['lanes']} дорожек), ожидание {st['avg_wait_ms']:.1f} мс\n"
+        f"отправлено {st['sent']}, повторов после 429: {st['retried']}, ошибок {st['failed']}\n\n"
+    )
+    text += "📊 <b>Кэш:</b>\n\n"
+    for cache in CACHES:
+        st = cache.stats()
+        text += (
+            f"<b>{cache.name}</b>: {st['size']}/{cache.maxsize}\n"
+            f"попаданий {st['hits']}, промахов {st['misses']} ({st['hit_rate']:.0%}), вытеснено {st['evictions']}\n\n"
+        )
+    if METRICS:
+        text += "⏱ <b>Обработчики</b> (по суммарному времени):\n"
+        text += "".join(metric_line(key[0], st) + "\n" for key, st in top_series(handler_seconds, 8)) + "\n"
+        text += "🗄 <b>Запросы:</b>\n"
+        text += "".join(metric_line(key[0][:80], st) + "\n" for key, st in top_series(query_seconds, 8)) + "\n"
+        errors = {}
+        with api_errors.lock:
+            for (method, _), count in api_errors.series.items():
+                errors[method] = errors.get(method, 0) + count
+        text += "📡 <b>Telegram API:</b>\n"
+        text += "".join(
+            metric_line(key[0], st) + f", ошибок {errors.get(key[0], 0)}\n" for key, st in top_series(api_seconds, 8)
+        )
+    send_long(m.chat.id, text, reply_markup=admin_menu())
+
+def top_series(family, limit):
+    with family.lock:
+        rows = [(key, (h.count, h.sum, h.quantile(0.95))) for key, h in family.series.items()]
+    return sorted(rows, key=lambda row: row[1][1], reverse=True)[:limit]
+
+def metric_line(name, st):
+    count, total, p95 = st
+    return f"<code>{html.escape(name)}</code>: {count}, ср. {total / count * 1000:.1f} мс, p95 ≤ {p95 * 1000:.0f} мс"
+
+# ================== DELETE PROFILE (ADMIN) ==================
+@route(text=BTN_DELETE_PROFILE)
+def admin_delete(m):
+    s = get_state(m.chat.id)
+    if s.role != "admin":
+        send(m.chat.id, "❌ Только для администраторов.", reply_markup=role_menu())
+        return
+    reset_step(m.chat.id)
+    s.step = "delete_login"
+    send(m.chat.id, "🗑 Введите ФИО для удаления:", reply_markup=cancel_button())
+
+@route(step="delete_login")
+def admin_delete_confirm(m):
+    login = m.text.strip()
+    if not login:
+        send(m.chat.id, "❌ ФИО не может быть пустым.", reply_markup=cancel_button())
+        return
+    if not profile_exists(login):
+        send(m.chat.id, "⚠️ Пользователь не найден.", reply_markup=admin_menu())
+        reset_step(m.chat.id)
+        return
+    s = get_state(m.chat.id)
+    s.delete_target = login
+    s.step = "confirm_delete"
+    send(
+        m.chat.id,
+        f"❓ Удалить <b>{login}</b>?\n❗ Все данные будут потеряны!",
+        parse_mode="HTML",
+        reply_markup=confirm_delete_button()
+    )
+
+@route(step="confirm_delete", text=BTN_CONFIRM_DELETE)
+def delete_confirmed(m):
+    login = get_state(m.chat.id).delete_target
+    delete_profile(login)
+    reset_step(m.chat.id)
+    send(m.chat.id, f"✅ Пользователь <b>{login}</b> удалён.", parse_mode="HTML", reply_markup=admin_menu())
+
+# ================== ACADEMIC YEAR (ADMIN) ==================
+@route(text=BTN_ROLLOVER)
+def rollover_start(m):
+    s = get_state(m.chat.id)
+    if s.role != "admin":
+        send(m.chat.id, "❌ Только для администраторов.", reply_markup=role_menu())
+        return
+    reset_step(m.chat.id)
+    year, grades, closed = fetch_year_summary()
+    text = f"📅 <b>Текущий учебный год: {year}</b>\nЗаписей с оценками: {grades}\n\n"
+    if closed:
+        text += "🗂 <b>В архиве:</b>\n" + "".join(
+            f"{name}: {students} уч., {count} записей\n" for name, students, count in closed
+        ) + "\n"
+    text += (
+        f"❓ Закрыть {year} и начать {next_year_name(year)}?\n"
+        "Оценки уйдут в архив, ученики увидят их в разделе «Прошлые годы»."
+    )
+    s.rollover_year = year
+    s.step = "confirm_rollover"
+    send(m.chat.id, text, parse_mode="HTML", reply_markup=confirm_rollover_menu())
+
+@route(step="confirm_rollover", text=BTN_CONFIRM_ROLLOVER)
+def rollover_confirmed(m):
+    s = get_state(m.chat.id)
+    expected = s.rollover_year
+    reset_step(m.chat.id)
+    send(m.chat.id, "⏳ Переношу оценки в архив...")
+    run_in_background("rollover", rollover_and_report, m.chat.id, expected)
+
+def rollover_and_report(chat_id, expected):
+    start = time.monotonic()
+    try:
+        result = rollover_year(expected)
+    except Exception as e:
+        print(f"⚠️ Ошибка при закрытии года {expected}: {e}")
+        send(chat_id, "❌ Не удалось закрыть год, оценки не тронуты.", reply_markup=admin_menu())
+        return
+    if result is None:
+        send(chat_id, f"⚠️ Год {expected} уже закрыт.", reply_markup=admin_menu())
+        return
+    closed, opened, students, grades, size = result
+    send(
+        chat_id,
+        f"✅ <b>Учебный год {closed} закрыт.</b>\n"
+        f"🗂 В архив: {grades} записей, {students} уч. ({size / 1024:.1f} КБ сжато) "
+        f"за {time.monotonic() - start:.1f} с\n"
+        f"📅 Начат {opened}.",
+        parse_mode="HTML",
+        reply_markup=admin_menu()
+    )
+
+# ================== SCHOOLS (ADMIN) ==================
+# Only administrators of the first school manage the district.
+def district_admin(m):
+    s = get_state(m.chat.id)
+    if s.role != "admin" or current_school() != CATALOG:
+        send(m.chat.id, "❌ Только для администраторов первой школы.", reply_markup=role_menu())
+        return False
+    return True
+
+@route(command="schools")
+def list_schools(m):
+    if not district_admin(m):
+        return
+    text = "🏫 <b>Школы:</b>\n\n"
+    for school_id, name, _, logins in fetch_schools():
+        path = shard_path(school_id)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        text += f"<b>#{school_id}</b> {html.escape(name)} — {logins} уч. записей, {size / 2 ** 20:.1f} МБ\n"
+    send(m.chat.id, text, parse_mode="HTML", reply_markup=admin_menu())
+
+@route(command="addschool")
+def add_school(m):
+    if not district_admin(m):
+        return
+    parts = m.text.split(maxsplit=1)
+    name = parts[1].strip() if len(parts) > 1 else ""
+    if not name:
+        send(m.chat.id, "✍️ Использование: /addschool Название школы", reply_markup=admin_menu())
+        return
+    try:
+        school_id, login, password = create_school(name)
+    except sqlite3.IntegrityError:
+        send(m.chat.id, "❌ Школа с таким названием уже есть.", reply_markup=admin_menu())
+        return
+    send(
+        m.chat.id,
+        f"✅ <b>Школа #{school_id} создана!</b>\n"
+        f"🏫 {html.escape(name)}\n"
+        f"👤 Логин администратора: <code>{login}</code>\n"
+        f"🔑 Пароль: <code>{password}</code>",
+        parse_mode="HTML",
+        reply_markup=admin_menu()
+    )
+
+# ================== BACKUP (ADMIN) ==================
+def backup_line(source, seconds, pages, size, error):
+    if error:
+        return f"❌ <code>{html.escape(source)}</code>: {html.escape(error)}\n"
+    return (
+        f"✅ <code>{html.escape(source)}</code>: {pages} стр. за {seconds:.1f} с "
+        f"({pages / seconds if seconds else 0:.0f} стр./с), {size / 2 ** 20:.1f} МБ\n"
+    )
+
+@route(command="backup")
+def backup_status(m):
+    if not district_admin(m):
+        return
+    if m.text.split()[1:2] == ["now"]:
+        send(m.chat.id, "⏳ Делаю резервную копию...", reply_markup=admin_menu())
+        threading.Thread(target=backup_and_report, args=(m.chat.id,), name="backup-now", daemon=True).start()
+        return
+    rows = last_backups()
+    if not rows:
+        text = "💾 Резервных копий ещё не было.\n"
+    else:
+        text = "💾 <b>Последние резервные копии:</b>\n\n"
+        for source, _, started_at, seconds, pages, size, error in rows:
+            text += time.strftime("%d.%m %H:%M ", time.localtime(started_at)) + backup_line(source, seconds, pages, size, error)
+    if BACKUP_INTERVAL_HOURS > 0:
+        text += f"\n🕒 Следующая: {time.strftime('%d.%m %H:%M', time.localtime(max(next_backup_at(), time.time())))}"
+    text += "\n▶️ /backup now — сделать сейчас"
+    send(m.chat.id, text, parse_mode="HTML", reply_markup=admin_menu())
+
+def backup_and_report(chat_id):
+    try:
+        start = time.monotonic()
+        results = run_backups()
+        if results is None:
+            send(chat_id, "⏳ Резервная копия уже делается.")
+            return
+        text = f"💾 <b>Резервная копия готова</b> за {time.monotonic() - start:.1f} с:\n\n"
+        text += "".join(backup_line(source, seconds, pages, size, error) for source, _, seconds, pages, size, error in results)
+        send(chat_id, text, parse_mode="HTML")
+    except Exception as e:
+        print(f"⚠️ Ошибка резервного копирования: {e}")
+        send(chat_id, "❌ Резервная копия не удалась.")
+    finally:
+        release_db()
+
+# ================== TEACHER AUTH ==================
+@route(text=BTN_TEACHER)
+def teacher_login(m):
+    s = get_state(m.chat.id)
+    s.role = None
+    s.step = "teacher_login"
+    send(m.chat.id, "👤 Введите ваше ФИО:", reply_markup=cancel_button())
+
+@route(step="teacher_login")
+def teacher_password(m):
+    s = get_state(m.chat.id)
+    s.login = m.text
+    s.step = "teacher_password"
+    send(m.chat.id, "🔑 Введите пароль:", reply_markup=cancel_button())
+
+@route(step="teacher_password")
+def teacher_auth(m):
+    s = get_state(m.chat.id)
+    school_id = login_school(s.login) or CATALOG
+    use_school(school_id)
+    row = check_teacher(s.login, m.text)
+    if not row:
+        send(m.chat.id, "❌ Неверные данные.", reply_markup=role_menu())
+        reset_step(m.chat.id)
+        return
+    s.role = "teacher"
+    s.subject = row[1]
+    s.school = school_id
+    assign_chat(m.chat.id, school_id)
+    s.step = None
+    send(
+        m.chat.id,
+        f"✅ <b>Добро пожаловать, {s.login}!</b>\n"
+        f"📚 Предмет: <b>{row[1]}</b>",
+        parse_mode="HTML",
+        reply_markup=teacher_menu()
+    )
+
+# ================== ADD STUDENT (TEACHER) ==================
+@route(text=BTN_ADD_STUDENT)
+def add_student(m):
+    s = get_state(m.chat.id)
+    if s.role != "teacher":
+        send(m.chat.id, "❌ Только для преподавателей.", reply_markup=role_menu())
+        return
+    reset_step(m.chat.id)
+    s.step = "student_name"
+    send(m.chat.id, "👤 Введите ФИО ученика (уникальное):", reply_markup=cancel_button())
+
+@route(step="student_name")
+def save_student(m):
+    name = m.text.strip()
+    if not name:
+        send(m.chat.id, "❌ ФИО не может быть пустым.", reply_markup=cancel_button())
+        return
+    if student_id_by_login(name) is not None:
+        send(m.chat.id, "❌ Ученик уже существует!", reply_markup=teacher_menu())
+        reset_step(m.chat.id)
+        return
+    if login_elsewhere(name):
+        send(m.chat.id, "❌ Это ФИО уже занято в другой школе, добавьте уточнение.", reply_markup=cancel_button())
+        return
+    password = gen_password()
+    try:
+        insert_student(name, password)
+    except sqlite3.IntegrityError:
+        # taken meanwhile, here or in another school
+        send(m.chat.id, "❌ Это ФИО уже занято, добавьте уточнение.", reply_markup=teacher_menu())
+        reset_step(m.chat.id)
+        return
+    reset_step(m.chat.id)
+    send(
+        m.chat.id,
+        f"✅ <b>Ученик добавлен!</b>\n"
+        f"👤 ФИО: <b>{name}</b>\n"
+        f"🔑 Пароль: <code>{password}</code>",
+        parse_mode="HTML",
+        reply_markup=teacher_menu()
+    )
+
+# ================== LIST STUDENTS (TEACHER) ==================
+@route(text=BTN_LIST_STUDENTS)
+def list_students(m):
+    s = get_state(m.chat.id)
+    if s.role != "teacher":
+        send(m.chat.id, "❌ Только для преподавателей.", reply_markup=role_menu())
+        return
+    reset_step(m.chat.id)
+    send_listing(
+        m.chat.id,
+        (f"• {html.escape(name)}\n" for name in iter_student_logins()),
+        header="📋 <b>Список учеников:</b>\n\n",
+        footer="\n💡 Используйте «✏️ Ввести оценки» или «🔍 Посмотреть оценки».",
+        empty_text="📭 Нет учеников.",
+        reply_markup=teacher_menu()
+    )
+
+# ================== STUDENT PICKER (TEACHER) ==================
+# Students are picked from an inline keyboard, one bounded page at a time;
+# typing text instead of pressing a button searches by ФИО.
+PICKER_PAGE_SIZE = 8
+PICKER_STEPS = ("choose_student", "view_choose_student")
+
+def students_page(direction=None, cursor_id=None):
+    rows = fetch_students_page(direction, cursor_id, PICKER_PAGE_SIZE + 1)
+    more = len(rows) > PICKER_PAGE_SIZE
+    rows = rows[:PICKER_PAGE_SIZE]
+    if direction == "prev":
+        rows.reverse()
+        return rows, more, True
+    return rows, direction == "next", more
+
+def picker_keyboard(rows, has_prev=False, has_next=False):
+    kb = types.InlineKeyboardMarkup()
+    for student_id, login in rows:
+        kb.add(types.InlineKeyboardButton(login, callback_data=f"pick:{student_id}"))
+    nav = []
+    if has_prev:
+        nav.append(types.InlineKeyboardButton("◀️", callback_data=f"page:prev:{rows[0][0]}"))
+    if has_next:
+        nav.append(types.InlineKeyboardButton("▶️", callback_data=f"page:next:{rows[-1][0]}"))
+    if nav:
+        kb.row(*nav)
+    kb.add(types.InlineKeyboardButton(BTN_CANCEL, callback_data="pick_cancel"))
+    return kb
+
+def send_student_picker(chat_id, prompt):
+    rows, has_prev, has_next = students_page()
+    if not rows:
+        send(chat_id, "📭 Нет учеников.", reply_markup=teacher_menu())
+        return False
+    send(
+        chat_id,
+        f"{prompt}\n🔎 Или введите начало ФИО для поиска.",
+        reply_markup=picker_keyboard(rows, has_prev, has_next)
+    )
+    return True
+
+@callback_route("page")
+def picker_page(c):
+    s = get_state(c.message.chat.id)
+    if s.role != "teacher" or s.step not in PICKER_STEPS:
+        send(c.message.chat.id, "⚠️ Этот список устарел. Откройте его заново из меню.")
+        return
+    _, direction, cursor_id = c.data.split(":")
+    rows, has_prev, has_next = students_page(direction, int(cursor_id))
+    if not rows:
+        rows, has_prev, has_next = students_page()
+    outbox.submit(
+        c.message.chat.id, "edit_message_reply_markup", c.message.chat.id, c.message.message_id,
+        reply_markup=picker_keyboard(rows, has_prev, has_next)
+    )
+
+@callback_route("pick")
+def picker_pick(c):
+    chat_id = c.message.chat.id
+    s = get_state(chat_id)
+    if s.role != "teacher" or s.step not in PICKER_STEPS:
+        send(chat_id, "⚠️ Этот список устарел. Откройте его заново из меню.")
+        return
+    student_id = int(c.data.split(":")[1])
+    login = student_login_by_id(student_id)
+    if login is None:
+        send(chat_id, "❌ Ученик не найден.", reply_markup=cancel_button())
+        return
+    student_chosen(chat_id, student_id, login)
+
+@callback_route("pick_cancel")
+def picker_cancel(c):
+    cancel(c.message)
+
+@route(step="choose_student")
+@route(step="view_choose_student")
+def choose_student(m):
+    query = m.text.strip()
+    student_id = student_id_by_login(query)
+    if student_id is not None:
+        student_chosen(m.chat.id, student_id, query)
+        return
+    rows = search_students(query, PICKER_PAGE_SIZE + 1) if query else []
+    if not rows:
+        send(m.chat.id, "❌ Ученик не найден. Попробуйте другой запрос.", reply_markup=cancel_button())
+        return
+    text = f"🔎 Найдено по «{query}»:"
+    if len(rows) > PICKER_PAGE_SIZE:
+        text += f"\nПоказаны первые {PICKER_PAGE_SIZE} — уточните запрос."
+    send(m.chat.id, text, reply_markup=picker_keyboard(rows[:PICKER_PAGE_SIZE]))
+
+def student_chosen(chat_id, student_id, login):
+    s = get_state(chat_id)
+    if s.step == "view_choose_student":
+        show_student_grades(chat_id, student_id, login)
+        return
+    s.selected_student_id = student_id
+    s.step = "semester"
+    send(chat_id, f"👤 <b>{html.escape(login)}</b>\n🔢 Семестр (1 или 2):", parse_mode="HTML", reply_markup=cancel_button())
+
+# ================== VIEW STUDENT GRADES (TEACHER) ==================
+@route(text=BTN_VIEW_STUDENT_GRADES)
+def view_student_grades_start(m):
+    s = get_state(m.chat.id)
+    if s.role != "teacher":
+        send(m.chat.id, "❌ Только для преподавателей.", reply_markup=role_menu())
+        return
+    reset_step(m.chat.id)
+    if send_student_picker(m.chat.id, "🔍 Выберите ученика:"):
+        s.step = "view_choose_student"
+
+def show_student_grades(chat_id, student_id, student_name):
+    s = get_state(chat_id)
+    text = teacher_report(student_id, student_name, s.subject)
+    reset_step(chat_id)
+    if text is None:
+        send(chat_id, f"📭 У <b>{html.escape(student_name)}</b> нет оценок по «{html.escape(s.subject)}».", parse_mode="HTML", reply_markup=teacher_menu())
+        return
+    send_long(chat_id, text, reply_markup=teacher_menu())
+
+# ================== ENTER GRADES (TEACHER) ==================
+@route(text=BTN_ENTER_GRADES)
+def start_grades(m):
+    s = get_state(m.chat.id)
+    if s.role != "teacher":
+        send(m.chat.id, "❌ Только для преподавателей.", reply_markup=role_menu())
+        return
+    reset_step(m.chat.id)
+    if send_student_picker(m.chat.id, "✏️ Выберите ученика:"):
+        s.step = "choose_student"
+
+@route(step="semester")
+def enter_semester(m):
+    if m.text not in ("1", "2"):
+        send(m.chat.id, "🔢 Введите 1 или 2.", reply_markup=cancel_button())
+        return
+    s = get_state(m.chat.id)
+    s.semester = int(m.text)
+    s.step = "grades"
+    send(m.chat.id, "🎯 Оценки через запятую (2–5):\nПример: <code>5,4,5</code>", reply_markup=cancel_button())
+
+@route(step="grades")
+def enter_grades(m):
+    grades = validate_grades(m.text)
+    if not grades:
+        send(m.chat.id, "❌ Оценки от 2 до 5 через запятую.", reply_markup=cancel_button())
+        return
+    s = get_state(m.chat.id)
+    s.grades = grades
+    s.step = "comment"
+    send(m.chat.id, "💬 Комментарий (можно пропустить):", reply_markup=cancel_button())
+
+@route(step="comment")
+def save_grades(m):
+    s = get_state(m.chat.id)
+    comment = m.text.strip() or "—"
+    insert_grades(s.selected_student_id, s.subject, s.semester, s.grades, comment)
+    reset_step(m.chat.id)
+    send(m.chat.id, "✅ Оценки сохранены!", reply_markup=teacher_menu())
+
+# ================== ANALYTICS (TEACHER & ADMIN) ==================
+@route(text=BTN_ANALYTICS)
+def analytics(m):
+    s = get_state(m.chat.id)
+    if s.role == "teacher":
+        subject, menu = s.subject, teacher_menu()
+    elif s.role == "admin":
+        subject, menu = None, admin_menu()
+    else:
+        send(m.chat.id, "❌ Только для преподавателей и администраторов.", reply_markup=role_menu())
+        return
+    reset_step(m.chat.id)
+    text = class_analytics(subject)
+    if not text:
+        send(m.chat.id, "📭 Оценок пока нет.", reply_markup=menu)
+        return
+    send_long(m.chat.id, text, reply_markup=menu)
+
+# ================== EXPORT GRADES ==================
+# Rows are streamed from the database into a temporary file on disk, so an
+# export takes the same memory whatever the size of the school. Teachers get
+# their subject, admins the whole school.
+EXPORT_FORMATS = {BTN_EXPORT_CSV: "csv", BTN_EXPORT_XLSX: "xlsx", BTN_EXPORT_GZIP: "csv.gz"}
+EXPORT_HEADER = ["ФИО", "Предмет", "Семестр", "Оценки", "Комментарий", "% за семестр", "Итог за семестр"]
+TELEGRAM_FILE_LIMIT = 50 * 1024 * 1024
+
+def export_rows(subject=None):
+    for login, subj, sem, marks, comment, count, total in iter_grade_export(subject):
+        p = average_percent(total, count)
+        yield login, subj, sem, format_marks(marks), comment, p, final_mark(p)
+
+def write_export(rows, fmt, out):
+    if fmt == "xlsx":
+        import openpyxl
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet("Оценки")
+        sheet.append(EXPORT_HEADER)
+        for row in rows:
+            sheet.append(row)
+        workbook.save(out)
+        return
+    binary = gzip.GzipFile(fileobj=out, mode="wb") if fmt == "csv.gz" else out
+    text = io.TextIOWrapper(binary, encoding="utf-8-sig", newline="")
+    writer = csv.writer(text, delimiter=";")
+    writer.writerow(EXPORT_HEADER)
+    writer.writerows(rows)
+    text.flush()
+    text.detach()
+    if binary is not out:
+        binary.close()
+
+@route(text=BTN_EXPORT_GRADES)
+def export_grades_start(m):
+    s = get_state(m.chat.id)
+    if s.role not in ("teacher", "admin"):
+        send(m.chat.id, "❌ Только для преподавателей и администраторов.", reply_markup=role_menu())
+        return
+    reset_step(m.chat.id)
+    s.step = "export_format"
+    send(
+        m.chat.id,
+        "📤 Выберите формат. Для больших выгрузок удобнее CSV (gzip).",
+        reply_markup=export_format_menu()
+    )
+
+@route(step="export_format")
+def export_grades(m):
+    s = get_state(m.chat.id)
+    fmt = EXPORT_FORMATS.get(m.text)
+    if fmt is None:
+        send(m.chat.id, "❌ Выберите формат кнопкой.", reply_markup=export_format_menu())
+        return
+    subject, menu = (s.subject, teacher_menu()) if s.role == "teacher" else (None, admin_menu())
+    reset_step(m.chat.id)
+    run_in_background("export", export_and_send, m.chat.id, subject, fmt, menu)
+
+def export_and_send(chat_id, subject, fmt, menu):
+    rows = export_rows(subject)
+    first = next(rows, None)
+    if first is None:
+        send(chat_id, "📭 Оценок пока нет.", reply_markup=menu)
+        return
+    send(chat_id, "⏳ Готовлю файл...")
+    with tempfile.TemporaryFile() as out:
+        try:
+            write_export(itertools.chain([first], rows), fmt, out)
+        except Exception as e:
+            print(f"⚠️ Ошибка экспорта: {e}")
+            send(chat_id, "❌ Не удалось подготовить файл.", reply_markup=menu)
+            return
+        size = out.tell()
+        if size > TELEGRAM_FILE_LIMIT:
+            send(chat_id, "❌ Файл больше 50 МБ. Попробуйте CSV (gzip).", reply_markup=menu)
+            return
+        out.seek(0)
+        send_document(
+            chat_id,
+            out,
+            visible_file_name=f"grades_{subject or 'school'}_{time.strftime('%Y%m%d_%H%M')}.{fmt}",
+            caption=f"📤 Оценки: {subject or 'вся школа'}",
+            reply_markup=menu
+        ).result()  # the temporary file is closed on leaving this block
+
+# ================== IMPORT GRADES (TEACHER) ==================
+# A whole class in one go: "ФИО;семестр;оценки;комментарий" per line, sent
+# as a CSV/XLSX document or pasted as text. Rows are parsed as a stream,
+# students are resolved in one batched lookup and everything valid is
+# written in a single transaction.
+IMPORT_GRADES_FORMAT = "<code>ФИО;семестр;оценки;комментарий</code>\nПример: <code>Иванов Иван;1;5,4,5;молодец</code>"
+
+def download_document(m):
+    return bot.download_file(bot.get_file(m.document.file_id).file_path)
+
+def iter_csv_rows(text_stream):
+    first = text_stream.readline()
+    delimiter = "\t" if "\t" in first and ";" not in first else ";"
+    return csv.reader(itertools.chain([first], text_stream), delimiter=delimiter)
+
+def iter_xlsx_rows(data):
+    import openpyxl
+    workbook = openpyxl.load_workbook(io.BytesIO(data), read_only=True)
+    try:
+        for row in workbook.active.iter_rows(values_only=True):
+            yield ["" if value is None else str(value) for value in row]
+    finally:
+        workbook.close()
+
+def decode_upload(data):
+    try:
+        return data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return data.decode("cp1251")
+
+def iter_upload_rows(m):
+    if m.content_type != "document":
+        return iter_csv_rows(io.StringIO(m.text))
+    data = download_document(m)
+    if (m.document.file_name or "").lower().endswith(".xlsx"):
+        return iter_xlsx_rows(data)
+    return iter_csv_rows(io.StringIO(decode_upload(data)))
+
+def parse_grade_rows(rows):
+    parsed, errors = [], []
+    for line_no, fields in enumerate(rows, start=1):
+        fields = [f.strip() for f in fields]
+        if not any(fields) or (line_no == 1 and fields[0].lower() == "фио"):
+            continue
+        if len(fields) < 3:
+            errors.append((line_no, "нужно минимум 3 поля"))
+            continue
+        name, semester, grades_text = fields[:3]
+        comment = fields[3] if len(fields) > 3 and fields[3] else "—"
+        if semester.endswith(".0"):
+            semester = semester[:-2]
+        if semester not in ("1", "2"):
+            errors.append((line_no, "семестр должен быть 1 или 2"))
+            continue
+        grades = validate_grades(grades_text.replace(" ", ""))
+        if not grades:
+            errors.append((line_no, "оценки от 2 до 5 через запятую"))
+            continue
+        parsed.append((line_no, name, int(semester), grades, comment))
+    return parsed, errors
+
+def import_grades(subject, rows):
+    parsed, errors = parse_grade_rows(rows)
+    ids = student_ids_by_logins({name for _, name, _, _, _ in parsed})
+    valid = []
+    for line_no, name, semester, grades, comment in parsed:
+        if name not in ids:
+            errors.append((line_no, f"ученик «{html.escape(name)}» не найден"))
+            continue
+        valid.append((ids[name], semester, grades, comment))
+    if valid:
+        insert_grades_bulk(subject, valid)
+    return valid, sorted(errors)
+
+@route(text=BTN_IMPORT_GRADES)
+def import_grades_start(m):
+    s = get_state(m.chat.id)
+    if s.role != "teacher":
+        send(m.chat.id, "❌ Только для преподавателей.", reply_markup=role_menu())
+        return
+    reset_step(m.chat.id)
+    s.step = "import_grades"
+    send(
+        m.chat.id,
+        f"📥 Отправьте файл CSV/XLSX или вставьте строки в формате:\n{IMPORT_GRADES_FORMAT}",
+        parse_mode="HTML",
+        reply_markup=cancel_button()
+    )
+
+@route(step="import_grades")
+@route(step="import_grades", document=True)
+def import_grades_upload(m):
+    s = get_state(m.chat.id)
+    try:
+        valid, errors = import_grades(s.subject, iter_upload_rows(m))
+    except Exception as e:
+        print(f"⚠️ Ошибка импорта оценок: {e}")
+        send(m.chat.id, "❌ Не удалось прочитать файл. Нужен CSV (;) или XLSX.", reply_markup=cancel_button())
+        return
+    reset_step(m.chat.id)
+    summary = (
+        f"✅ <b>Импортировано строк: {len(valid)}</b> "
+        f"(учеников: {len({student_id for student_id, _, _, _ in valid})})\n"
+        f"❌ Ошибок: {len(errors)}\n"
+    )
+    send_listing(
+        m.chat.id,
+        (f"• строка {line_no}: {error}\n" for line_no, error in errors),
+        header=summary + ("\n" if errors else ""),
+        empty_text=summary,
+        reply_markup=teacher_menu()
+    )
+
+# ================== IMPORT ROSTER ==================
+# Accounts for a whole school in one upload: admins import teachers
+# ("ФИО;предмет"), teachers import students ("ФИО"). Credentials come back as
+# a CSV document instead of one chat message per account.
+ROSTER_FORMATS = {
+    "teachers": "<code>ФИО;предмет</code>\nПример: <code>Петрова Анна;Физика</code>",
+    "students": "<code>ФИО</code> — по одному ученику в строке",
+}
+
+def parse_roster_rows(rows, with_subject):
+    parsed, errors, seen = [], [], set()
+    for line_no, fields in enumerate(rows, start=1):
+        fields = [f.strip() for f in fields]
+        if not any(fields) or (line_no == 1 and fields[0].lower() == "фио"):
+            continue
+        name = fields[0]
+        subject = fields[1] if len(fields) > 1 else ""
+        if not name:
+            errors.append((line_no, "ФИО не может быть пустым"))
+            continue
+        if with_subject and not subject:
+            errors.append((line_no, "не указан предмет"))
+            continue
+        if name in seen:
+            errors.append((line_no, f"«{html.escape(name)}» уже есть в файле"))
+            continue
+        seen.add(name)
+        parsed.append((line_no, name, subject))
+    return parsed, errors
+
+def import_roster(table, rows):
+    with_subject = table == "teachers"
+    parsed, errors = parse_roster_rows(rows, with_subject)
+    passwords = [gen_password() for _ in parsed]
+    if with_subject:
+        accounts = [(name, subject, password) for (_, name, subject), password in zip(parsed, passwords)]
+    else:
+        accounts = [(name, password) for (_, name, _), password in zip(parsed, passwords)]
+    created, existing = insert_roster(table, accounts) if accounts else ([], set())
+    errors.extend((line_no, f"«{html.escape(name)}» уже существует") for line_no, name, _ in parsed if name in existing)
+    return created, sorted(errors)
+
+def credentials_file(table, created):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=";")
+    writer.writerow(["ФИО", "предмет", "пароль"] if table == "teachers" else ["ФИО", "пароль"])
+    writer.writerows(created)
+    return io.BytesIO(buffer.getvalue().encode("utf-8-sig"))
+
+def start_roster_import(m, table, role, denied_text):
+    s = get_state(m.chat.id)
+    if s.role != role:
+        send(m.chat.id, denied_text, reply_markup=role_menu())
+        return
+    reset_step(m.chat.id)
+    s.step = f"import_{table}"
+    send(
+        m.chat.id,
+        f"📥 Отправьте файл CSV/XLSX или вставьте строки в формате:\n{ROSTER_FORMATS[table]}",
+        parse_mode="HTML",
+        reply_markup=cancel_button()
+    )
+
+def finish_roster_import(m, table, menu):
+    try:
+        created, errors = import_roster(table, iter_upload_rows(m))
+    except Exception as e:
+        print(f"⚠️ Ошибка импорта ({table}): {e}")
+        send(m.chat.id, "❌ Не удалось прочитать файл. Нужен CSV (;) или XLSX.", reply_markup=cancel_button())
+        return
+    reset_step(m.chat.id)
+    if created:
+        send_document(
+            m.chat.id,
+            credentials_file(table, created),
+            visible_file_name=f"{table}_{time.strftime('%Y%m%d_%H%M')}.csv",
+            caption="🔑 Логины и пароли. ❗ Пароли больше нигде не сохраняются!"
+        )
+    summary = f"✅ <b>Создано аккаунтов: {len(created)}</b>\n❌ Ошибок: {len(errors)}\n"
+    send_listing(
+        m.chat.id,
+        (f"• строка {line_no}: {error}\n" for line_no, error in errors),
+        header=summary + ("\n" if errors else ""),
+        empty_text=summary,
+        reply_markup=menu()
+    )
+
+@route(text=BTN_IMPORT_TEACHERS)
+def import_teachers_start(m):
+    start_roster_import(m, "teachers", "admin", "❌ Только для администраторов.")
+
+@route(step="import_teachers")
+@route(step="import_teachers", document=True)
+def import_teachers_upload(m):
+    finish_roster_import(m, "teachers", admin_menu)
+
+@route(text=BTN_IMPORT_STUDENTS)
+def import_students_start(m):
+    start_roster_import(m, "students", "teacher", "❌ Только для преподавателей.")
+
+@route(step="import_students")
+@route(step="import_students", document=True)
+def import_students_upload(m):
+    finish_roster_import(m, "students", teacher_menu)
+
+# ================== STUDENT AUTH ==================
+@route(text=BTN_STUDENT)
+def student_login(m):
+    s = get_state(m.chat.id)
+    s.role = None
+    s.step = "student_login"
+    send(m.chat.id, "👤 Введите ваше ФИО:", reply_markup=cancel_button())
+
+@route(step="student_login")
+def student_password(m):
+    s = get_state(m.chat.id)
+    s.login = m.text
+    s.step = "student_password"
+    send(m.chat.id, "🔑 Введите пароль:", reply_markup=cancel_button())
+
+@route(step="student_password")
+def student_auth(m):
+    s = get_state(m.chat.id)
+    school_id = login_school(s.login) or CATALOG
+    use_school(school_id)
+    student_id = check_student(s.login, m.text)
+    if student_id is None:
+        send(m.chat.id, "❌ Неверные данные.", reply_markup=role_menu())
+        reset_step(m.chat.id)
+        return
+    s.role = "student"
+    s.student_id = student_id
+    s.school = school_id
+    assign_chat(m.chat.id, school_id)
+    s.step = None
+    send(m.chat.id, f"✅ Добро пожаловать, <b>{s.login}</b>!", parse_mode="HTML", reply_markup=student_menu())
+
+@route(text=BTN_CHANGE_PASSWORD)
+def change_password(m):
+    s = get_state(m.chat.id)
+    if s.role != "student":
+        send(m.chat.id, "❌ Только для учеников.", reply_markup=role_menu())
+        return
+    reset_step(m.chat.id)
+    s.step = "new_password"
+    send(m.chat.id, "🔑 Новый пароль (минимум 6 символов):", reply_markup=cancel_button())
+
+@route(step="new_password")
+def save_new_password(m):
+    new_pass = m.text.strip()
+    if len(new_pass) < 6:
+        send(m.chat.id, "❌ Минимум 6 символов.", reply_markup=cancel_button())
+        return
+    s = get_state(m.chat.id)
+    update_student_password(s.student_id, new_pass)
+    reset_step(m.chat.id)
+    send(m.chat.id, "✅ Пароль изменён!", reply_markup=student_menu())
+
+@route(text=BTN_PROGRESS)
+def progress(m):
+    s = get_state(m.chat.id)
+    if s.role != "student":
+        return
+    reset_step(m.chat.id)
+    text = student_report(s.student_id)
+    if text is None:
+        send(m.chat.id, "📭 У вас пока нет оценок.", reply_markup=student_menu())
+        return
+    send_long(m.chat.id, text, reply_markup=student_menu())
+
+@route(text=BTN_HISTORY)
+def history(m):
+    s = get_state(m.chat.id)
+    if s.role != "student":
+        return
+    reset_step(m.chat.id)
+    text = render_history(s.student_id)
+    if text is None:
+        send(m.chat.id, "📭 Оценок прошлых лет нет.", reply_markup=student_menu())
+        return
+    send_long(m.chat.id, text, reply_markup=student_menu())
+
+@route(command="history")
+def staff_history(m):
+    # /history ФИО: archived years of any student, for teachers and admins
+    s = get_state(m.chat.id)
+    if s.role not in ("teacher", "admin"):
+        send(m.chat.id, "❌ Только для преподавателей и администраторов.", reply_markup=role_menu())
+        return
+    menu = teacher_menu() if s.role == "teacher" else admin_menu()
+    parts = m.text.split(maxsplit=1)
+    name = parts[1].strip() if len(parts) > 1 else ""
+    if not name:
+        send(m.chat.id, "✍️ Использование: /history ФИО ученика", reply_markup=menu)
+        return
+    student_id = student_id_by_login(name)
+    text = render_history(student_id) if student_id is not None else None
+    if text is None:
+        send(m.chat.id, f"📭 У <b>{html.escape(name)}</b> нет оценок прошлых лет.", parse_mode="HTML", reply_markup=menu)
+        return
+    send_long(m.chat.id, f"👤 <b>{html.escape(name)}</b>\n\n" + text, reply_markup=menu)
+
+# ================== EXECUTOR ==================
+# Every chat is a step machine, so its updates must be handled in order,
+# while different chats can run in parallel. Updates are sharded by chat id
+# onto a fixed set of lanes; each lane is one thread with its own bounded
+# queue, so a chat always lands on the same serial lane. Updates travel as
+# raw JSON dicts and are parsed on their lane.
+def update_chat_id(update):
+    for kind in ("message", "edited_message"):
+        if kind in update:
+            return update[kind]["chat"]["id"]
+    if "callback_query" in update:
+        query = update["callback_query"]
+        return query["message"]["chat"]["id"] if "message" in query else query["from"]["id"]
+    return update["update_id"]
+
+class ChatExecutor:
+    def __init__(self, lanes, depth):
+        self.queues = [queue.Queue(maxsize=depth) for _ in range(lanes)]
+        self.processed = [0] * lanes
+        self.waited = [0.0] * lanes
+        self.rejected = 0
+
+    def lane_of(self, chat_id):
+        # the process was already picked by hash % WORKER_PROCESSES
+        return hash(chat_id) // WORKER_PROCESSES % len(self.queues)
+
+    def submit(self, update, block=True):
+        try:
+            self.queues[self.lane_of(update_chat_id(update))].put((time.monotonic(), update), block=block)
+        except queue.Full:
+            self.rejected += 1
+            raise
+
+    def work(self, lane):
+        q = self.queues[lane]
+        while True:
+            queued_at, update = q.get()
+            self.waited[lane] += time.monotonic() - queued_at
+            try:
+                bot.process_new_updates([types.Update.de_json(update)])
+            except Exception as e:
+                print(f"⚠️ Ошибка обработки обновления {update.get('update_id')}: {e}")
+            finally:
+                self.processed[lane] += 1
+                q.task_done()
+
+    def start(self):
+        for lane in range(len(self.queues)):
+            threading.Thread(target=self.work, args=(lane,), name=f"lane-{lane}", daemon=True).start()
+
+    def join(self):
+        for q in self.queues:
+            q.join()
+
+    def stats(self):
+        depths = [q.qsize() for q in self.queues]
+        processed = sum(self.processed)
+        mean_depth = sum(depths) / len(depths)
+        mean_processed = processed / len(self.processed)
+        return {
+            "lanes": len(self.queues),
+            "depth": sum(depths),
+            "max_depth": max(depths),
+            "depth_skew": max(depths) / mean_depth if mean_depth else 1.0,
+            "processed": processed,
+            "processed_skew": max(self.processed) / mean_processed if mean_processed else 1.0,
+            "avg_wait_ms": sum(self.waited) / processed * 1000 if processed else 0.0,
+            "rejected": self.rejected,
+        }
+
+def run_polling(intake):
+    bot.remove_webhook()
+    offset = None
+    while True:
+        try:
+            updates = apihelper.get_updates(bot.token, offset, None, 70, None, 60)
+        except Exception as e:
+            print(f"⚠️ Ошибка getUpdates: {e}")
+            time.sleep(3)
+            continue
+        for update in updates:
+            offset = update["update_id"] + 1
+            # blocks while the lane is full, which throttles polling itself
+            intake.submit(update)
+
+# ================== WEBHOOK ==================
+# Updates are acknowledged as soon as they are queued on their chat's lane.
+# When that lane is full the server answers 503, and Telegram redelivers the
+# update later instead of us buffering without bound.
+# Without WEBHOOK_URL nothing is registered with Telegram, which makes local
+# testing simple: POST a recorded update to the server, e.g.
+#   curl -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" \
+#        -d @update.json http://127.0.0.1:8443/webhook
+WEBHOOK_MAX_BODY = 1024 * 1024
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            self.reply(404)
+            return
+        secret = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+            self.reply(403)
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            self.reply(400)
+            return
+        if length < 0:
+            self.reply(400)
+            return
+        if length > WEBHOOK_MAX_BODY:
+            self.reply(413)
+            return
+        try:
+            update = json.loads(self.rfile.read(length))
+            update_chat_id(update)
+        except Exception:
+            self.reply(400)
+            return
+        try:
+            self.server.intake.submit(update, block=False)
+        except queue.Full:
+            self.reply(503, retry_after=1)
+            return
+        self.reply(200)
+
+    def reply(self, status, retry_after=None):
+        self.send_response(status)
+        if retry_after:
+            self.send_header("Retry-After", str(retry_after))
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+def run_webhook(intake):
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("❌ Для BOT_MODE=webhook нужен WEBHOOK_SECRET в .env файле")
+    if WEBHOOK_URL:
+        bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET, max_connections=40)
+    server = ThreadingHTTPServer((WEBHOOK_HOST, WEBHOOK_PORT), WebhookHandler)
+    server.daemon_threads = True
+    server.intake = intake
+    print(f"🌐 Webhook слушает http://{WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    server.serve_forever()
+
+# ================== METRICS ENDPOINT ==================
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def label_text(names, values):
+    return ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values))
+
+def render_metrics():
+    lines = []
+    for family in HISTOGRAMS:
+        lines += [f"# HELP {family.name} {family.help}", f"# TYPE {family.name} histogram"]
+        with family.lock:
+            series = [(key, list(h.counts), h.sum, h.count) for key, h in family.series.items()]
+        for key, counts, total, count in series:
+            labels = label_text(family.labels, key)
+            cumulative = 0
+            for bound, n in zip(METRIC_BUCKETS + ("+Inf",), counts):
+                cumulative += n
+                lines.append(f'{family.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"{family.name}_sum{{{labels}}} {total}")
+            lines.append(f"{family.name}_count{{{labels}}} {count}")
+    for family in COUNTERS:
+        lines += [f"# HELP {family.name} {family.help}", f"# TYPE {family.name} counter"]
+        with family.lock:
+            series = list(family.series.items())
+        lines += [f"{family.name}{{{label_text(family.labels, key)}}} {value}" for key, value in series]
+
+    sessions = session_store.stats()
+    lanes = executor.stats()
+    try:
+        last_backup = last_backup_success()
+    finally:
+        release_db()
+    gauges = [
+        ("schoolbot_sessions_active", "gauge", [("", sessions["active"])]),
+        ("schoolbot_sessions_dirty", "gauge", [("", sessions["dirty"])]),
+        ("schoolbot_lane_queue_depth", "gauge", [("", lanes["depth"])]),
+        ("schoolbot_lane_depth_skew", "gauge", [("", lanes["depth_skew"])]),
+        ("schoolbot_updates_processed_total", "counter", [("", lanes["processed"])]),
+        ("schoolbot_updates_rejected_total", "counter", [("", lanes["rejected"])]),
+        # from the catalog, so backups made by any process count; the file
+        # with the oldest good snapshot decides
+        ("schoolbot_backup_last_success_timestamp_seconds", "gauge", [("", last_backup)]),
+    ]
+    caches = [(cache.name, cache.stats()) for cache in CACHES]
+    for field, kind in (("size", "gauge"), ("hits", "counter"), ("misses", "counter"), ("evictions", "counter")):
+        suffix = "" if kind == "gauge" else "_total"
+        gauges.append((f"schoolbot_cache_{field}{suffix}", kind, [(f'cache="{name}"', st[field]) for name, st in caches]))
+    for name, kind, samples in gauges:
+        lines.append(f"# TYPE {name} {kind}")
+        lines += [f"{name}{{{labels}}} {value}" if labels else f"{name} {value}" for labels, value in samples]
+    return "\n".join(lines) + "\n"
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port):
+    server = ThreadingHTTPServer((METRICS_HOST, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print(f"📈 Метрики: http://{METRICS_HOST}:{port}/metrics")
+
+# ================== APP ==================
+def create_app(config=None):
+    global bot, executor, outbox
+    globals().update(Config.from_env() if config is None else config)
+    if not BOT_TOKEN:
+        raise RuntimeError("❌ BOT_TOKEN не найден в .env файле")
+    if WRITE_SYNC.upper() not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+        raise ValueError(f"WRITE_SYNC: ожидается OFF, NORMAL, FULL или EXTRA, получено {WRITE_SYNC!r}")
+    if MAX_OPEN_SHARDS < 2:
+        raise ValueError("MAX_OPEN_SHARDS: нужно не меньше 2 (каталог и одна школа)")
+    bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
+    bot.register_message_handler(dispatch, content_types=["text", "document"])
+    bot.register_callback_query_handler(dispatch_callback, func=lambda c: True)
+    if METRICS:
+        apihelper._make_request = timed_request
+    executor = ChatExecutor(WORKER_LANES, LANE_QUEUE_SIZE)
+    outbox = Outbox(SEND_LANES, SEND_QUEUE_SIZE)
+    close_shards()
+    use_school(CATALOG)
+    init_db()
+    return bot
+
+# ================== SUPERVISOR ==================
+# With WORKER_PROCESSES > 1 this process only receives updates and forwards
+# each one to worker hash(chat id) % N, so a chat always lands on the same
+# process and its steps stay in order. Workers run the usual lanes and share
+# school.db: sessions are partitioned with their chats, writes serialize on
+# SQLite's lock (WAL, busy timeout) and caches sync via cache_invalidations.
+# Broadcast rate limits are per process.
+class ProcessRouter:
+    def __init__(self, processes, depth, target=None, args=()):
+        self.context = multiprocessing.get_context("spawn")
+        self.inboxes = [self.context.Queue(depth) for _ in range(processes)]
+        self.workers = [None] * processes
+        self.target = target or run_worker
+        self.args = args
+        self.forwarded = [0] * processes
+        self.rejected = self.restarts = 0
+        self.stopping = False
+
+    def spawn(self, index):
+        worker = self.context.Process(
+            target=self.target, args=(index, self.inboxes[index]) + self.args, name=f"worker-{index}"
+        )
+        worker.start()
+        self.workers[index] = worker
+
+    def start(self):
+        for index in range(len(self.workers)):
+            self.spawn(index)
+        threading.Thread(target=self.watch, name="supervisor", daemon=True).start()
+        atexit.register(self.stop)
+
+    def watch(self):
+        while not self.stopping:
+            time.sleep(1)
+            for index, worker in enumerate(self.workers):
+                if worker.exitcode is not None and not self.stopping:
+                    print(f"⚠️ Воркер {index} завершился с кодом {worker.exitcode}, перезапускаю")
+                    self.restarts += 1
+                    self.spawn(index)
+
+    def submit(self, update, block=True):
+        index = hash(update_chat_id(update)) % len(self.inboxes)
+        try:
+            self.inboxes[index].put(update, block=block)
+        except queue.Full:
+            self.rejected += 1
+            raise
+        self.forwarded[index] += 1
+
+    def stop(self, timeout=30):
+        # workers exit on the sentinel; the watcher must not restart them
+        self.stopping = True
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for worker in self.workers:
+            worker.join(timeout)
+            # not daemonic (a daemon can't start the scrypt pool), so a hung
+            # worker would block interpreter exit
+            if worker.is_alive():
+                worker.terminate()
+
+def run_worker(index, inbox, config):
+    # Ctrl+C reaches the whole process group; shutdown is driven by the supervisor
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if bot is None:
+        create_app(config)
+    if METRICS and METRICS_PORT:
+        start_metrics_server(METRICS_PORT + 1 + index)
+    session_store.start()
+    executor.start()
+    if index == 0:
+        resume_broadcasts()
+    while True:
+        update = inbox.get()
+        if update is None:
+            break
+        executor.submit(update)
+    executor.join()
+    outbox.join()
+    for sh in open_shards():
+        sh.writer.join()
+    session_store.flush()
+    # a multiprocessing child joins its children before the executor's own
+    # exit hook would stop them, so the scrypt pool must go first
+    if _auth_pool is not None:
+        _auth_pool.shutdown()
+
+# ================== RUN ==================
+if __name__ == "__main__":
+    config = Config.from_env()
+    create_app(config)
+    print("🚀 SchoolBot запущен!")
+    for problem in check_query_plans():
+        print(f"⚠️ Запрос без индекса: {problem}")
+    start_backups()
+    if METRICS and METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+    if WORKER_PROCESSES > 1:
+        intake = ProcessRouter(WORKER_PROCESSES, LANE_QUEUE_SIZE * WORKER_LANES, args=(config,))
+        intake.start()
+        print(f"🧩 Воркеров: {WORKER_PROCESSES}")
+    else:
+        session_store.start()
+        resume_broadcasts()
+        executor.start()
+        intake = executor
+    if BOT_MODE == "webhook":
+        run_webhook(intake)
+    else:
+        run_polling(intake)